@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background writer of csv files
+
+The station loops of the scripts write several small csv files per station
+(time series and yearly series of each period and season). On lustre each
+write waits for the file system, so AsyncWriter writes the files in a pool
+of threads while the trends of the next stations are computed. Jobs are
+(path, frame) pairs, the frame (pandas.Series or DataFrame) must not be
+modified after it is submitted.
+
+The queue is bounded, so that the computation blocks instead of keeping
+more than maxsize frames in memory when the file system is slow. Errors of
+the threads are raised by flush (and close), which waits until all
+submitted files are written.
+"""
+import os, atexit, threading, queue
+
+# Default number of writer threads and maximum number of queued files
+ASYNC_WRITE_WORKERS = 4
+ASYNC_WRITE_QUEUE = 1000
+
+
+class AsyncWriter:
+    """
+    Write csv files in background threads
+
+    Parameters
+    ----------
+    nworkers : int
+        Number of writer threads. If 0, files are written when submitted.
+    maxsize : int
+        Maximum number of files in the queue (submit blocks when full).
+    atomic : bool
+        If True, each file is written to a temporary file which is then
+        renamed, so that an interrupted run never leaves a partial file.
+    fsync : bool
+        If True, each file is synced to disk before it counts as written.
+
+    Example
+    -------
+    >>> with AsyncWriter() as writer:
+    ...     writer.submit('out/data.csv', series)
+    """
+    def __init__(self, nworkers=ASYNC_WRITE_WORKERS, maxsize=ASYNC_WRITE_QUEUE,
+                 atomic=False, fsync=False):
+        self.atomic = atomic
+        self.fsync = fsync
+        self._dirs = set()
+        self._dirs_lock = threading.Lock()
+        self._errors = []
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        for i in range(nworkers):
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name=f'AsyncWriter-{i}')
+            thread.start()
+            self._threads.append(thread)
+        self._closed = False
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # do not hide an exception of the caller by write errors
+        self.close(raise_errors=exc_type is None)
+
+    def _makedirs(self, path):
+        # create every output directory only once
+        outdir = os.path.dirname(path)
+        if not outdir or outdir in self._dirs:
+            return
+        with self._dirs_lock:
+            if not outdir in self._dirs:
+                os.makedirs(outdir, exist_ok=True)
+                self._dirs.add(outdir)
+
+    def _write(self, path, frame, kwargs):
+        self._makedirs(path)
+        fname = f'{path}.{threading.get_ident()}.tmp' if self.atomic else path
+        with open(fname, 'w', newline='') as f:
+            frame.to_csv(f, **kwargs)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        if self.atomic:
+            os.replace(fname, path)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            except Exception as e:
+                self._errors.append((job[0], e))
+            finally:
+                self._queue.task_done()
+
+    def submit(self, path, frame, **kwargs):
+        """
+        Write frame to csv file path (kwargs are passed to to_csv)
+
+        Blocks while the queue is full.
+        """
+        if self._closed:
+            raise ValueError('AsyncWriter is closed')
+        if not self._threads:
+            self._write(path, frame, kwargs)
+        else:
+            self._queue.put((path, frame, kwargs))
+
+    def flush(self):
+        """Wait until all submitted files are written, raise IOError if
+        writing of any of them failed"""
+        self._queue.join()
+        if self._errors:
+            errors, self._errors = self._errors, []
+            path, e = errors[0]
+            raise IOError(f'failed to write {len(errors)} file(s), first: '
+                          f'{path}: {e!r}') from e
+
+    def close(self, raise_errors=True):
+        """Flush and stop the threads (called at exit if not done before)"""
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        try:
+            if raise_errors:
+                self.flush()
+        finally:
+            for thread in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Computation of trends for many stations at once
+
+The functions here give the same results as
+pyaerocom.trends_engine.TrendsEngine.compute_trend (yearly and seasonal
+averaging, Mann-Kendall test, Theil-Sen slope and normalisation of the slope
+to %/yr), but for a matrix of time series (station x time) and all periods
+and seasons in one call, so that the computation is done on NumPy arrays
+instead of small pandas objects.
+"""
+import math
+from functools import lru_cache
+import warnings
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
+from scipy.stats import norm
+from pyaerocom.time_config import PANDAS_RESAMPLE_OFFSETS
+
+# Results returned for each station, period and season (NaN where
+# compute_trend returns None). The period specific normalised trend
+# (slp_<start>, slp_<start>_err and reg0_<start> in compute_trend) is
+# returned as slp, slp_err and reg0.
+TREND_KEYS = ['n', 'pval', 'm', 'm_err', 'yoffs', 'slp', 'slp_err', 'reg0']
+
+# Months of each season, and first day, end (first day of the next season,
+# included as in pyaerocom) and middle of the season in year yr. These are
+# copies of SEASONS, _start_season, _end_season and _mid_season in
+# pyaerocom.trends_helpers (private there), so that the results here do not
+# depend on pyaerocom internals. tests/test_batch_trends.py checks that they
+# still agree.
+SEASON_MONTHS = {'spring': [3, 4, 5],
+                 'summer': [6, 7, 8],
+                 'autumn': [9, 10, 11],
+                 'winter': [12, 1, 2]}
+SEASON_START = {'spring': (0, '03-01'), 'summer': (0, '06-01'),
+                'autumn': (0, '09-01'), 'winter': (-1, '12-01'),
+                'all': (0, '01-01')}
+SEASON_END = {'spring': '06-01', 'summer': '09-01', 'autumn': '12-01',
+              'winter': '03-01', 'all': '01-01'}
+SEASON_MID = {'spring': '04-15', 'summer': '07-15', 'autumn': '10-15',
+              'winter': '01-15', 'all': '06-15'}
+
+# Largest number of years for which the exact distribution of Kendall's
+# statistic is used (as in scipy.stats.kendalltau with method='auto')
+KENDALL_EXACT_MAX_N = 33
+
+
+def _nanmean_rows(values):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(values, axis=1)
+
+
+def _check_season(seas):
+    if seas not in SEASON_START:
+        raise ValueError('Invalid input for season (seas):', seas)
+
+
+def _start_season(seas, yr):
+    _check_season(seas)
+    offset, day = SEASON_START[seas]
+    return '{}-{}'.format(yr + offset, day)
+
+
+def _end_season(seas, yr):
+    _check_season(seas)
+    return '{}-{}'.format(yr, SEASON_END[seas])
+
+
+def _mid_season(seas, yr):
+    _check_season(seas)
+    return np.datetime64('{}-{}'.format(yr, SEASON_MID[seas]))
+
+
+def _day_end(date_str):
+    return np.datetime64(date_str) + np.timedelta64(1, 'D')
+
+
+def seasonal_means(times, values, season):
+    """
+    Compute yearly or seasonal means of each year, for all stations
+
+    Equivalent to pyaerocom.trends_helpers._get_yearly (without the start
+    year, and up to rounding errors of the sums), i.e. the seasons include
+    the first day of the next season and a year is only valid for season
+    'all' if all 4 seasons occur in the time index of that year.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        datetime64 time stamps (sorted).
+    values : numpy.ndarray
+        Data with shape (number of stations, number of times).
+    season : str
+        Season ('all', 'spring', 'summer', 'autumn' or 'winter').
+
+    Returns
+    -------
+    years : numpy.ndarray
+        All years occurring in times.
+    means : numpy.ndarray
+        Means of each year, shape (number of stations, number of years).
+    """
+    times = np.asarray(times, dtype='datetime64[ns]')
+    tyears = times.astype('datetime64[Y]').astype(int) + 1970
+    years = np.unique(tyears)
+    means = np.full((values.shape[0], len(years)), np.nan)
+    if season == 'all':
+        months = times.astype('datetime64[M]').astype(int) % 12 + 1
+    for i, yr in enumerate(years):
+        if season == 'all':
+            tmask = tyears == yr
+            found = set()
+            for seas, seas_months in SEASON_MONTHS.items():
+                if np.isin(months[tmask], seas_months).any():
+                    found.add(seas)
+            if len(found) < 4:
+                continue
+        else:
+            tmask = ((times >= np.datetime64(_start_season(season, yr))) &
+                     (times < _day_end(_end_season(season, yr))))
+        if tmask.any():
+            means[:, i] = _nanmean_rows(values[:, tmask])
+    return years, means
+
+
+@lru_cache(maxsize=None)
+def _kendall_cdf(n):
+    # Cumulative number of permutations of n elements with at most c
+    # inversions (Mahonian numbers), divided by n!
+    counts = np.zeros(n*(n-1)//2 + 1)
+    counts[0] = 1.
+    for j in range(2, n+1):
+        cum = np.cumsum(counts)
+        shifted = np.zeros_like(cum)
+        shifted[j:] = cum[:-j]
+        counts = cum - shifted
+    return np.cumsum(counts) / math.factorial(n)
+
+
+def kendall_pval_exact(n, c):
+    """
+    Exact two-sided p-value of Kendall's tau without ties
+
+    Parameters
+    ----------
+    n : int
+        Number of samples.
+    c : int
+        Number of concordant (or discordant) pairs.
+
+    Returns
+    -------
+    float
+        p-value
+    """
+    tot = n*(n-1)//2
+    c = min(c, tot - c)
+    if n <= 2:
+        return 1.
+    return min(2. * _kendall_cdf(n)[c], 1.)
+
+
+def _compressed_rows(x, values):
+    # Shift the valid (not NaN) values of each row to the start of the row,
+    # the same for x
+    valid = ~np.isnan(values)
+    order = np.argsort(~valid, axis=1, kind='stable')
+    vals = np.take_along_axis(values, order, axis=1)
+    xs = np.where(np.take_along_axis(valid, order, axis=1), x[order], np.nan)
+    return xs, vals, valid.sum(axis=1)
+
+
+def _row_stats(xs, vals, num):
+    # Medians of x and values of each row, computed on the valid values
+    # only, as for 1D arrays
+    medx = np.full(len(num), np.nan)
+    medy = np.full(len(num), np.nan)
+    for k in np.unique(num):
+        rows = num == k
+        medx[rows] = np.median(xs[rows, :k], axis=1)
+        medy[rows] = np.median(vals[rows, :k], axis=1)
+    return medx, medy
+
+
+def _mean_abs_residual(xs, vals, num, slope, yoffs):
+    out = np.full(len(num), np.nan)
+    for k in np.unique(num):
+        rows = num == k
+        reg = slope[rows, None] * xs[rows, :k] + yoffs[rows, None]
+        out[rows] = np.mean(np.abs(vals[rows, :k] - reg), axis=1)
+    return out
+
+
+def _tie_terms(vals, num):
+    # Number of tied pairs and sum of t*(t-1)*(2t+5) over groups of t tied
+    # values in each row
+    tied_pairs = np.zeros(len(num), dtype=int)
+    tie_sum = np.zeros(len(num))
+    srt = np.sort(vals, axis=1)
+    has_ties = (srt[:, 1:] == srt[:, :-1]).any(axis=1)
+    for row in np.where(has_ties)[0]:
+        _, cnt = np.unique(srt[row, :num[row]], return_counts=True)
+        cnt = cnt[cnt > 1]
+        tied_pairs[row] = (cnt * (cnt - 1) // 2).sum()
+        tie_sum[row] = (cnt * (cnt - 1.) * (2*cnt + 5)).sum()
+    return tied_pairs, tie_sum
+
+
+def trends_from_yearly(x, values, min_num_yrs, x0_period, slope_confidence=None):
+    """
+    Compute Mann-Kendall p-values, Theil-Sen slopes and normalised trends
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Years of the values, relative to 1970 (as float, strictly increasing).
+    values : numpy.ndarray
+        Yearly values, shape (number of stations, len(x)). NaN for missing.
+    min_num_yrs : int
+        Minimum number of valid years for a trend.
+    x0_period : float
+        First year of period, relative to 1970. Used for normalisation.
+    slope_confidence : float, optional
+        Confidence of slope, defaults to 0.68.
+
+    Returns
+    -------
+    dict
+        Arrays with one value per station for each of TREND_KEYS.
+    """
+    if slope_confidence is None:
+        slope_confidence = .68
+    x = np.asarray(x, dtype=float)
+    if np.any(np.diff(x) <= 0):
+        raise ValueError('x must be strictly increasing')
+    nstat = values.shape[0]
+    result = {key: np.full(nstat, np.nan) for key in TREND_KEYS}
+    num = (~np.isnan(values)).sum(axis=1)
+    result['n'] = num.astype(float)
+
+    rows = np.where(num >= min_num_yrs)[0]
+    if len(rows) == 0 or len(x) < 2:
+        return result
+    xs, vals, num = _compressed_rows(x, values[rows])
+    nt = num * (num - 1) // 2
+
+    # all pairwise slopes, NaN if one of the values is missing
+    i, j = np.triu_indices(len(x), 1)
+    dy = values[rows][:, j] - values[rows][:, i]
+    slopes = np.sort(dy / (x[j] - x[i]), axis=1)
+    idx = np.arange(len(rows))
+    medslope = (slopes[idx, (nt - 1) // 2] + slopes[idx, nt // 2]) / 2.
+    medx, medy = _row_stats(xs, vals, num)
+    yoffs = medy - medslope * medx
+
+    # confidence interval of slope (Sen, 1968)
+    alpha = slope_confidence
+    if alpha > 0.5:
+        alpha = 1. - alpha
+    z = norm.ppf(alpha / 2.)
+    tied_pairs, tie_sum = _tie_terms(vals, num)
+    sigsq = 1/18. * (num * (num-1) * (2*num+5) - tie_sum)
+    sigma = np.sqrt(sigsq)
+    ru = np.minimum(np.round((nt - z*sigma)/2.).astype(int), nt - 1)
+    rl = np.maximum(np.round((nt + z*sigma)/2.).astype(int) - 1, 0)
+    slope_low = slopes[idx, rl]
+    slope_up = slopes[idx, ru]
+    slope_err = (np.abs(medslope - slope_low) + np.abs(medslope - slope_up)) / 2.
+
+    # Mann-Kendall test (two-sided p-value of Kendall's tau-b)
+    with np.errstate(invalid='ignore'):
+        dis = (dy < 0).sum(axis=1)
+        con_minus_dis = (dy > 0).sum(axis=1) - dis
+    pval = np.full(len(rows), np.nan)
+    for k, row in enumerate(rows):
+        n, tot = num[k], nt[k]
+        if tied_pairs[k] == tot:
+            continue
+        if tied_pairs[k] == 0 and (n <= KENDALL_EXACT_MAX_N or
+                                   min(dis[k], tot - dis[k]) <= 1):
+            pval[k] = kendall_pval_exact(n, tot - dis[k])
+        else:
+            m = n * (n - 1.)
+            var = (m * (2*n + 5) - tie_sum[k]) / 18
+            pval[k] = 2 * ndtr(-np.abs(con_minus_dis[k] / np.sqrt(var)))
+
+    # normalisation with the value of the regression line in the first year
+    # of the period
+    v0_period = medslope * x0_period + yoffs
+    mean_residual = _mean_abs_residual(xs, vals, num, medslope, yoffs)
+    t0_data = xs[:, 0]
+    tN_data = xs[idx, num - 1]
+    dt_ratio = (t0_data - x0_period) / (tN_data - t0_data)
+    v0_err_period = mean_residual * (1 + dt_ratio)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trend_period = medslope / v0_period * 100
+        delta_sl = slope_err / v0_period
+        delta_ref = medslope * v0_err_period / v0_period**2
+        trend_period_err = np.sqrt(delta_sl**2 + delta_ref**2) * 100
+    positive = v0_period > 0
+
+    result['pval'][rows] = pval
+    result['m'][rows] = medslope
+    result['m_err'][rows] = slope_err
+    result['yoffs'][rows] = yoffs
+    result['slp'][rows] = np.where(positive, trend_period, np.nan)
+    result['slp_err'][rows] = np.where(positive, trend_period_err, np.nan)
+    result['reg0'][rows] = np.where(positive, v0_period, np.nan)
+    return result
+
+
+def compute_trends_batch(times, values, ts_type, periods, seasons,
+                         slope_confidence=None):
+    """
+    Compute trends for all stations, periods and seasons
+
+    Parameters
+    ----------
+    times : array-like
+        Time stamps of the data (sorted, datetime64 or DatetimeIndex).
+    values : numpy.ndarray
+        Data with shape (number of stations, number of times). NaN for
+        missing data.
+    ts_type : str
+        Frequency of data, 'monthly' or 'yearly'.
+    periods : list
+        Tuples (first year, last year, minimum number of years), as PERIODS
+        in constants.py.
+    seasons : list
+        Seasons, as SEASONS in constants.py.
+    slope_confidence : float, optional
+        Confidence of slope, defaults to 0.68.
+
+    Returns
+    -------
+    results : dict
+        For each of TREND_KEYS, an array with shape (number of stations,
+        number of periods, number of seasons). NaN where compute_trend
+        returns None (e.g. n if there is no data in the period, or all
+        trend values if there are too few years).
+    yearly : dict
+        For each (first year, last year, season), a tuple (dates, values)
+        of the yearly (seasonal) time series that compute_trend returns as
+        'data', with values of shape (number of stations, len(dates)), or
+        None if there is no data in the period.
+    """
+    if ts_type not in ['yearly', 'monthly']:
+        raise ValueError(ts_type)
+    times = np.asarray(times, dtype='datetime64[ns]')
+    values = np.asarray(values, dtype=float)
+    nstat = values.shape[0]
+    shape = (nstat, len(periods), len(seasons))
+    results = {key: np.full(shape, np.nan) for key in TREND_KEYS}
+    yearly = {}
+    tyears = times.astype('datetime64[Y]').astype(int) + 1970
+    for iseas, seas in enumerate(seasons):
+        if ts_type == 'monthly':
+            years, means = seasonal_means(times, values, seas)
+        for iper, (start, stop, min_yrs) in enumerate(periods):
+            tmask = ((times >= np.datetime64(_start_season(seas, start))) &
+                     (times < np.datetime64(str(stop + 1))))
+            if not tmask.any():
+                yearly[(start, stop, seas)] = None
+                continue
+            if ts_type == 'monthly':
+                sel = np.isin(years, np.unique(tyears[tmask]))
+                sel &= years >= start
+                dates = np.array([_mid_season(seas, yr) for yr in years[sel]],
+                                 dtype='datetime64[ns]')
+                data = means[:, sel]
+            else:
+                dates = times[tmask]
+                data = values[:, tmask]
+            yearly[(start, stop, seas)] = (dates, data)
+
+            dmask = ((dates >= _mid_season(seas, start)) &
+                     (dates <= _mid_season(seas, stop)))
+            x = dates[dmask].astype('datetime64[Y]').astype(float)
+            x0_period = np.datetime64(_mid_season(seas, start),
+                                      'Y').astype(float)
+            res = trends_from_yearly(x, data[:, dmask], min_yrs, x0_period,
+                                     slope_confidence)
+            for key in TREND_KEYS:
+                results[key][:, iper, iseas] = res[key]
+    return results, yearly
+
+
+def year_dates(years):
+    """
+    Time stamps of yearly data as in pyaerocom (year start plus the offset
+    of yearly resampling, i.e. 181 days) as datetime64[ns] array
+    """
+    offset = np.timedelta64(pd.Timedelta(PANDAS_RESAMPLE_OFFSETS['AS']))
+    years = np.asarray(years, dtype=int)
+    return (years - 1970).astype('datetime64[Y]').astype('datetime64[ns]') + offset
+
+
+def yearly_percentiles(times, values, percentiles, min_num_obs=0):
+    """
+    Yearly percentiles of daily data for all stations and percentiles
+
+    Gives the same as resampling the series of each station to yearly with
+    how='<percentile>percentile' and a minimum number of daily values
+    (StationData.resample_time), for all percentiles at once: the data is
+    grouped by year once and np.nanpercentile is called once per year.
+
+    Parameters
+    ----------
+    times : array-like
+        Time stamps of the data (sorted, datetime64 or DatetimeIndex).
+    values : numpy.ndarray
+        Data with shape (number of stations, number of times). NaN for
+        missing data.
+    percentiles : list
+        Percentiles (0-100).
+    min_num_obs : int, optional
+        Minimum number of valid values in a year, NaN otherwise.
+
+    Returns
+    -------
+    dates : numpy.ndarray
+        Time stamps of the years (datetime64[ns], as the index of yearly
+        series resampled in pyaerocom, i.e. year start plus 181 days).
+    result : numpy.ndarray
+        Percentiles with shape (number of stations, number of years,
+        number of percentiles).
+    """
+    times = pd.DatetimeIndex(times)
+    values = np.asarray(values, dtype=float)
+    if len(times) == 0:
+        return (np.array([], dtype='datetime64[ns]'),
+                np.full((values.shape[0], 0, len(percentiles)), np.nan))
+    tyears = np.asarray(times.year)
+    years = np.arange(tyears[0], tyears[-1] + 1)
+    starts = np.searchsorted(tyears, years, side='left')
+    stops = np.searchsorted(tyears, years, side='right')
+    result = np.full((values.shape[0], len(years), len(percentiles)), np.nan)
+    for iyr, (start, stop) in enumerate(zip(starts, stops)):
+        if stop == start:
+            continue
+        block = values[:, start:stop]
+        with warnings.catch_warnings():
+            # all-NaN stations give NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            perc = np.nanpercentile(block, percentiles, axis=1)
+        perc[:, (~np.isnan(block)).sum(axis=1) < min_num_obs] = np.nan
+        result[:, iyr, :] = perc.T
+    return year_dates(years), result
+
+
+def trend_row(results, istat, iper, iseas):
+    """
+    Get trend results in the order of the columns of the trend tables
+
+    Parameters
+    ----------
+    results : dict
+        First output of compute_trends_batch.
+    istat, iper, iseas : int
+        Index of station, period and season.
+
+    Returns
+    -------
+    list
+        trend [%/yr], trend err [%/yr], yoffs, slope, slope err, num yrs
+        and pval, with None for missing values as in compute_trend.
+    """
+    row = []
+    for key in ['slp', 'slp_err', 'reg0', 'm', 'm_err', 'n', 'pval']:
+        val = results[key][istat, iper, iseas]
+        if np.isnan(val):
+            row.append(None)
+        elif key == 'n':
+            row.append(int(val))
+        else:
+            row.append(val)
+    return row
+
+
+def yearly_series(yearly, istat, start, stop, seas, name=None, index_name=None):
+    """
+    Get yearly time series of one station as pandas.Series
+
+    Returns None if there is no data in the period, as compute_trend. The
+    name of the series and its index can be given (e.g. as in the series
+    passed to compute_trend, which keeps them).
+    """
+    entry = yearly[(start, stop, seas)]
+    if entry is None:
+        return None
+    dates, data = entry
+    return pd.Series(data[istat], index=pd.DatetimeIndex(dates, name=index_name),
+                     name=name)
+
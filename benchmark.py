@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the trend scripts with synthetic model and station data
+
+The scripts can only run against the EMEP model runs on lustre and the EBAS
+archive. This benchmark generates stand-ins for both:
+
+- EMEP-style yearly model files (<year>/Base_day.nc and, for the first
+  year, Base_hour.nc) on a lon-lat grid, containing every raw field needed
+  by the benchmarked variables (named as in the emep_variables.ini of
+  pyaerocom),
+- station observations as pyaerocom.UngriddedData (daily, with some weekly
+  samplers, and hourly for ozone), with missing values, sampled from the
+  same smooth fields as the model plus noise.
+
+It then runs the processing of calc_trends.py (process_var),
+calc_trends_o3.py (process_o3 and process_metrics) and
+write_model_pm25spec.py (write_pm25spec) on them, recording each stage with profiling.py. The report is written to
+BENCHMARK_RESULTS_DIR, named by size and git commit, so that two commits
+can be compared with
+
+    python benchmark.py --size small
+    python profiling.py benchmark_results/<old>.json benchmark_results/<new>.json
+
+The data is generated once per size in BENCHMARK_DATA_DIR and reused.
+Everything runs locally, no network access is needed.
+"""
+import os, json, shutil, subprocess, tempfile, functools
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pyaerocom as pya
+from pyaerocom.io.read_mscw_ctm import ReadMscwCtm
+from pyaerocom.variable_helpers import get_emep_variables
+
+from read_mods import (read_models, ReadPlan, StationGridIndex, CALCULATE_HOW, group_variables,
+                       EMEP_VAR_UNITS)
+from ozone_metrics import model_hourly_grid
+from manifest import OutputUpdate, station_fingerprints
+from output_store import get_output_writer
+from async_writer import AsyncWriter
+from profiling import PROFILER, stage, compare_reports
+import calc_trends
+import calc_trends_o3
+import write_model_pm25spec
+
+# Problem sizes: number of stations, number of years (ending in LAST_YR) and
+# grid size (latitudes x longitudes) of the synthetic model files
+BENCHMARK_SIZES = {
+    'small':  dict(nstations=20, nyears=8, nlat=40, nlon=50),
+    'medium': dict(nstations=100, nyears=20, nlat=80, nlon=100),
+    'large':  dict(nstations=400, nyears=20, nlat=100, nlon=120),
+    }
+
+# Last year of the synthetic data (the periods in constants.py end in 2019)
+LAST_YR = 2019
+
+# Domain of the synthetic model grid (EMEP-like)
+GRID_LAT_RANGE = (30., 75.)
+GRID_LON_RANGE = (-30., 45.)
+
+# Variables of the benchmarked pipelines
+TREND_VARS = ['concpm25', 'concso4', 'concNtno3']
+PM25SPEC_VARS = write_model_pm25spec.EBAS_VARS
+
+# Fraction of stations with weekly instead of daily samples, and fraction of
+# missing observations
+WEEKLY_STATION_FRACTION = 0.1
+MISSING_FRACTION = 0.1
+
+# Units of the raw EMEP fields by prefix of the EMEP variable name
+EMEP_UNITS_BY_PREFIX = [('SURF_ugC_', 'ug C m-3'), ('SURF_ug_', 'ug/m3'),
+                        ('SURF_ppb_', 'ppb'), ('SURF_MAXO3', 'ppb')]
+
+BENCHMARK_DATA_DIR = 'benchmark_data'
+BENCHMARK_RESULTS_DIR = 'benchmark_results'
+
+# Data ID of the synthetic observations
+SYNTHETIC_OBS_ID = 'SyntheticObs'
+
+
+def emep_fields(var, var_map=None):
+    """
+    Names of the EMEP file variables needed to read a raw pyaerocom variable
+
+    Variables that ReadMscwCtm computes on import (AUX_REQUIRES) need all
+    of their inputs.
+
+    Returns
+    -------
+    list
+        (pyaerocom name, EMEP name) of each field
+    """
+    if var_map is None:
+        var_map = get_emep_variables()
+    if var in var_map:
+        return [(var, var_map[var])]
+    if var in ReadMscwCtm.AUX_REQUIRES:
+        return [field for req in ReadMscwCtm.AUX_REQUIRES[var]
+                for field in emep_fields(req, var_map)]
+    raise ValueError(f'{var} cannot be read from EMEP files')
+
+
+def emep_units(emep_var, var):
+    """Units of a raw field in the synthetic EMEP files"""
+    for prefix, units in EMEP_UNITS_BY_PREFIX:
+        if emep_var.startswith(prefix):
+            return units
+    return pya.const.VARS[var].units
+
+
+def _seed(*items):
+    # reproducible seed for each field, year and station set
+    return int.from_bytes(json.dumps(items).encode(), 'little') % 2**32
+
+
+def grid(nlat, nlon):
+    """Latitudes and longitudes (cell centres) of the synthetic model grid"""
+    dlat = (GRID_LAT_RANGE[1] - GRID_LAT_RANGE[0]) / nlat
+    dlon = (GRID_LON_RANGE[1] - GRID_LON_RANGE[0]) / nlon
+    lats = GRID_LAT_RANGE[0] + dlat * (np.arange(nlat) + 0.5)
+    lons = GRID_LON_RANGE[0] + dlon * (np.arange(nlon) + 0.5)
+    return lats, lons
+
+
+def synthetic_values(var, times, lats, lons, rng):
+    """
+    Smooth field with seasonal cycle, trend and noise
+
+    Parameters
+    ----------
+    var : str
+        Field name (sets the magnitude).
+    times : pandas.DatetimeIndex
+        Time stamps.
+    lats, lons : numpy.ndarray
+        Coordinates of the points (same shape).
+    rng : numpy.random.Generator
+        Random number generator for the noise.
+
+    Returns
+    -------
+    numpy.ndarray
+        Values with shape (len(times), *lats.shape), float32
+    """
+    scale = 1 + _seed(var) % 50
+    lats = np.asarray(lats)[np.newaxis]
+    lons = np.asarray(lons)[np.newaxis]
+    base = scale * (1 + np.exp(-(lats - 50)**2 / 200) * (1 + 0.5 * np.cos(np.radians(lons) * 8)))
+    tfrac = np.asarray(times.dayofyear + times.hour / 24.) / 365.25
+    shape = (len(times),) + (1,) * (lats.ndim - 1)
+    season = (1 + 0.3 * np.cos(2 * np.pi * (tfrac - 0.05))).reshape(shape)
+    diurnal = (1 + 0.2 * np.sin(2 * np.pi * (np.asarray(times.hour) - 9) / 24)).reshape(shape)
+    trend = (1 - 0.02 * (np.asarray(times.year) - 2000)).reshape(shape)
+    noise = rng.lognormal(0, 0.2, size=(len(times),) + lats.shape[1:])
+    return (base * season * diurnal * trend * noise).astype(np.float32)
+
+
+def model_times(year, data_freq):
+    """Time stamps of a yearly model file"""
+    freq = dict(day='D', hour='H')[data_freq]
+    return pd.date_range(f'{year}-01-01', f'{year}-12-31 23:00', freq=freq)
+
+
+def make_model_file(path, fields, year, nlat, nlon, data_freq):
+    """
+    Write a synthetic EMEP model file
+
+    Parameters
+    ----------
+    path : str
+        Path of the file (e.g. <year>/Base_day.nc).
+    fields : list
+        (pyaerocom name, EMEP name) of the fields to write.
+    year : int
+        Year of the file.
+    nlat, nlon : int
+        Grid size.
+    data_freq : str
+        'day' or 'hour'.
+    """
+    lats, lons = grid(nlat, nlon)
+    times = model_times(year, data_freq)
+    glats, glons = np.meshgrid(lats, lons, indexing='ij')
+    coords = dict(time=times,
+                  lat=('lat', lats, dict(units='degrees_north', standard_name='latitude',
+                                         long_name='latitude')),
+                  lon=('lon', lons, dict(units='degrees_east', standard_name='longitude',
+                                         long_name='longitude')))
+    data_vars = {}
+    for var, emep_var in fields:
+        rng = np.random.default_rng(_seed(emep_var, year, data_freq, nlat, nlon))
+        values = synthetic_values(var, times, glats, glons, rng)
+        data_vars[emep_var] = (('time', 'lat', 'lon'), values,
+                               dict(units=emep_units(emep_var, var)))
+    ds = xr.Dataset(data_vars, coords=coords)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    time_units = 'hours' if data_freq == 'hour' else 'days'
+    encoding = dict(time=dict(units=f'{time_units} since {year}-01-01 00:00:00',
+                              calendar='proleptic_gregorian', dtype='float64'))
+    ds.to_netcdf(f'{path}.tmp', encoding=encoding)
+    os.replace(f'{path}.tmp', path)
+
+
+def benchmark_modelfile(datadir, year, data_freq):
+    """Model file of a year in the synthetic data (getfile of read_model)"""
+    return os.path.join(datadir, 'model', str(year), f'Base_{data_freq}.nc')
+
+
+def make_stations(nstations, seed=0):
+    """
+    Synthetic station list inside the grid domain
+
+    Returns
+    -------
+    pandas.DataFrame
+        Columns station_id, station_name, latitude, longitude, altitude and
+        ts_type (daily or weekly)
+    """
+    rng = np.random.default_rng(seed)
+    margin = 2.
+    lats = rng.uniform(GRID_LAT_RANGE[0] + margin, GRID_LAT_RANGE[1] - margin, nstations)
+    lons = rng.uniform(GRID_LON_RANGE[0] + margin, GRID_LON_RANGE[1] - margin, nstations)
+    nweekly = int(round(WEEKLY_STATION_FRACTION * nstations))
+    ts_types = ['weekly'] * nweekly + ['daily'] * (nstations - nweekly)
+    return pd.DataFrame(dict(station_id=[f'XX{i:04d}R' for i in range(nstations)],
+                             station_name=[f'Synthetic station {i:04d}' for i in range(nstations)],
+                             latitude=np.round(lats, 4), longitude=np.round(lons, 4),
+                             altitude=np.round(rng.uniform(0, 1500, nstations)),
+                             ts_type=ts_types))
+
+
+def make_obs(var, stations, first_yr, last_yr, ts_type=None):
+    """
+    Synthetic observations of a variable at the stations
+
+    Parameters
+    ----------
+    var : str
+        Variable name (as in pyaerocom).
+    stations : pandas.DataFrame
+        Stations (see make_stations).
+    first_yr, last_yr : int
+        First and last year (both included).
+    ts_type : str, optional
+        Time resolution of all stations ('hourly', 'daily' or 'weekly'),
+        defaults to the ts_type of each station.
+
+    Returns
+    -------
+    pyaerocom.UngriddedData
+    """
+    freqs = dict(hourly='H', daily='D', weekly='7D')
+    units = EMEP_VAR_UNITS.get(var, pya.const.VARS[var].units)
+    stats = []
+    for station in stations.itertuples():
+        tst = ts_type or station.ts_type
+        times = pd.date_range(f'{first_yr}-01-01', f'{last_yr}-12-31 23:00', freq=freqs[tst])
+        rng = np.random.default_rng(_seed(var, station.station_id, tst))
+        values = synthetic_values(var, times, np.array([station.latitude]),
+                                  np.array([station.longitude]), rng)[:, 0].astype(float)
+        values[rng.random(len(values)) < MISSING_FRACTION] = np.nan
+        stat = pya.StationData(station_id=station.station_id,
+                               station_name=station.station_name,
+                               latitude=station.latitude, longitude=station.longitude,
+                               altitude=station.altitude, ts_type=tst,
+                               data_id=SYNTHETIC_OBS_ID, framework='EMEP',
+                               data_level=2, filename=f'{station.station_id}.{var}.synthetic')
+        stat.var_info[var] = dict(units=units, ts_type=tst, matrix='synthetic')
+        stat[var] = pd.Series(values, index=times)
+        stats.append(stat)
+    return pya.UngriddedData.from_station_data(stats)
+
+
+def make_benchmark_data(datadir, nstations, nyears, nlat, nlon):
+    """
+    Generate the synthetic model files (if not done before)
+
+    Returns
+    -------
+    stations : pandas.DataFrame
+        Stations (see make_stations).
+    first_yr, last_yr : int
+        First and last year of the data.
+    """
+    first_yr, last_yr = LAST_YR - nyears + 1, LAST_YR
+    var_map = get_emep_variables()
+    raw_vars = ReadPlan(TREND_VARS + [calc_trends_o3.VAR_DMAX] + PM25SPEC_VARS,
+                        CALCULATE_HOW).raw_vars
+    fields = sorted(set(field for var in raw_vars for field in emep_fields(var, var_map)))
+    for year in range(first_yr, last_yr + 1):
+        path = benchmark_modelfile(datadir, year, 'day')
+        if not os.path.exists(path):
+            print(f'Generating {path}')
+            make_model_file(path, fields, year, nlat, nlon, 'day')
+    # hourly ozone of the first year only (hourly files are large)
+    path = benchmark_modelfile(datadir, first_yr, 'hour')
+    if not os.path.exists(path):
+        print(f'Generating {path}')
+        make_model_file(path, emep_fields(calc_trends_o3.VAR_ORIG, var_map),
+                        first_yr, nlat, nlon, 'hour')
+    return make_stations(nstations), first_yr, last_yr
+
+
+def _output_dirs(outdir, name):
+    obs_dir = os.path.join(outdir, name, 'obs_output')
+    mod_dir = os.path.join(outdir, name, 'mod_output')
+    os.makedirs(obs_dir, exist_ok=True)
+    os.makedirs(mod_dir, exist_ok=True)
+    return obs_dir, mod_dir
+
+
+def bench_trends(getfile, stations, first_yr, last_yr, outdir):
+    """Processing of calc_trends.py (observations are built beforehand)"""
+    start_yr, stop_yr = str(first_yr), str(last_yr + 1)
+    obsdata = {var: make_obs(var, stations, first_yr, last_yr) for var in TREND_VARS}
+    var_info = {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': 'day'} for var in TREND_VARS}
+    obs_dir, mod_dir = _output_dirs(outdir, 'trends')
+    # one group of variables sharing model fields at a time, as calc_trends.var_tasks
+    for group in group_variables(TREND_VARS, CALCULATE_HOW):
+        station_index = StationGridIndex.from_ungridded([obsdata[var] for var in group])
+        moddata = read_models(group, getfile, start_yr, stop_yr, var_info, CALCULATE_HOW,
+                              station_index=station_index)
+        for var in group:
+            update = OutputUpdate(os.path.join(obs_dir, f'manifest_{var}.json'), 'benchmark',
+                                  station_fingerprints(obsdata[var], var), incremental=False)
+            repos = [(obs_dir, mod_dir, calc_trends.STRICT_RESAMPLE_CONSTRAINTS, update)]
+            calc_trends.process_var(var, obsdata.pop(var), moddata.pop(var), start_yr, stop_yr,
+                                    repos)
+
+
+def bench_o3(getfile, stations, first_yr, last_yr, outdir):
+    """Processing of calc_trends_o3.py (hourly observations)"""
+    start_yr, stop_yr = str(first_yr), str(last_yr + 1)
+    var = calc_trends_o3.VAR_DMAX
+    data = make_obs(calc_trends_o3.VAR_ORIG, stations, first_yr, last_yr, ts_type='hourly')
+    var_info = {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': 'day'}}
+    mdata = read_models([var], getfile, start_yr, stop_yr, var_info,
+                        station_index=StationGridIndex.from_ungridded(data))[var]
+    obs_dir, mod_dir = _output_dirs(outdir, 'o3')
+    metrics = calc_trends_o3.OZONE_METRICS_VARS
+    with AsyncWriter() as writer:
+        obs_out = get_output_writer('csv', obs_dir, var, writer)
+        mod_out = get_output_writer('csv', mod_dir, var, writer)
+        hourly = calc_trends_o3.get_hourly_grid(data, start_yr, stop_yr)
+        calc_trends_o3.process_o3(data, mdata, start_yr, stop_yr, obs_out, mod_out,
+                                  hourly)
+
+        # other metrics, with the hourly model file of the first year only
+        mod_hourly = model_hourly_grid(hourly, getfile, calc_trends_o3.VAR_ORIG,
+                                       EMEP_VAR_UNITS[calc_trends_o3.VAR_ORIG])
+        outputs = {metric: (get_output_writer('csv', obs_dir, metric, writer),
+                            get_output_writer('csv', mod_dir, metric, writer))
+                   for metric in metrics}
+        calc_trends_o3.process_metrics(data, hourly, mod_hourly, start_yr, stop_yr,
+                                       outputs)
+        with stage('write_output', var):
+            obs_out.close()
+            mod_out.close()
+            for metric_obs_out, metric_mod_out in outputs.values():
+                metric_obs_out.close()
+                metric_mod_out.close()
+
+
+def bench_pm25spec(getfile, stations, first_yr, last_yr, outdir):
+    """Processing of write_model_pm25spec.py"""
+    pm25spec_dir = os.path.join(outdir, 'pm25spec')
+    os.makedirs(pm25spec_dir, exist_ok=True)
+    write_model_pm25spec.write_pm25spec(
+        getfile, list(stations.station_id), list(stations.latitude),
+        list(stations.longitude), pm25spec_dir, first_yr, last_yr, 'day')
+
+
+BENCHMARKS = {'trends': bench_trends, 'o3': bench_o3, 'pm25spec': bench_pm25spec}
+
+
+def git_commit():
+    """Short hash of the checked out commit (with -dirty if modified)"""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_benchmark(size='small', benchmarks=None, datadir=BENCHMARK_DATA_DIR,
+                  resultdir=BENCHMARK_RESULTS_DIR, tracemalloc_on=False):
+    """
+    Run benchmarks and write the profiling report
+
+    Parameters
+    ----------
+    size : str
+        Key of BENCHMARK_SIZES.
+    benchmarks : list, optional
+        Keys of BENCHMARKS to run (default all).
+    datadir : str
+        Folder of the synthetic data (a subfolder per size).
+    resultdir : str
+        Folder of the reports.
+    tracemalloc_on : bool
+        Record the peak memory of each stage with tracemalloc.
+
+    Returns
+    -------
+    str
+        Path of the JSON report
+    """
+    if benchmarks is None:
+        benchmarks = list(BENCHMARKS)
+    params = BENCHMARK_SIZES[size]
+    datadir = os.path.join(datadir, size)
+    stations, first_yr, last_yr = make_benchmark_data(datadir, **params)
+    getfile = functools.partial(benchmark_modelfile, datadir)
+
+    commit = git_commit()
+    PROFILER.enable(resultdir, f'benchmark_{size}_{commit}', tracemalloc_on=tracemalloc_on,
+                    size=size, commit=commit, benchmarks=benchmarks, **params)
+    outdir = tempfile.mkdtemp(prefix='emep_trends_benchmark_')
+    try:
+        for name in benchmarks:
+            with stage('benchmark', name):
+                BENCHMARKS[name](getfile, stations, first_yr, last_yr, outdir)
+    finally:
+        shutil.rmtree(outdir)
+    return PROFILER.write_report()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the trend scripts with '
+                                                 'synthetic data')
+    parser.add_argument('--size', default='small', choices=list(BENCHMARK_SIZES))
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS),
+                        help='benchmarks to run (default all)')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='record the peak memory of each stage (slow)')
+    parser.add_argument('--compare', default=None,
+                        help='JSON report of a previous run to compare with')
+    args = parser.parse_args()
+    report = run_benchmark(args.size, args.benchmarks, tracemalloc_on=args.tracemalloc)
+    if args.compare is not None:
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(compare_reports(args.compare, report))
@@ -8,11 +8,23 @@ Created on Tue Jun 15 11:16:33 2021
 import os, socket, tqdm
 import numpy as np
 import pandas as pd
+import scipy
 import pyaerocom as pya
 
+from station_meta import get_station_meta, extract_stations
+from obs_cache import read_obs, read_obs_multi
+from checkpoint import Checkpoint, get_checkpoint_file, chunks
+from async_writer import AsyncWriter
+from profiling import PROFILER, stage
 from helper_functions import (delete_outdated_output, clear_output,
-                              get_years_to_read)
-from read_mods import read_model, get_modelfile, CALCULATE_HOW, EMEP_VAR_UNITS
+                              get_years_to_read, order_variables, run_tasks,
+                              colocate_monthly)
+from batch_trends import compute_trends_batch, trend_row, yearly_series
+from output_store import get_output_writer, KIND_SITEMETA, KIND_TRENDS
+from manifest import (OutputUpdate, get_manifest_file, hash_files, model_file_stats,
+                      config_fingerprint, station_fingerprints, merge_table)
+from read_mods import (read_models, get_modelfile, CALCULATE_HOW, EMEP_VAR_UNITS,
+                       StationGridIndex, group_variables)
 from variables import ALL_EBAS_VARS
 from constants import PERIODS, EBAS_ID, EBAS_LOCAL, SEASONS
 
@@ -24,6 +36,64 @@ RELAXED_RESAMPLE_CONSTRAINTS = dict(monthly     =   dict(daily      = 4, weekly
 
 RESAMPLE_HOW = 'mean'
 
+# Number of worker processes used for reading the yearly model files
+# (1 means that the files are read one after another)
+MODEL_READ_WORKERS = 1
+
+# Directory for cached concatenated model data (None: no cache, see README.md)
+MODEL_CACHE_DIR = None
+
+# Directory for cached filtered observations (None: no cache, see README.md)
+OBS_CACHE_DIR = None
+# Read all variables from EBAS in one pass, so that files containing several
+# of the variables are parsed once (needs memory for all variables at once)
+OBS_READ_ONE_PASS = True
+
+# Number of worker processes used for processing the variables after reading
+# (colocation, trends and output; 1 means one variable after another)
+VAR_WORKERS = 1
+# Maximum memory (address space) of each of these worker processes in GB
+# (None for no limit)
+VAR_WORKER_MAX_MEM_GB = None
+# Variables that take longest to process, they are started first
+HEAVY_VARS = ['concpm25', 'concNtno3']
+
+# Format of output, 'csv' (one file per station and series, as in the data
+# repositories) or 'store' (one file per variable, see output_store.py)
+OUTPUT_FORMAT = 'csv'
+
+# Only recompute the stations whose observations changed since the last run
+# (see manifest.py). All output is recomputed if the settings, the model files,
+# the code (CODE_FILES) or the versions of pyaerocom, numpy, pandas or scipy
+# changed, or if False.
+INCREMENTAL = True
+# Number of stations processed between two checkpoints (the progress of a
+# variable is saved after each batch, see --resume)
+CHECKPOINT_STATIONS = 200
+
+# Number of threads writing the csv files in the background while the next
+# stations are computed (0: write directly, see async_writer.py)
+ASYNC_WRITE_WORKERS = 4
+# Write each csv file to a temporary file, sync it to disk and rename it
+# (slower, but no partial files if the node fails)
+ASYNC_WRITE_SAFE = False
+
+# Record wall time, CPU time, I/O and memory of the stages of the run and
+# write a report to this folder of the (first) data repository, e.g.
+# 'run_reports' (None: no report, see profiling.py and README.md)
+PROFILE_REPORT_DIR = None
+# Trace memory allocations for the peak memory of each stage (slow)
+PROFILE_TRACEMALLOC = False
+# Variables for which a cProfile of process_var is dumped to the report folder
+PROFILE_CPROFILE_VARS = []
+
+# Source files whose changes trigger recomputing all output (all modules of
+# this repository imported by this script)
+CODE_FILES = ['calc_trends.py', 'batch_trends.py', 'station_meta.py',
+              'helper_functions.py', 'output_store.py', 'manifest.py', 'checkpoint.py',
+              'read_mods.py', 'derive_cubes.py', 'constants.py', 'variables.py',
+              'obs_cache.py', 'async_writer.py', 'profiling.py']
+
 EBAS_VARS = [
              'concno2',
             # 'concso2',
@@ -55,94 +125,76 @@ EBAS_BASE_FILTERS = dict(set_flags_nan   = True,
                          #data_level      = 2
                          framework       = ['*EMEP*', '*ACTRIS*'])
 
-# Folder where data repos are located. In this folder, there must already be located folders named
-# 'emep_trends_2021_data' and 'emep_trends_2021_data_relaxed'.
+# Folder where data repos are located. In this folder, there must already be located
+# the folders of OUTPUT_REPOS.
 PFOLDER_DATA_REPOS = '../'
 #PFOLDER_DATA_REPOS = '/home/eivindgw/testdata/'  # !!!!!!!!!!!!!! for testing
 
-ISRELAXED = False
-
-if __name__ == '__main__':
-
-    if ISRELAXED:
-        DATAREPO_DIR = os.path.join(PFOLDER_DATA_REPOS, 'emep_trends_2021_data_relaxed')
-        RESAMPLE_CONSTRAINTS = RELAXED_RESAMPLE_CONSTRAINTS
-    else:
-        DATAREPO_DIR = os.path.join(PFOLDER_DATA_REPOS, 'emep_trends_2021_data')
-        RESAMPLE_CONSTRAINTS = STRICT_RESAMPLE_CONSTRAINTS
-    if not os.path.exists(DATAREPO_DIR):
-        raise IOError('Data repository folder "%s" does not exist' % DATAREPO_DIR)
-
-    OBS_OUTPUT_DIR = os.path.join(DATAREPO_DIR, 'obs_output')
-    MODEL_OUTPUT_DIR = os.path.join(DATAREPO_DIR, 'mod_output')
-    if not os.path.exists(OBS_OUTPUT_DIR):
-        os.mkdir(OBS_OUTPUT_DIR)
-    if not os.path.exists(MODEL_OUTPUT_DIR):
-        os.mkdir(MODEL_OUTPUT_DIR)
-
-    if os.path.exists(EBAS_LOCAL):
-        data_dir = EBAS_LOCAL
-    else:
-        # try use lustre...
-        data_dir = None
-
-    # clear outdated output variables
-    delete_outdated_output(OBS_OUTPUT_DIR, ALL_EBAS_VARS)
-    delete_outdated_output(MODEL_OUTPUT_DIR, ALL_EBAS_VARS)
-
-    start_yr, stop_yr = get_years_to_read(PERIODS)
-    #start_yr = '2015'; stop_yr = '2016'  #!!!!!!!!!! for testing
-    print(start_yr, stop_yr)
-
-    oreader = pya.io.ReadUngridded(EBAS_ID, data_dirs=data_dir)
-
-    for var in EBAS_VARS:
-        print('\nvar=', var)
-        if var not in ALL_EBAS_VARS:
-            raise ValueError('invalid variable ', var, '. Please register'
-                             'in variables.py')
-        # delete former output for that variable if it exists
-        clear_output(OBS_OUTPUT_DIR, var)
-        clear_output(MODEL_OUTPUT_DIR, var)
-
-        sitemeta = []
-        obs_trendtab = []
-        mod_trendtab = []
-
-        data = oreader.read(vars_to_retrieve=var)
-        data = data.apply_filters(**EBAS_BASE_FILTERS)
-        #data = data.apply_filters(station_name='Glen Dye')  #!!!!!!!! for testing
-        var_info = {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': 'day'}}
-        mdata = read_model(var, get_modelfile, start_yr, stop_yr, var_info, CALCULATE_HOW)
-
-        tst = 'monthly'
-        coldata = pya.colocation.colocate_gridded_ungridded(
-                    mdata, data, ts_type=tst, start=start_yr, stop=stop_yr,
-                    colocate_time=True, resample_how=RESAMPLE_HOW,
-                    min_num_obs=RESAMPLE_CONSTRAINTS
-                    )
-
-        # Loop over stations in colcated data
-        sitelist = list(coldata.data.station_name.values)
-        for site in tqdm.tqdm(sitelist, desc=var):
-
-            # Pick out monthly time series from observations and model at this station
-            obs_site = coldata.data.sel(station_name=site).isel(data_source=0).to_series()
-            mod_site = coldata.data.sel(station_name=site).isel(data_source=1).to_series()
-            obs_ts = obs_site.loc[start_yr:stop_yr]
-            mod_ts = mod_site.loc[start_yr:stop_yr]
-            if len(obs_ts) == 0 or np.isnan(obs_ts).all(): # skip
+# Data repositories to write and the resample constraints used for each of
+# them. They are all computed in one pass (see helper_functions.colocate_monthly),
+# so further entries, e.g. for coverage sensitivity runs with
+# dict(monthly=dict(daily=7, weekly=2), daily=dict(hourly=18)), are cheap.
+# The folders must exist in PFOLDER_DATA_REPOS.
+OUTPUT_REPOS = [('emep_trends_2021_data', STRICT_RESAMPLE_CONSTRAINTS),
+                #('emep_trends_2021_data_relaxed', RELAXED_RESAMPLE_CONSTRAINTS),
+                ]
+
+
+def process_stations(var, colarr, stat_meta, station_names, obs_out, mod_out):
+    """
+    Compute trends and write the series of a batch of stations
+
+    Parameters
+    ----------
+    var : str
+        Name of variable.
+    colarr : ColocatedArrays
+        Monthly colocated data of the batch.
+    stat_meta : pandas.DataFrame
+        Station metadata (see station_meta.get_station_meta).
+    station_names : list
+        Names of the stations to process (others in colarr are ignored).
+    obs_out, mod_out : output_store.CsvOutput or output_store.StoreOutput
+        Output writers for observations and model.
+
+    Returns
+    -------
+    sitemeta, obs_trendtab, mod_trendtab : list
+        Rows of the sitemeta and trend tables.
+    new_ids : dict
+        Station ID of each station name with output.
+    """
+    sitemeta = []
+    obs_trendtab = []
+    mod_trendtab = []
+    new_ids = {}
+
+    tst = 'monthly'
+    # Compute trends of all stations, periods and seasons at once
+    with stage('trends', var, nstations=len(colarr)):
+        obs_trends, obs_yearly = compute_trends_batch(
+            colarr.times, colarr.obs, tst, PERIODS, SEASONS)
+        mod_trends, mod_yearly = compute_trends_batch(
+            colarr.times, colarr.mod, tst, PERIODS, SEASONS)
+
+    # Loop over stations in colcated data
+    sitelist = list(colarr.station_names)
+    station_names = set(station_names)
+    # rows of the tables and series files of each station
+    with stage('write_output', var, nstations=len(station_names)):
+        for istat, site in enumerate(sitelist):
+
+            if not site in station_names:
+                continue
+            if len(colarr.times) == 0 or np.isnan(colarr.obs[istat]).all(): # skip
                 continue
 
-            # Read metadata
-            sitedata_for_meta = data.to_station_data(
-                site, var, start=int(start_yr), stop=int(stop_yr)+1,
-                resample_how=RESAMPLE_HOW,
-                min_num_obs=RESAMPLE_CONSTRAINTS
-            )
+            # Metadata of this station
+            sitedata_for_meta = stat_meta.loc[site]
             site_id = sitedata_for_meta.station_id
+            new_ids[site] = site_id
 
-            unit = sitedata_for_meta.get_unit(var)
+            unit = sitedata_for_meta.unit
             sitemeta.append([var,
                              site_id,
                              sitedata_for_meta.station_name,
@@ -152,57 +204,122 @@ if __name__ == '__main__':
                              unit,
                              tst,
                              sitedata_for_meta.framework,
-                             sitedata_for_meta.var_info[var]['matrix']
+                             sitedata_for_meta.matrix
                              ])
 
-            # Save monthly time series to files
-            obs_subdir = os.path.join(OBS_OUTPUT_DIR, f'data_{var}')
-            mod_subdir = os.path.join(MODEL_OUTPUT_DIR, f'data_{var}')
-            os.makedirs(obs_subdir, exist_ok=True)
-            os.makedirs(mod_subdir, exist_ok=True)
-
-            fname = f'data_{var}_{site_id}_{tst}.csv'
-
-            obs_siteout = os.path.join(obs_subdir, fname)
-            obs_ts.to_csv(obs_siteout)
-
-            mod_siteout = os.path.join(mod_subdir, fname)
-            mod_ts.to_csv(mod_siteout)
+            # Save monthly time series
+            obs_out.write_timeseries(site_id, tst, colarr.obs_series(istat))
+            mod_out.write_timeseries(site_id, tst, colarr.mod_series(istat))
 
-            # Calculate trends at this station
+            # Trends at this station
 
-            te = pya.trends_engine.TrendsEngine
-
-            for (start, stop, min_yrs) in PERIODS:
-                for seas in SEASONS:
-                    obs_trend = te.compute_trend(obs_ts, tst, start, stop, min_yrs,
-                                                 seas)
-
-                    obs_row = [var, site_id, obs_trend['period'], obs_trend['season'],
-                               obs_trend[f'slp_{start}'], obs_trend[f'slp_{start}_err'],
-                               obs_trend[f'reg0_{start}'], obs_trend['m'], obs_trend['m_err'],
-                               obs_trend['n'], obs_trend['pval'], unit]
+            for iper, (start, stop, min_yrs) in enumerate(PERIODS):
+                for iseas, seas in enumerate(SEASONS):
+                    obs_row = ([var, site_id, f'{start}-{stop}', seas] +
+                               trend_row(obs_trends, istat, iper, iseas) + [unit])
 
                     obs_trendtab.append(obs_row)
 
-                    mod_trend = te.compute_trend(mod_ts, tst, start, stop, min_yrs,
-                                                 seas)
-
-                    mod_row = [var, site_id, mod_trend['period'], mod_trend['season'],
-                               mod_trend[f'slp_{start}'], mod_trend[f'slp_{start}_err'],
-                               mod_trend[f'reg0_{start}'], mod_trend['m'], mod_trend['m_err'],
-                               mod_trend['n'], mod_trend['pval'], unit]
+                    mod_row = ([var, site_id, f'{start}-{stop}', seas] +
+                               trend_row(mod_trends, istat, iper, iseas) + [unit])
 
                     mod_trendtab.append(mod_row)
 
-                    fname = f'{var}_{site_id}_{start}-{stop}_{seas}_yearly.csv'
-                    try:
-                        obs_trend['data'].to_csv(os.path.join(obs_subdir, fname))
-                        mod_trend['data'].to_csv(os.path.join(mod_subdir, fname))
-                    except AttributeError:
-                        pass
-
-        # Save sitemeta and trend results
+                    # unnamed, as the yearly series of TrendsEngine.compute_trend for
+                    # monthly data (header ',0' of the yearly files)
+                    obs_yrts = yearly_series(obs_yearly, istat, start, stop, seas)
+                    mod_yrts = yearly_series(mod_yearly, istat, start, stop, seas)
+                    if obs_yrts is not None:
+                        obs_out.write_yearly(site_id, f'{start}-{stop}', seas, obs_yrts)
+                        mod_out.write_yearly(site_id, f'{start}-{stop}', seas, mod_yrts)
+
+    return sitemeta, obs_trendtab, mod_trendtab, new_ids
+
+
+class RepoOutput:
+    """
+    Output of a variable to one data repository
+
+    Holds the output writers, the rows of the sitemeta and trend tables and
+    the checkpoint of the variable in the repository.
+
+    Parameters
+    ----------
+    var : str
+        Name of variable.
+    obs_output_dir, model_output_dir : str
+        Output directories for observations and model.
+    resample_constraints : dict
+        Resample constraints used for colocation.
+    update : manifest.OutputUpdate
+        Stations to recompute. The output of the other stations is kept.
+    resume : bool
+        If True, continue from the checkpoint of an interrupted run with the
+        same input (if there is one).
+    writer : async_writer.AsyncWriter, optional
+        Background writer of the csv files.
+
+    Attributes
+    ----------
+    todo : list
+        Names of the stations that remain to be processed.
+    """
+    def __init__(self, var, obs_output_dir, model_output_dir,
+                 resample_constraints, update, resume=False, writer=None):
+        self.var = var
+        self.resample_constraints = resample_constraints
+        self.update = update
+        self.obs_out = get_output_writer(OUTPUT_FORMAT, obs_output_dir, var, writer)
+        self.mod_out = get_output_writer(OUTPUT_FORMAT, model_output_dir, var, writer)
+
+        self.ckpt = Checkpoint(get_checkpoint_file(obs_output_dir, var), update.key)
+        self.keep_ids = [update.previous[name] for name in update.kept
+                         if update.previous.get(name) is not None]
+        if resume and self.ckpt.load():
+            print(f'{var}: resume after {len(self.ckpt.done)} of {len(update.todo)} '
+                  f'stations in {obs_output_dir}')
+            self.tables = self.ckpt.state['tables']
+            self.obs_out.set_state(self.ckpt.state['obs_out'])
+            self.mod_out.set_state(self.ckpt.state['mod_out'])
+        else:
+            self.tables = ([], [], [], {})
+            if update.full:
+                # delete former output for that variable if it exists
+                clear_output(obs_output_dir, var)
+                clear_output(model_output_dir, var)
+            else:
+                print(f'{var}: recompute {len(update.todo)} stations, '
+                      f'remove {len(update.removed)} stations, '
+                      f'keep {len(update.kept)} stations in {obs_output_dir}')
+                # Keep the output of unchanged stations
+                for out in [self.obs_out, self.mod_out]:
+                    out.remove_stations(update.outdated_ids)
+                    out.keep_stations(self.keep_ids)
+        done = set(self.ckpt.done)
+        self.todo = [name for name in update.todo if not name in done]
+
+    def add(self, station_names, rows):
+        """Add output rows of processed stations and save checkpoint"""
+        sitemeta, obs_trendtab, mod_trendtab, new_ids = self.tables
+        sitemeta += rows[0]
+        obs_trendtab += rows[1]
+        mod_trendtab += rows[2]
+        new_ids.update(rows[3])
+
+        # files of the stations in the checkpoint must be on disk
+        with stage('write_output', self.var):
+            self.obs_out.flush()
+            self.mod_out.flush()
+        self.ckpt.done += station_names
+        self.ckpt.state = dict(tables=self.tables,
+                               obs_out=self.obs_out.get_state(),
+                               mod_out=self.mod_out.get_state())
+        self.ckpt.save()
+
+    def finish(self):
+        """Write sitemeta and trend tables, and the manifest"""
+        sitemeta, obs_trendtab, mod_trendtab, new_ids = self.tables
+        update = self.update
 
         metadf = pd.DataFrame(sitemeta,
                               columns=['var',
@@ -217,10 +334,6 @@ if __name__ == '__main__':
                                        'matrix'
                                        ])
 
-        metaout = os.path.join(OBS_OUTPUT_DIR, f'sitemeta_{var}.csv')
-
-        metadf.to_csv(metaout)
-
         obs_trenddf = pd.DataFrame(obs_trendtab,
                                    columns=['var',
                                             'station_id',
@@ -251,9 +364,242 @@ if __name__ == '__main__':
                                             'unit'
                                             ])
 
-        obs_trendout = os.path.join(OBS_OUTPUT_DIR, f'trends_{var}.csv')
-        obs_trenddf.to_csv(obs_trendout)
+        if not update.full:
+            site_order = update.site_order(new_ids)
+            metadf = merge_table(self.obs_out.read_table(KIND_SITEMETA), metadf,
+                                 self.keep_ids, site_order)
+            obs_trenddf = merge_table(self.obs_out.read_table(KIND_TRENDS), obs_trenddf,
+                                      self.keep_ids, site_order)
+            mod_trenddf = merge_table(self.mod_out.read_table(KIND_TRENDS), mod_trenddf,
+                                      self.keep_ids, site_order)
+
+        self.obs_out.write_sitemeta(metadf)
+        self.obs_out.write_trends(obs_trenddf)
+        self.mod_out.write_trends(mod_trenddf)
+        self.obs_out.close()
+        self.mod_out.close()
+        update.save(new_ids)
+        self.ckpt.remove()
+
+
+def process_var(var, data, mdata, start_yr, stop_yr, repos, resume=False):
+    """
+    Colocate, compute trends and write all output for one variable
+
+    The output for all data repositories (resample constraints) is computed
+    in one pass. The stations are processed in batches of
+    CHECKPOINT_STATIONS, and the progress is saved to a checkpoint file
+    after each batch.
+
+    Parameters
+    ----------
+    var : str
+        Name of variable.
+    data : pyaerocom.UngriddedData
+        Filtered EBAS observations of var.
+    mdata : pyaerocom.GriddedData
+        Model data of var.
+    start_yr, stop_yr : str
+        First and last year to colocate.
+    repos : list
+        Tuples (obs_output_dir, model_output_dir, resample_constraints,
+        update) for each data repository, see RepoOutput.
+    resume : bool
+        If True, continue from the checkpoints of an interrupted run.
+    """
+    print('\nvar=', var)
+    # csv files are written in background threads while the trends of the
+    # next stations are computed
+    with PROFILER.cprofile(var), \
+            AsyncWriter(ASYNC_WRITE_WORKERS, atomic=ASYNC_WRITE_SAFE,
+                        fsync=ASYNC_WRITE_SAFE) as writer:
+        outputs = [RepoOutput(var, *repo, resume=resume, writer=writer)
+                   for repo in repos]
+        todo = sorted(set().union(*[output.todo for output in outputs]))
+
+        for batch in tqdm.tqdm(chunks(todo, CHECKPOINT_STATIONS), desc=var):
+            batch_data = extract_stations(data, batch)
+            with stage('colocate', var, nstations=len(batch)):
+                colarrs = colocate_monthly(mdata, batch_data, start_yr, stop_yr,
+                                           [output.resample_constraints for output in outputs],
+                                           resample_how=RESAMPLE_HOW)
+
+            # Metadata of all stations in observations
+            with stage('station_meta', var, nstations=len(batch)):
+                stat_meta = get_station_meta(batch_data, var, start=int(start_yr), stop=int(stop_yr)+1)
+
+            for output, colarr in zip(outputs, colarrs):
+                todo_output = set(output.todo)
+                names = [name for name in batch if name in todo_output]
+                if not names:
+                    continue
+                if colarr is None:
+                    rows = ([], [], [], {})
+                else:
+                    rows = process_stations(var, colarr, stat_meta, names,
+                                            output.obs_out, output.mod_out)
+                output.add(names, rows)
+
+        with stage('write_output', var):
+            for output in outputs:
+                output.finish()
+    print('Processing of variable %s done.' % var)
+
+
+def var_tasks(oreader, variables, repo_dirs, config, start_yr, stop_yr, resume=False):
+    """
+    Read observations and model data and yield the arguments of process_var
+
+    The variables are handled in groups sharing model fields (see
+    group_variables). The model data of each group is read in one pass over
+    the model files, at the grid cells of the stations of the group, and
+    the tasks of the group are yielded before the next group is read. The
+    data of a variable is only referenced by its task, so it is freed once
+    the task is done. The observations are read per group, or of all
+    variables at once if OBS_READ_ONE_PASS.
+
+    Parameters
+    ----------
+    oreader : pyaerocom.io.ReadUngridded
+        Reader of the EBAS observations.
+    variables : list
+        Variables to process, in this order (within the groups).
+    repo_dirs : list
+        (obs output dir, model output dir, resample constraints) of each
+        data repository.
+    config : dict
+        Settings of the run, for the fingerprint of the output (see
+        manifest.config_fingerprint).
+    start_yr, stop_yr : str
+        First and stop year (stop_yr not included).
+    resume : bool, optional
+        Continue from the checkpoints of the variables.
+
+    Yields
+    ------
+    tuple
+        Arguments of process_var for each variable whose output is not up
+        to date
+    """
+    obsdata = {}
+    if OBS_READ_ONE_PASS:
+        obsdata = read_obs_multi(oreader, EBAS_ID, variables, EBAS_BASE_FILTERS,
+                                 cache_dir=OBS_CACHE_DIR)
+    for group in group_variables(variables, CALCULATE_HOW):
+        if not OBS_READ_ONE_PASS:
+            for var in group:
+                obsdata[var] = read_obs(oreader, EBAS_ID, var, EBAS_BASE_FILTERS,
+                                        cache_dir=OBS_CACHE_DIR)
+        #obsdata = {var: data.apply_filters(station_name='Glen Dye') for var, data in obsdata.items()}  #!!!!!!!! for testing
+
+        var_repos = {}
+        for var in group:
+            fingerprints = station_fingerprints(obsdata[var], var)
+            repos = []
+            for obs_dir, mod_dir, resample_constraints in repo_dirs:
+                update = OutputUpdate(get_manifest_file(obs_dir, var),
+                                      config_fingerprint(var=var,
+                                                         resample_constraints=resample_constraints,
+                                                         **config),
+                                      fingerprints, incremental=INCREMENTAL)
+                if update.uptodate:
+                    print(f'Output of {var} in {obs_dir} is up to date')
+                else:
+                    repos.append((obs_dir, mod_dir, resample_constraints, update))
+            if repos:
+                var_repos[var] = repos
+            else:
+                del obsdata[var]
+        todo_vars = [var for var in group if var in var_repos]
+        if not todo_vars:
+            continue
+
+        # the model is read at the grid cells of the stations of the group,
+        # the cached model data of each variable depends on its own stations
+        station_index = StationGridIndex.from_ungridded([obsdata[var] for var in todo_vars])
+        var_station_index = {var: StationGridIndex.from_ungridded(obsdata[var])
+                             for var in todo_vars}
+        var_info = {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': 'day'}
+                    for var in todo_vars}
+        moddata = read_models(todo_vars, get_modelfile, start_yr, stop_yr, var_info,
+                              CALCULATE_HOW, nworkers=MODEL_READ_WORKERS,
+                              station_index=station_index, cache_dir=MODEL_CACHE_DIR,
+                              var_station_index=var_station_index)
+        for var in todo_vars:
+            yield (var, obsdata.pop(var), moddata.pop(var), start_yr, stop_yr,
+                   var_repos.pop(var), resume)
+        del moddata
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Calculate trends of EBAS variables '
+                                                 'in observations and model')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue interrupted run from the checkpoints of the '
+                             'variables (completed variables are skipped anyway, '
+                             'see INCREMENTAL)')
+    args = parser.parse_args()
+
+    # Define output directories of all data repositories
+    repo_dirs = []
+    for repo, resample_constraints in OUTPUT_REPOS:
+        DATAREPO_DIR = os.path.join(PFOLDER_DATA_REPOS, repo)
+        if not os.path.exists(DATAREPO_DIR):
+            raise IOError('Data repository folder "%s" does not exist' % DATAREPO_DIR)
+
+        OBS_OUTPUT_DIR = os.path.join(DATAREPO_DIR, 'obs_output')
+        MODEL_OUTPUT_DIR = os.path.join(DATAREPO_DIR, 'mod_output')
+        if not os.path.exists(OBS_OUTPUT_DIR):
+            os.mkdir(OBS_OUTPUT_DIR)
+        if not os.path.exists(MODEL_OUTPUT_DIR):
+            os.mkdir(MODEL_OUTPUT_DIR)
+
+        # clear outdated output variables
+        delete_outdated_output(OBS_OUTPUT_DIR, ALL_EBAS_VARS)
+        delete_outdated_output(MODEL_OUTPUT_DIR, ALL_EBAS_VARS)
+        repo_dirs.append((OBS_OUTPUT_DIR, MODEL_OUTPUT_DIR, resample_constraints))
+
+    if PROFILE_REPORT_DIR is not None:
+        PROFILER.enable(os.path.join(PFOLDER_DATA_REPOS, OUTPUT_REPOS[0][0], PROFILE_REPORT_DIR),
+                        'calc_trends', tracemalloc_on=PROFILE_TRACEMALLOC,
+                        cprofile_vars=PROFILE_CPROFILE_VARS, variables=EBAS_VARS,
+                        output_repos=[repo for repo, _ in OUTPUT_REPOS],
+                        var_workers=VAR_WORKERS, model_read_workers=MODEL_READ_WORKERS,
+                        output_format=OUTPUT_FORMAT)
+
+    if os.path.exists(EBAS_LOCAL):
+        data_dir = EBAS_LOCAL
+    else:
+        # try use lustre...
+        data_dir = None
+
+    start_yr, stop_yr = get_years_to_read(PERIODS)
+    #start_yr = '2015'; stop_yr = '2016'  #!!!!!!!!!! for testing
+    print(start_yr, stop_yr)
+
+    oreader = pya.io.ReadUngridded(EBAS_ID, data_dirs=data_dir)
+
+    for var in EBAS_VARS:
+        if var not in ALL_EBAS_VARS:
+            raise ValueError('invalid variable ', var, '. Please register'
+                             'in variables.py')
 
-        mod_trendout = os.path.join(MODEL_OUTPUT_DIR, f'trends_{var}.csv')
-        mod_trenddf.to_csv(mod_trendout)
-        print('Processing of variable %s done.' % var)
+    # Find the stations to recompute for each variable and data repository,
+    # variables without changes are skipped (also when reading the model)
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    config = dict(start_yr=start_yr, stop_yr=stop_yr, resample_how=RESAMPLE_HOW,
+                  periods=PERIODS, seasons=SEASONS, filters=EBAS_BASE_FILTERS,
+                  model=model_file_stats(get_modelfile, start_yr, stop_yr, 'day'),
+                  code=hash_files([os.path.join(code_dir, f) for f in CODE_FILES]),
+                  versions=dict(pyaerocom=pya.__version__, numpy=np.__version__,
+                                pandas=pd.__version__, scipy=scipy.__version__),
+                  output_format=OUTPUT_FORMAT)
+
+    # Heavy variables first, so that they do not end up running alone at the end
+    variables = order_variables(EBAS_VARS, HEAVY_VARS)
+    tasks = var_tasks(oreader, variables, repo_dirs, config, start_yr, stop_yr,
+                      args.resume)
+    run_tasks(process_var, tasks, nworkers=VAR_WORKERS,
+              max_mem_gb=VAR_WORKER_MAX_MEM_GB)
+    PROFILER.write_report()
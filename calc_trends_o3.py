@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Module for processing percentiles of daily max ozone in model and observations
+Module for processing percentiles of daily max ozone in model and observations,
+and further ozone metrics (MDA8, SOMO35, AOT40, see ozone_metrics.py)
 """
 import os, tqdm
 import numpy as np
 import pandas as pd
 import pyaerocom as pya
 
-from read_mods import read_model, get_modelfile, EMEP_VAR_UNITS
+from read_mods import read_model, get_modelfile, EMEP_VAR_UNITS, StationGridIndex
+from station_meta import get_station_meta
+from hourly_grid import HourlyGrid
+from ozone_metrics import OZONE_METRICS, compute_metrics, model_hourly_grid
+from obs_cache import read_obs
 from helper_functions import (clear_output, delete_outdated_output,
-                              get_years_to_read)
+                              get_years_to_read, ColocatedArrays)
+from batch_trends import (compute_trends_batch, trend_row, yearly_series,
+                          yearly_percentiles)
+from output_store import get_output_writer
+from async_writer import AsyncWriter
+from profiling import PROFILER, stage
 from constants import PERIODS, EBAS_ID, EBAS_LOCAL
 from variables import ALL_EBAS_VARS
 
@@ -18,129 +28,134 @@ from variables import ALL_EBAS_VARS
 RESAMPLE_CONSTRAINTS = dict(yearly     =   dict(daily      = 330),
                             daily      =   dict(hourly     = 18))
 
-# daily to yearly will be added below for each percentile
+# hourly to daily is done by HourlyGrid.daily_max before the colocation
 RESAMPLE_HOW = dict(daily=dict(hourly='max'))
 
-# O3 percentiles for daily -> yearly
+# O3 percentiles for daily -> yearly (see yearly_percentiles in batch_trends.py)
 PERECENTILES = [10, 50, 75, 95, 98, 99]
 
 
-def get_rs_how(percentile):
-    """
-    Get resampling dict for ozone for a given yearly percentile of daily max
-
-    Parameters
-    ----------
-    percentile : int
-        integer percentile to be used for daily -> yearly
-
-    Returns
-    -------
-    dict
-        resample_how dictionary
-    """
-    rs_how = {**RESAMPLE_HOW}
-    rs_how['yearly'] = dict(daily=f'{percentile}percentile')
-    return rs_how
-
-
 # variable name in EBAS for original hourly ozone
 VAR_ORIG = 'vmro3'
 # variable name used in output files and in model data, for daily max ozone
 VAR_DMAX = 'vmro3max'
 
+# Ozone metrics computed from hourly observations and model in addition to
+# daily max ozone (output variables, see OZONE_METRICS in ozone_metrics.py).
+# An empty list disables reading of the hourly model data.
+OZONE_METRICS_VARS = ['vmro3mda8', 'somo35', 'aot40']
+
+# Directory for cached filtered observations (None: no cache, see README.md)
+OBS_CACHE_DIR = None
+
+# Format of output, 'csv' or 'store' (see output_store.py)
+OUTPUT_FORMAT = 'csv'
+# Number of threads writing the csv files in the background (0: write
+# directly) and whether to write them atomically and synced to disk
+ASYNC_WRITE_WORKERS = 4
+ASYNC_WRITE_SAFE = False
+
+# Folder of the data repository for the report of the stages of the run,
+# e.g. 'run_reports' (None: no report, see profiling.py and README.md),
+# tracing of memory allocations (slow)
+PROFILE_REPORT_DIR = None
+PROFILE_TRACEMALLOC = False
+
 # QC filters for EBAS data
 EBAS_BASE_FILTERS = dict(set_flags_nan   = True,
                          #data_level      = 2,
                          framework       = ['*EMEP*', '*ACTRIS*'],
                          ts_type         = 'hourly')
 
-
 # Folder where data repos are located. In this folder, there must already be located folders named
 # 'emep_trends_2021_data' and 'emep_trends_2021_data_relaxed'.
 PFOLDER_DATA_REPOS = '../'
 #PFOLDER_DATA_REPOS = '/home/eivindgw/testdata/'  # !!!!!!!!!!!!!! for testing
 
-if __name__ == '__main__':
-
-    # Define output directories
-    DATAREPO_DIR = os.path.join(PFOLDER_DATA_REPOS, 'emep_trends_2021_data')
-    if not os.path.exists(DATAREPO_DIR):
-        raise IOError('Data repository folder "%s" does not exist' % DATAREPO_DIR)
 
-    OBS_OUTPUT_DIR = os.path.join(DATAREPO_DIR, 'obs_output')
-    MODEL_OUTPUT_DIR = os.path.join(DATAREPO_DIR, 'mod_output')
-
-    if not os.path.exists(OBS_OUTPUT_DIR):
-        os.mkdir(OBS_OUTPUT_DIR)
-    if not os.path.exists(MODEL_OUTPUT_DIR):
-        os.mkdir(MODEL_OUTPUT_DIR)
-
-    if os.path.exists(EBAS_LOCAL):
-        data_dir = EBAS_LOCAL
-    else:
-        # try use lustre...
-        data_dir = None
-
-    # clear outdated output variables
-    delete_outdated_output(OBS_OUTPUT_DIR, ALL_EBAS_VARS)
-    delete_outdated_output(MODEL_OUTPUT_DIR, ALL_EBAS_VARS)
-
-    start_yr, stop_yr = get_years_to_read(PERIODS)
-    #start_yr = '2017'; stop_yr = '2018'  #!!!!!!!!!! for testing
-    print(start_yr, stop_yr)
+def get_hourly_grid(data, start_yr, stop_yr):
+    """
+    Hourly observations of VAR_ORIG of all stations on a day x hour grid,
+    for the years from start_yr to the year before stop_yr (as read_model)
+    """
+    return HourlyGrid.from_ungridded(data, VAR_ORIG, start_yr, int(stop_yr) - 1)
 
-    oreader = pya.io.ReadUngridded(EBAS_ID, data_dirs=data_dir)
 
-    if VAR_DMAX not in ALL_EBAS_VARS:
-        raise ValueError('invalid variable ', VAR_DMAX, '. Please register'
-                         'in variables.py')
-
-    # delete previous output
-    clear_output(OBS_OUTPUT_DIR, VAR_DMAX)
-    clear_output(MODEL_OUTPUT_DIR, VAR_DMAX)
+def process_o3(data, mdata, start_yr, stop_yr, obs_out, mod_out, hourly=None):
+    """
+    Colocate daily max ozone, compute trends of its yearly percentiles and
+    write all output
 
+    Parameters
+    ----------
+    data : pyaerocom.UngriddedData
+        Filtered observations of VAR_ORIG (hourly ozone).
+    mdata : pyaerocom.GriddedData
+        Model data of VAR_DMAX (daily max ozone).
+    start_yr, stop_yr : str
+        First and last year to colocate.
+    obs_out, mod_out : output_store.CsvOutput or output_store.StoreOutput
+        Output writers for observations and model (not closed here).
+    hourly : hourly_grid.HourlyGrid, optional
+        Hourly observations of VAR_ORIG (see get_hourly_grid), created from
+        data if not given.
+    """
     sitemeta = []
     obs_trendtab = []
     mod_trendtab = []
 
-    data = oreader.read(vars_to_retrieve=VAR_ORIG)
-    data = data.apply_filters(**EBAS_BASE_FILTERS)
-    # data = data.apply_filters(station_id='GB0013R')
-
-    # Read daily max ozone
-    var_info = {VAR_DMAX: {'units': EMEP_VAR_UNITS[VAR_DMAX], 'data_freq': 'day'}}
-    mdata = read_model(VAR_DMAX, get_modelfile, start_yr, stop_yr, var_info)
-
     tst = 'daily'
-    coldata = pya.colocation.colocate_gridded_ungridded(
-                mdata, data, ts_type=tst, start=start_yr, stop=stop_yr,
-                var_ref=VAR_ORIG, colocate_time=True, resample_how=RESAMPLE_HOW,
-                min_num_obs=RESAMPLE_CONSTRAINTS
-                )
+    with stage('colocate', VAR_DMAX):
+        # daily max of the hourly observations of all stations at once, so
+        # that the colocation does not need to resample them
+        if hourly is None:
+            hourly = get_hourly_grid(data, start_yr, stop_yr)
+        obs_dmax, _ = hourly.daily_max(RESAMPLE_CONSTRAINTS[tst]['hourly'])
+        daily_data = hourly.to_ungridded(obs_dmax)
+        coldata = pya.colocation.colocate_gridded_ungridded(
+                    mdata, daily_data, ts_type=tst, start=start_yr, stop=stop_yr,
+                    var_ref=VAR_ORIG, colocate_time=True, resample_how=RESAMPLE_HOW,
+                    min_num_obs=RESAMPLE_CONSTRAINTS
+                    )
+
+    # Daily time series of all stations in colocated data
+    colarr = ColocatedArrays(coldata)
+
+    # Yearly percentiles of all stations (station x year x percentile) and
+    # their trends for all stations and periods, for each percentile
+    tst_trend = 'yearly'
+    min_num = RESAMPLE_CONSTRAINTS[tst_trend][tst]
+    with stage('trends', VAR_DMAX):
+        yr_times, obs_perc = yearly_percentiles(colarr.times, colarr.obs,
+                                                PERECENTILES, min_num)
+        _, mod_perc = yearly_percentiles(colarr.times, colarr.mod,
+                                         PERECENTILES, min_num)
+        obs_trends, mod_trends = [], []
+        for ipct in range(len(PERECENTILES)):
+            obs_trends.append(compute_trends_batch(
+                yr_times, obs_perc[:, :, ipct], tst_trend, PERIODS, ['all']))
+            mod_trends.append(compute_trends_batch(
+                yr_times, mod_perc[:, :, ipct], tst_trend, PERIODS, ['all']))
+
+    # Metadata of all stations in observations
+    with stage('station_meta', VAR_DMAX):
+        stat_meta = get_station_meta(data, VAR_ORIG, start=int(start_yr), stop=int(stop_yr)+1)
 
     # Loop over stations in colocated data
-    sitelist = list(coldata.data.station_name.values)
-    for site in tqdm.tqdm(sitelist, desc=VAR_DMAX):
+    sitelist = list(colarr.station_names)
+    for istat, site in enumerate(tqdm.tqdm(sitelist, desc=VAR_DMAX)):
 
         # Pick out daily time series from observations and model at this station
-        obs_data = coldata.data.sel(station_name=site).isel(data_source=0).to_series()
-        mod_data = coldata.data.sel(station_name=site).isel(data_source=1).to_series()
-
-        obs_ts = obs_data.loc[start_yr:stop_yr]
-        mod_ts = mod_data.loc[start_yr:stop_yr]
+        obs_ts = colarr.obs_series(istat).loc[start_yr:stop_yr]
+        mod_ts = colarr.mod_series(istat).loc[start_yr:stop_yr]
         if len(obs_ts) == 0 or np.isnan(obs_ts).all():  # skip
             continue
 
-        # Read metadata
-        sitedata_for_meta = data.to_station_data(
-            site, VAR_ORIG, start=int(start_yr), stop=int(stop_yr)+1,
-            resample_how=RESAMPLE_HOW,
-            min_num_obs=RESAMPLE_CONSTRAINTS
-        )
+        # Metadata of this station
+        sitedata_for_meta = stat_meta.loc[site]
         site_id = sitedata_for_meta.station_id
 
-        unit = sitedata_for_meta.get_unit(VAR_ORIG)
+        unit = sitedata_for_meta.unit
         sitemeta.append([VAR_DMAX,
                          site_id,
                          sitedata_for_meta.station_name,
@@ -150,87 +165,43 @@ if __name__ == '__main__':
                          unit,
                          tst,
                          sitedata_for_meta.framework,
-                         sitedata_for_meta.var_info[VAR_ORIG]['matrix']
+                         sitedata_for_meta.matrix
                          ])
 
-        # Save daily time series to files
-        obs_subdir = os.path.join(OBS_OUTPUT_DIR, f'data_{VAR_DMAX}')
-        mod_subdir = os.path.join(MODEL_OUTPUT_DIR, f'data_{VAR_DMAX}')
-        os.makedirs(obs_subdir, exist_ok=True)
-        os.makedirs(mod_subdir, exist_ok=True)
-
-        fname = f'data_{VAR_DMAX}_{site_id}_{tst}.csv'
-
-        obs_siteout = os.path.join(obs_subdir, fname)
-        obs_ts.to_csv(obs_siteout)
-
-        mod_siteout = os.path.join(mod_subdir, fname)
-        mod_ts.to_csv(mod_siteout)
-
-        # Create StationData objects with the time series
-        varinfo = {VAR_DMAX: {'ts_type': tst}}
-        obs_site = pya.StationData(var_info=varinfo)
-        obs_site[VAR_DMAX] = obs_data
-        mod_site = pya.StationData(var_info=varinfo)
-        mod_site[VAR_DMAX] = mod_data
-
-        # Go through all percentiles and create trend analysis
-        tst_trend = 'yearly'
-        for percentile in PERECENTILES:
-            # Create yearly time series of this percentile
-            rs_how = get_rs_how(percentile)
-            try:
-                obs_site_trend = obs_site.resample_time(
-                    var_name=VAR_DMAX,
-                    ts_type=tst_trend,
-                    min_num_obs=RESAMPLE_CONSTRAINTS,
-                    how=rs_how, inplace=False)
-                mod_site_trend = mod_site.resample_time(
-                    var_name=VAR_DMAX,
-                    ts_type=tst_trend,
-                    min_num_obs=RESAMPLE_CONSTRAINTS,
-                    how=rs_how, inplace=False)
-            except pya.exceptions.TemporalResolutionError:
-                continue  # lower res than daily ?????????????????????
-
-            obs_ts_perc = obs_site_trend[VAR_DMAX]
-            mod_ts_perc = mod_site_trend[VAR_DMAX]
-            if len(obs_ts_perc) == 0 or np.isnan(obs_ts_perc).all():  # skip
-                continue
-
-            # Calculate trends
-            te = pya.trends_engine.TrendsEngine
+        # Save daily time series
+        obs_out.write_timeseries(site_id, tst, obs_ts)
+        mod_out.write_timeseries(site_id, tst, mod_ts)
 
-            for (start, stop, min_yrs) in PERIODS:
+        # Go through all percentiles and their trends
+        for ipct, percentile in enumerate(PERECENTILES):
+            if np.isnan(obs_perc[istat, :, ipct]).all():  # skip
+                continue
+            obs_results, obs_yearly = obs_trends[ipct]
+            mod_results, mod_yearly = mod_trends[ipct]
 
-                obs_trend = te.compute_trend(
-                    obs_ts_perc, tst_trend, start, stop, min_yrs, 'all')
+            for iper, (start, stop, min_yrs) in enumerate(PERIODS):
 
-                obs_row = [
-                    VAR_DMAX, site_id, obs_trend['period'], obs_trend['season'],
-                    obs_trend[f'slp_{start}'], obs_trend[f'slp_{start}_err'],
-                    obs_trend[f'reg0_{start}'], obs_trend['m'], obs_trend['m_err'],
-                    obs_trend['n'], obs_trend['pval'], unit, percentile]
+                obs_row = ([VAR_DMAX, site_id, f'{start}-{stop}', 'all'] +
+                           trend_row(obs_results, istat, iper, 0) + [unit, percentile])
 
                 obs_trendtab.append(obs_row)
 
-                mod_trend = te.compute_trend(
-                    mod_ts_perc, tst_trend, start, stop, min_yrs, 'all')
-
-                mod_row = [
-                    VAR_DMAX, site_id, mod_trend['period'], mod_trend['season'],
-                    mod_trend[f'slp_{start}'], mod_trend[f'slp_{start}_err'],
-                    mod_trend[f'reg0_{start}'], mod_trend['m'], mod_trend['m_err'],
-                    mod_trend['n'], mod_trend['pval'], unit, percentile]
+                mod_row = ([VAR_DMAX, site_id, f'{start}-{stop}', 'all'] +
+                           trend_row(mod_results, istat, iper, 0) + [unit, percentile])
 
                 mod_trendtab.append(mod_row)
 
-                fname = f'{VAR_DMAX}_{site_id}_{start}-{stop}_{percentile}p_yearly.csv'
-                try:
-                    obs_trend['data'].to_csv(os.path.join(obs_subdir, fname))
-                    mod_trend['data'].to_csv(os.path.join(mod_subdir, fname))
-                except AttributeError:
-                    pass
+                # yearly series are None if there is no data in the period,
+                # named as the daily series
+                obs_yrts = yearly_series(obs_yearly, istat, start, stop, 'all',
+                                         colarr.name, colarr.times.name)
+                mod_yrts = yearly_series(mod_yearly, istat, start, stop, 'all',
+                                         colarr.name, colarr.times.name)
+                if obs_yrts is not None:
+                    obs_out.write_yearly(site_id, f'{start}-{stop}', f'{percentile}p',
+                                         obs_yrts)
+                    mod_out.write_yearly(site_id, f'{start}-{stop}', f'{percentile}p',
+                                         mod_yrts)
 
     # Save sitemeta and trend results
 
@@ -248,9 +219,7 @@ if __name__ == '__main__':
                  'matrix'
                  ])
 
-    metaout = os.path.join(OBS_OUTPUT_DIR, f'sitemeta_{VAR_DMAX}.csv')
-
-    metadf.to_csv(metaout)
+    obs_out.write_sitemeta(metadf)
 
     obs_trenddf = pd.DataFrame(
         obs_trendtab,
@@ -286,9 +255,226 @@ if __name__ == '__main__':
                  'percentile'
                  ])
 
-    obs_trendout = os.path.join(OBS_OUTPUT_DIR, f'trends_{VAR_DMAX}.csv')
-    obs_trenddf.to_csv(obs_trendout)
+    obs_out.write_trends(obs_trenddf)
+    mod_out.write_trends(mod_trenddf)
+
+
+def process_metrics(data, hourly, mod_hourly, start_yr, stop_yr, outputs):
+    """
+    Compute the ozone metrics of OZONE_METRICS_VARS from hourly data of
+    observations and model, their trends and write all output
+
+    Parameters
+    ----------
+    data : pyaerocom.UngriddedData
+        Filtered observations of VAR_ORIG (hourly ozone), for the metadata.
+    hourly, mod_hourly : hourly_grid.HourlyGrid
+        Hourly observations and model at the same stations (see
+        get_hourly_grid and ozone_metrics.model_hourly_grid).
+    start_yr, stop_yr : str
+        First and last year of the data.
+    outputs : dict
+        Output writers for observations and model (tuple, not closed here)
+        of each metric.
+    """
+    metrics = list(outputs)
+    min_days = RESAMPLE_CONSTRAINTS['yearly']['daily']
+    with stage('trends', ','.join(metrics)):
+        obs_metrics = compute_metrics(hourly, metrics, PERECENTILES, min_days)
+        mod_metrics = compute_metrics(mod_hourly, metrics, PERECENTILES, min_days)
+
+    with stage('station_meta', ','.join(metrics)):
+        stat_meta = get_station_meta(data, VAR_ORIG, start=int(start_yr), stop=int(stop_yr)+1)
+
+    trend_columns = ['var', 'station_id', 'period', 'season', 'trend [%/yr]',
+                     'trend err [%/yr]', 'yoffs', 'slope', 'slope err', 'num yrs',
+                     'pval', 'unit']
+    for metric in metrics:
+        obs_out, mod_out = outputs[metric]
+        info = OZONE_METRICS[metric]
+        obs_daily, yr_times, obs_yearly = obs_metrics[metric]
+        mod_daily, _, mod_yearly = mod_metrics[metric]
+        labels = PERECENTILES if info['percentiles'] else [None]
+        tst = info['freq']
+        if tst == 'daily':
+            times, obs_values, mod_values = hourly.days, obs_daily, mod_daily
+        else:
+            times = pd.DatetimeIndex(yr_times, name='time')
+            obs_values, mod_values = obs_yearly[:, :, 0], mod_yearly[:, :, 0]
+
+        # trends of all stations and periods for each percentile
+        with stage('trends', metric):
+            obs_trends, mod_trends = [], []
+            for ipct in range(len(labels)):
+                obs_trends.append(compute_trends_batch(
+                    yr_times, obs_yearly[:, :, ipct], 'yearly', PERIODS, ['all']))
+                mod_trends.append(compute_trends_batch(
+                    yr_times, mod_yearly[:, :, ipct], 'yearly', PERIODS, ['all']))
+
+        sitemeta = []
+        obs_trendtab = []
+        mod_trendtab = []
+        for istat, site in enumerate(tqdm.tqdm(hourly.station_names, desc=metric)):
+            if np.isnan(obs_values[istat]).all():  # skip
+                continue
+
+            # Metadata of this station
+            sitedata_for_meta = stat_meta.loc[site]
+            site_id = sitedata_for_meta.station_id
+            unit = info['unit'].format(unit=sitedata_for_meta.unit)
+            sitemeta.append([metric,
+                             site_id,
+                             sitedata_for_meta.station_name,
+                             sitedata_for_meta.latitude,
+                             sitedata_for_meta.longitude,
+                             sitedata_for_meta.altitude,
+                             unit,
+                             tst,
+                             sitedata_for_meta.framework,
+                             sitedata_for_meta.matrix
+                             ])
+
+            # Save daily or yearly time series
+            obs_out.write_timeseries(site_id, tst, pd.Series(obs_values[istat], index=times,
+                                                             name=metric))
+            mod_out.write_timeseries(site_id, tst, pd.Series(mod_values[istat], index=times,
+                                                             name=metric))
+
+            for ipct, percentile in enumerate(labels):
+                if np.isnan(obs_yearly[istat, :, ipct]).all():  # skip
+                    continue
+                obs_results, obs_yrs = obs_trends[ipct]
+                mod_results, mod_yrs = mod_trends[ipct]
+                label = 'all' if percentile is None else f'{percentile}p'
+                extra = [] if percentile is None else [percentile]
+
+                for iper, (start, stop, min_yrs) in enumerate(PERIODS):
+                    obs_trendtab.append([metric, site_id, f'{start}-{stop}', 'all'] +
+                                        trend_row(obs_results, istat, iper, 0) +
+                                        [unit] + extra)
+                    mod_trendtab.append([metric, site_id, f'{start}-{stop}', 'all'] +
+                                        trend_row(mod_results, istat, iper, 0) +
+                                        [unit] + extra)
+
+                    obs_yrts = yearly_series(obs_yrs, istat, start, stop, 'all',
+                                             metric, 'time')
+                    mod_yrts = yearly_series(mod_yrs, istat, start, stop, 'all',
+                                             metric, 'time')
+                    if obs_yrts is not None:
+                        obs_out.write_yearly(site_id, f'{start}-{stop}', label, obs_yrts)
+                        mod_out.write_yearly(site_id, f'{start}-{stop}', label, mod_yrts)
+
+        # Save sitemeta and trend results
+        metadf = pd.DataFrame(
+            sitemeta,
+            columns=['var',
+                     'station_id',
+                     'station_name',
+                     'latitude',
+                     'longitude',
+                     'altitude',
+                     'unit',
+                     'freq',
+                     'framework',
+                     'matrix'
+                     ])
+        obs_out.write_sitemeta(metadf)
+
+        columns = trend_columns + (['percentile'] if info['percentiles'] else [])
+        obs_out.write_trends(pd.DataFrame(obs_trendtab, columns=columns))
+        mod_out.write_trends(pd.DataFrame(mod_trendtab, columns=columns))
+
+
+if __name__ == '__main__':
+
+    # Define output directories
+    DATAREPO_DIR = os.path.join(PFOLDER_DATA_REPOS, 'emep_trends_2021_data')
+    if not os.path.exists(DATAREPO_DIR):
+        raise IOError('Data repository folder "%s" does not exist' % DATAREPO_DIR)
+
+    OBS_OUTPUT_DIR = os.path.join(DATAREPO_DIR, 'obs_output')
+    MODEL_OUTPUT_DIR = os.path.join(DATAREPO_DIR, 'mod_output')
+
+    if not os.path.exists(OBS_OUTPUT_DIR):
+        os.mkdir(OBS_OUTPUT_DIR)
+    if not os.path.exists(MODEL_OUTPUT_DIR):
+        os.mkdir(MODEL_OUTPUT_DIR)
+
+    if PROFILE_REPORT_DIR is not None:
+        PROFILER.enable(os.path.join(DATAREPO_DIR, PROFILE_REPORT_DIR), 'calc_trends_o3',
+                        tracemalloc_on=PROFILE_TRACEMALLOC,
+                        variables=[VAR_DMAX] + OZONE_METRICS_VARS,
+                        output_format=OUTPUT_FORMAT)
 
-    mod_trendout = os.path.join(MODEL_OUTPUT_DIR, f'trends_{VAR_DMAX}.csv')
-    mod_trenddf.to_csv(mod_trendout)
+    if os.path.exists(EBAS_LOCAL):
+        data_dir = EBAS_LOCAL
+    else:
+        # try use lustre...
+        data_dir = None
+
+    # clear outdated output variables
+    delete_outdated_output(OBS_OUTPUT_DIR, ALL_EBAS_VARS)
+    delete_outdated_output(MODEL_OUTPUT_DIR, ALL_EBAS_VARS)
+
+    start_yr, stop_yr = get_years_to_read(PERIODS)
+    #start_yr = '2017'; stop_yr = '2018'  #!!!!!!!!!! for testing
+    print(start_yr, stop_yr)
+
+    oreader = pya.io.ReadUngridded(EBAS_ID, data_dirs=data_dir)
+
+    if VAR_DMAX not in ALL_EBAS_VARS:
+        raise ValueError('invalid variable ', VAR_DMAX, '. Please register'
+                         'in variables.py')
+
+    for metric in OZONE_METRICS_VARS:
+        if metric not in ALL_EBAS_VARS:
+            raise ValueError('invalid variable ', metric, '. Please register'
+                             'in variables.py')
+
+    # delete previous output
+    for var in [VAR_DMAX] + OZONE_METRICS_VARS:
+        clear_output(OBS_OUTPUT_DIR, var)
+        clear_output(MODEL_OUTPUT_DIR, var)
+
+    writer = AsyncWriter(ASYNC_WRITE_WORKERS, atomic=ASYNC_WRITE_SAFE,
+                         fsync=ASYNC_WRITE_SAFE)
+    obs_out = get_output_writer(OUTPUT_FORMAT, OBS_OUTPUT_DIR, VAR_DMAX, writer)
+    mod_out = get_output_writer(OUTPUT_FORMAT, MODEL_OUTPUT_DIR, VAR_DMAX, writer)
+
+    data = read_obs(oreader, EBAS_ID, VAR_ORIG, EBAS_BASE_FILTERS, cache_dir=OBS_CACHE_DIR)
+    # data = data.apply_filters(station_id='GB0013R')
+
+    # Hourly observations of all stations, used for daily max ozone and for
+    # all other metrics
+    hourly = get_hourly_grid(data, start_yr, stop_yr)
+
+    # Read daily max ozone
+    var_info = {VAR_DMAX: {'units': EMEP_VAR_UNITS[VAR_DMAX], 'data_freq': 'day'}}
+    station_index = StationGridIndex.from_ungridded(data)
+    mdata = read_model(VAR_DMAX, get_modelfile, start_yr, stop_yr, var_info,
+                       station_index=station_index)
+
+    process_o3(data, mdata, start_yr, stop_yr, obs_out, mod_out, hourly)
+    del mdata
+
+    # Other metrics from hourly model ozone at the stations
+    outputs = {}
+    if OZONE_METRICS_VARS:
+        mod_hourly = model_hourly_grid(hourly, get_modelfile, VAR_ORIG,
+                                       EMEP_VAR_UNITS[VAR_ORIG])
+        for metric in OZONE_METRICS_VARS:
+            outputs[metric] = (
+                get_output_writer(OUTPUT_FORMAT, OBS_OUTPUT_DIR, metric, writer),
+                get_output_writer(OUTPUT_FORMAT, MODEL_OUTPUT_DIR, metric, writer))
+        process_metrics(data, hourly, mod_hourly, start_yr, stop_yr, outputs)
+
+    # wait until all files are written
+    with stage('write_output', VAR_DMAX):
+        obs_out.close()
+        mod_out.close()
+        for metric_obs_out, metric_mod_out in outputs.values():
+            metric_obs_out.close()
+            metric_mod_out.close()
+        writer.close()
+    PROFILER.write_report()
     print('Processing of ozone done.')
@@ -9,8 +9,15 @@ import numpy as np
 import pandas as pd
 import pyaerocom as pya
 
-from read_mods import read_model, get_modelfile
-from helper_functions import clear_output, delete_outdated_output, get_years_to_read
+from batch_trends import compute_trends_batch, trend_row, yearly_series
+from read_mods import read_model, get_modelfile, StationGridIndex
+from station_meta import get_station_meta
+from obs_cache import read_obs
+from helper_functions import (clear_output, delete_outdated_output, get_years_to_read,
+                              ColocatedArrays, colocate_monthly)
+from output_store import get_output_writer
+from async_writer import AsyncWriter
+from profiling import PROFILER, stage
 from constants import PERIODS, EBAS_ID, EBAS_LOCAL, SEASONS
 from variables import ALL_EBAS_VARS
 
@@ -19,12 +26,34 @@ RESAMPLE_HOW = 'sum'
 RESAMPLE_CONSTRAINTS = dict(monthly= dict(daily=21),
                             daily=   dict(hourly=18))
 
+# If True, colocate at daily resolution and sum model and observations to
+# monthly only over the days with observations (for all stations at once).
+# Stations with observations coarser than daily (e.g. weekly) are colocated
+# as if False, i.e. monthly sums of all model days.
+COLOCATE_TIME = True
+
 EBAS_BASE_FILTERS = dict(set_flags_nan   = True,
                          #data_level      = 2
                          framework       = ['*EMEP*', '*ACTRIS*'])
 
 VAR = 'pr'
 
+# Directory for cached filtered observations (None: no cache, see README.md)
+OBS_CACHE_DIR = None
+
+# Format of output, 'csv' or 'store' (see output_store.py)
+OUTPUT_FORMAT = 'csv'
+# Number of threads writing the csv files in the background (0: write
+# directly) and whether to write them atomically and synced to disk
+ASYNC_WRITE_WORKERS = 4
+ASYNC_WRITE_SAFE = False
+
+# Folder of the data repository for the report of the stages of the run,
+# e.g. 'run_reports' (None: no report, see profiling.py and README.md),
+# tracing of memory allocations (slow)
+PROFILE_REPORT_DIR = None
+PROFILE_TRACEMALLOC = False
+
 PFOLDER_DATA_REPOS = '../'
 #PFOLDER_DATA_REPOS = '/home/eivindgw/testdata/'  # !!!!!!!!!!!!!! for testing
 
@@ -43,6 +72,11 @@ if __name__ == '__main__':
     if not os.path.exists(MODEL_OUTPUT_DIR):
         os.mkdir(MODEL_OUTPUT_DIR)
 
+    if PROFILE_REPORT_DIR is not None:
+        PROFILER.enable(os.path.join(DATAREPO_DIR, PROFILE_REPORT_DIR), 'calc_trends_pr',
+                        tracemalloc_on=PROFILE_TRACEMALLOC, variables=[VAR],
+                        output_format=OUTPUT_FORMAT, colocate_time=COLOCATE_TIME)
+
     if os.path.exists(EBAS_LOCAL):
         data_dir = EBAS_LOCAL
     else:
@@ -69,46 +103,65 @@ if __name__ == '__main__':
     sitemeta = []
     obs_trendtab = []
     mod_trendtab = []
+    writer = AsyncWriter(ASYNC_WRITE_WORKERS, atomic=ASYNC_WRITE_SAFE,
+                         fsync=ASYNC_WRITE_SAFE)
+    obs_out = get_output_writer(OUTPUT_FORMAT, OBS_OUTPUT_DIR, VAR, writer)
+    mod_out = get_output_writer(OUTPUT_FORMAT, MODEL_OUTPUT_DIR, VAR, writer)
 
     # Read observed precipitation
-    data = oreader.read(vars_to_retrieve=VAR)
-    data = data.apply_filters(**EBAS_BASE_FILTERS)
+    data = read_obs(oreader, EBAS_ID, VAR, EBAS_BASE_FILTERS, cache_dir=OBS_CACHE_DIR)
 
     # Read precipitation from daily model output
     var_info = {VAR: {'units': 'mm', 'data_freq': 'day'}}
-    mdata = read_model(VAR, get_modelfile, start_yr, stop_yr, var_info)
+    station_index = StationGridIndex.from_ungridded(data)
+    mdata = read_model(VAR, get_modelfile, start_yr, stop_yr, var_info,
+                       station_index=station_index)
 
-    # Colocate model and observations at monthly resolution
-    # (for now, do not colocated at each time before resampling)
     tst = 'monthly'
-    coldata = pya.colocation.colocate_gridded_ungridded(
-                mdata, data, ts_type=tst, start=start_yr, stop=stop_yr,
-                colocate_time=False, resample_how=RESAMPLE_HOW,
-                harmonise_units=False,
-                min_num_obs=RESAMPLE_CONSTRAINTS
-                )
+    if COLOCATE_TIME:
+        # Colocate model and observations at daily resolution, then sum
+        # both over the days with observations
+        with stage('colocate', VAR):
+            colarr = colocate_monthly(mdata, data, start_yr, stop_yr, [RESAMPLE_CONSTRAINTS],
+                                      resample_how=RESAMPLE_HOW, how='sum',
+                                      colocate_time=False, harmonise_units=False)[0]
+        if colarr is None:
+            raise pya.exceptions.VarNotAvailableError(
+                f'No observations of {VAR} from {start_yr} to {stop_yr}')
+    else:
+        # Colocate model and observations at monthly resolution
+        with stage('colocate', VAR):
+            coldata = pya.colocation.colocate_gridded_ungridded(
+                        mdata, data, ts_type=tst, start=start_yr, stop=stop_yr,
+                        colocate_time=False, resample_how=RESAMPLE_HOW,
+                        harmonise_units=False,
+                        min_num_obs=RESAMPLE_CONSTRAINTS
+                        )
+        colarr = ColocatedArrays(coldata, start_yr, stop_yr)
+
+    # invalidate model at months with no observed monthly sum
+    colarr.mod[np.isnan(colarr.obs)] = np.nan
+
+    # Compute trends of all stations, periods and seasons at once
+    with stage('trends', VAR):
+        obs_trends, obs_yearly = compute_trends_batch(
+            colarr.times, colarr.obs, tst, PERIODS, SEASONS)
+        mod_trends, mod_yearly = compute_trends_batch(
+            colarr.times, colarr.mod, tst, PERIODS, SEASONS)
+
+    # Metadata of all stations in observations
+    with stage('station_meta', VAR):
+        stat_meta = get_station_meta(data, VAR, start=int(start_yr), stop=int(stop_yr)+1)
 
     # Loop over stations in colcated data
-    sitelist = list(coldata.data.station_name.values)
-    for site in tqdm.tqdm(sitelist, desc=VAR):
-
-        # Pick out monthly precipitation time series at this station
-        obs_site = coldata.data.sel(station_name=site).isel(data_source=0).to_series()
-        mod_site = coldata.data.sel(station_name=site).isel(data_source=1).to_series()
-        # invalidate model at months with no observed monthly mean
-        noobs = np.isnan(obs_site.values)
-        mod_site = mod_site.where(~noobs, other=np.nan)
-        obs_ts = obs_site.loc[start_yr:stop_yr]
-        mod_ts = mod_site.loc[start_yr:stop_yr]
-        if len(obs_ts) == 0 or np.isnan(obs_ts).all(): # skip
+    sitelist = list(colarr.station_names)
+    for istat, site in enumerate(tqdm.tqdm(sitelist, desc=VAR)):
+
+        if len(colarr.times) == 0 or np.isnan(colarr.obs[istat]).all(): # skip
             continue
 
-        # Read metadata
-        sitedata_for_meta = data.to_station_data(
-            site, VAR, start=int(start_yr), stop=int(stop_yr)+1,
-            resample_how=RESAMPLE_HOW,
-            min_num_obs=RESAMPLE_CONSTRAINTS
-        )
+        # Metadata of this station
+        sitedata_for_meta = stat_meta.loc[site]
         site_id = sitedata_for_meta.station_id
         # set unit to mm month-1 since this is the result of the summing in the colocated data
         coldata_unit = 'mm month-1'
@@ -121,55 +174,34 @@ if __name__ == '__main__':
                          coldata_unit,
                          tst,
                          sitedata_for_meta.framework,
-                         sitedata_for_meta.var_info[VAR]['matrix']
+                         sitedata_for_meta.matrix
                          ])
 
-        # Save monthly time series to files
-        obs_subdir = os.path.join(OBS_OUTPUT_DIR, f'data_{VAR}')
-        mod_subdir = os.path.join(MODEL_OUTPUT_DIR, f'data_{VAR}')
-        os.makedirs(obs_subdir, exist_ok=True)
-        os.makedirs(mod_subdir, exist_ok=True)
-
-        fname = f'data_{VAR}_{site_id}_{tst}.csv'
+        # Save monthly time series
+        obs_out.write_timeseries(site_id, tst, colarr.obs_series(istat))
+        mod_out.write_timeseries(site_id, tst, colarr.mod_series(istat))
 
-        obs_siteout = os.path.join(obs_subdir, fname)
-        obs_ts.to_csv(obs_siteout)
+        # Trends at this station
 
-        mod_siteout = os.path.join(mod_subdir, fname)
-        mod_ts.to_csv(mod_siteout)
-
-        # Calculate trends at this station
-
-        te = pya.trends_engine.TrendsEngine
-
-        for (start, stop, min_yrs) in PERIODS:
-            for seas in SEASONS:
-                obs_trend = te.compute_trend(obs_ts, tst, start, stop, min_yrs,
-                                             seas)
-
-                obs_row = [VAR, site_id, obs_trend['period'], obs_trend['season'],
-                           obs_trend[f'slp_{start}'], obs_trend[f'slp_{start}_err'],
-                           obs_trend[f'reg0_{start}'], obs_trend['m'], obs_trend['m_err'],
-                           obs_trend['n'], obs_trend['pval'], coldata_unit]
+        for iper, (start, stop, min_yrs) in enumerate(PERIODS):
+            for iseas, seas in enumerate(SEASONS):
+                obs_row = ([VAR, site_id, f'{start}-{stop}', seas] +
+                           trend_row(obs_trends, istat, iper, iseas) + [coldata_unit])
 
                 obs_trendtab.append(obs_row)
 
-                mod_trend = te.compute_trend(mod_ts, tst, start, stop, min_yrs,
-                                             seas)
-
-                mod_row = [VAR, site_id, mod_trend['period'], mod_trend['season'],
-                           mod_trend[f'slp_{start}'], mod_trend[f'slp_{start}_err'],
-                           mod_trend[f'reg0_{start}'], mod_trend['m'], mod_trend['m_err'],
-                           mod_trend['n'], mod_trend['pval'], coldata_unit]
+                mod_row = ([VAR, site_id, f'{start}-{stop}', seas] +
+                           trend_row(mod_trends, istat, iper, iseas) + [coldata_unit])
 
                 mod_trendtab.append(mod_row)
 
-                fname = f'{VAR}_{site_id}_{start}-{stop}_{seas}_yearly.csv'
-                try:
-                    obs_trend['data'].to_csv(os.path.join(obs_subdir, fname))
-                    mod_trend['data'].to_csv(os.path.join(mod_subdir, fname))
-                except AttributeError:
-                    pass
+                # unnamed, as the yearly series of TrendsEngine.compute_trend for
+                # monthly data (header ',0' of the yearly files)
+                obs_yrts = yearly_series(obs_yearly, istat, start, stop, seas)
+                mod_yrts = yearly_series(mod_yearly, istat, start, stop, seas)
+                if obs_yrts is not None:
+                    obs_out.write_yearly(site_id, f'{start}-{stop}', seas, obs_yrts)
+                    mod_out.write_yearly(site_id, f'{start}-{stop}', seas, mod_yrts)
 
     # Save sitemeta and trend results
 
@@ -186,9 +218,7 @@ if __name__ == '__main__':
                                    'matrix'
                                    ])
 
-    metaout = os.path.join(OBS_OUTPUT_DIR, f'sitemeta_{VAR}.csv')
-
-    metadf.to_csv(metaout)
+    obs_out.write_sitemeta(metadf)
 
     obs_trenddf = pd.DataFrame(obs_trendtab,
                                columns=['var',
@@ -220,9 +250,12 @@ if __name__ == '__main__':
                                         'unit'
                                         ])
 
-    obs_trendout = os.path.join(OBS_OUTPUT_DIR, f'trends_{VAR}.csv')
-    obs_trenddf.to_csv(obs_trendout)
-
-    mod_trendout = os.path.join(MODEL_OUTPUT_DIR, f'trends_{VAR}.csv')
-    mod_trenddf.to_csv(mod_trendout)
+    obs_out.write_trends(obs_trenddf)
+    mod_out.write_trends(mod_trenddf)
+    # wait until all files are written
+    with stage('write_output', VAR):
+        obs_out.close()
+        mod_out.close()
+        writer.close()
+    PROFILER.write_report()
     print(f'Processing of precipitation ({VAR}) is done.')
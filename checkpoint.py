@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of the processing of a variable, for resuming interrupted runs
+
+The scripts process the stations of a variable in batches. After each batch
+the partial output tables (and the state of the output writers) are saved
+to checkpoint_<var>.pkl in the observation output directory, so that a run
+that is killed (e.g. by the wall-clock limit of the queue) can continue with
+the remaining stations instead of starting from the beginning.
+"""
+import os, pickle
+
+CHECKPOINT_VERSION = 1
+
+
+def get_checkpoint_file(outdir, var):
+    """Path of the checkpoint file of a variable in an output directory"""
+    return os.path.join(outdir, f'checkpoint_{var}.pkl')
+
+
+def chunks(items, size):
+    """Split list into consecutive lists of at most size items"""
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+class Checkpoint:
+    """
+    Progress of the processing of a variable
+
+    Parameters
+    ----------
+    path : str
+        Path of the checkpoint file.
+    key : str
+        Identifies the work the checkpoint belongs to (e.g. a fingerprint of
+        the input). A saved checkpoint is only loaded if its key is the same.
+
+    Attributes
+    ----------
+    done : list
+        Names of the stations that are processed.
+    state : dict
+        Partial results (picklable), set by the caller before save.
+    """
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.done = []
+        self.state = {}
+
+    def load(self):
+        """
+        Load saved checkpoint
+
+        Returns
+        -------
+        bool
+            True if a checkpoint with the same key was loaded
+        """
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'rb') as f:
+                content = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            return False
+        if content.get('version') != CHECKPOINT_VERSION or content.get('key') != self.key:
+            return False
+        self.done = content['done']
+        self.state = content['state']
+        return True
+
+    def save(self):
+        """Save checkpoint (written to a temporary file which is then renamed,
+        so an interruption never leaves a partial checkpoint behind)"""
+        content = dict(version=CHECKPOINT_VERSION, key=self.key, done=self.done,
+                       state=self.state)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(content, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        """Delete checkpoint file once all work is done"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,7 +1,7 @@
 """
 Module for calculation of derived variables from EMEP variables
 """
-from pyaerocom.io.aux_read_cubes import add_cubes
+import numpy as np
 from pyaerocom.molmasses import get_molmass
 
 # Molar masses of Nitrogen, Oxygen and Hydrogen single atoms
@@ -9,6 +9,128 @@ M_N = 14.006
 M_O = 15.999
 M_H = 1.007
 
+# Factors for conversion from ug m-3 to ug N m-3
+NH3_FAC = M_N / (M_N + 3*M_H)
+NH4_FAC = M_N / (M_N + 4*M_H)
+HNO3_FAC = M_N / (M_N + M_H + 3*M_O)
+NO3_FAC = M_N / (M_N + 3*M_O)
+
+# Fraction of coarse nitrate that is assumed to be in particles smaller than 2.5 um
+FRAC_NO3C_PM25 = 0.134
+
+# Derived variables that are linear combinations of their input variables.
+# For each variable: coefficients of the input cubes (in the order of the
+# arguments of the calc_* function), required units of the inputs and units
+# of the result
+LINEAR_COMBINATIONS = {
+    'concNtnh': {'coeffs': [NH3_FAC, NH4_FAC],
+                 'units_in': 'ug/m3', 'units': 'ug N m-3'},
+    'concNtno3': {'coeffs': [HNO3_FAC, NO3_FAC, NO3_FAC],
+                  'units_in': 'ug/m3', 'units': 'ug N m-3'},
+    'concNnh3': {'coeffs': [NH3_FAC],
+                 'units_in': 'ug/m3', 'units': 'ug N m-3'},
+    'concNnh4': {'coeffs': [NH4_FAC],
+                 'units_in': 'ug/m3', 'units': 'ug N m-3'},
+    'concNhno3': {'coeffs': [HNO3_FAC],
+                  'units_in': 'ug/m3', 'units': 'ug N m-3'},
+    'concno3pm25': {'coeffs': [1., FRAC_NO3C_PM25],
+                    'units_in': 'ug/m3', 'units': 'ug/m3'},
+    'concNno3pm25': {'coeffs': [NO3_FAC, FRAC_NO3C_PM25*NO3_FAC],
+                     'units_in': 'ug/m3', 'units': 'ug N m-3'},
+    'concNno3pm10': {'coeffs': [NO3_FAC, NO3_FAC],
+                     'units_in': 'ug/m3', 'units': 'ug N m-3'},
+}
+
+# Maximum number of array elements processed at once by linear_combination
+KERNEL_CHUNK_SIZE = 2**22
+
+
+def linear_combination(cubes, coeffs, var_name, units, chunk_size=KERNEL_CHUNK_SIZE):
+    """
+    Compute the sum of coefficient times cube for a list of cubes
+
+    The result is written into a single output array, chunk by chunk along
+    the first (time) dimension, so that no full-size temporary arrays are
+    created. The input data is not modified. If any input is masked, the
+    result is masked where any of the inputs is masked.
+
+    The coordinates and metadata of the result are copied from the first
+    cube (the cubes must have the same shape and are assumed to be on the
+    same grid).
+
+    Parameters
+    ----------
+    cubes : list
+        iris.cube.Cube objects to combine.
+    coeffs : list
+        Coefficients (float) of the cubes.
+    var_name : str
+        var_name of the returned cube.
+    units : str
+        Units of the returned cube.
+    chunk_size : int, optional
+        Approximate number of array elements processed in one chunk.
+
+    Returns
+    -------
+    iris.cube.Cube
+        Cube with the linear combination of the input cubes
+    """
+    assert len(cubes) == len(coeffs)
+    shape = cubes[0].shape
+    for cube in cubes[1:]:
+        if cube.shape != shape:
+            raise ValueError('Cannot combine cubes with shapes %s and %s'
+                             % (shape, cube.shape))
+    arrays = [cube.data for cube in cubes]
+    values = [np.ma.getdata(arr) for arr in arrays]
+    dtype = np.result_type(*values)
+    if not np.issubdtype(dtype, np.floating):
+        dtype = np.float64
+
+    out = np.empty(shape, dtype=dtype)
+    ntime = shape[0] if len(shape) > 0 else 1
+    step = max(1, chunk_size // max(1, int(np.prod(shape[1:]))))
+    tmp = None
+    for t0 in range(0, ntime, step):
+        sl = slice(t0, t0 + step)
+        out_chunk = out[sl]
+        np.multiply(values[0][sl], coeffs[0], out=out_chunk, casting='unsafe')
+        for arr, coeff in zip(values[1:], coeffs[1:]):
+            if tmp is None:
+                tmp = np.empty_like(out_chunk)
+            tmp_chunk = tmp[:len(out_chunk)]
+            np.multiply(arr[sl], coeff, out=tmp_chunk, casting='unsafe')
+            out_chunk += tmp_chunk
+
+    masks = [np.ma.getmask(arr) for arr in arrays]
+    if any(mask is not np.ma.nomask for mask in masks):
+        mask = np.zeros(shape, dtype=bool)
+        for m in masks:
+            mask |= m
+        out = np.ma.masked_array(out, mask=mask)
+
+    cube_out = cubes[0].copy(data=out)
+    if len(cubes) > 1:
+        # as in iris arithmetic with differently named cubes
+        cube_out.standard_name = None
+        cube_out.long_name = None
+    cube_out.var_name = var_name
+    cube_out.units = units
+    return cube_out
+
+
+def calc_linear(var_name, *cubes):
+    """
+    Calculate var_name from its input cubes as given in LINEAR_COMBINATIONS
+
+    The units of all input cubes are verified before the computation.
+    """
+    how = LINEAR_COMBINATIONS[var_name]
+    for cube in cubes:
+        assert cube.units == how['units_in']
+    return linear_combination(cubes, how['coeffs'], var_name, how['units'])
+
 
 def mmr_from_vmr(cube):
     """
@@ -67,14 +189,12 @@ def conc_from_vmr_STP(cube):
     assert cube.units == 'ppb'
     out_cube_name = ''.join(['conc', cube_name[3:]])
 
-    mmr_cube = mmr_from_vmr(cube)
-
     rho = standard_P / (R*standard_T)  # air density (kg/m3) in standard conditions
+    M_dry_air = get_molmass('air_dry')
+    M_variable = get_molmass(cube_name)
 
-    cube_out = rho*mmr_cube
-    cube_out.var_name = out_cube_name
-    cube_out.units = 'ug m-3'
-    return cube_out
+    # same as rho*mmr_from_vmr(cube), but without a temporary full-size cube
+    return linear_combination([cube], [rho * M_variable/M_dry_air], out_cube_name, 'ug m-3')
 
 
 def calc_concNtnh(concnh3, concnh4):
@@ -94,15 +214,7 @@ def calc_concNtnh(concnh3, concnh4):
         Total nitrate concentration in ug N m-3,
         i.e. converting NH3 and NH4 to ug N m-3 and then adding them
     """
-    assert concnh4.units == 'ug/m3'
-    assert concnh3.units == 'ug/m3'
-
-    nh3_fac = M_N / (M_N + M_H * 3)
-    nh4_fac = M_N / (M_N + M_H * 4)
-    concNtnh = add_cubes(concnh3*nh3_fac, concnh4*nh4_fac)
-    concNtnh.var_name = 'concNtnh'
-    concNtnh.units = 'ug N m-3'
-    return concNtnh
+    return calc_linear('concNtnh', concnh3, concnh4)
 
 
 def calc_concNtno3(conchno3, concno3f, concno3c):
@@ -123,17 +235,7 @@ def calc_concNtno3(conchno3, concno3f, concno3c):
     iris.cube.Cube
         Total nitrate concentration in ug N m-3
     """
-    assert conchno3.units == 'ug/m3'
-    assert concno3f.units == 'ug/m3'
-    assert concno3c.units == 'ug/m3'
-
-    hno3_fac = M_N / (M_N + M_H + M_O * 3)
-    no3_fac = M_N / (M_N + M_O * 3)
-    concno3 = add_cubes(concno3f, concno3c)
-    concNtno3 = add_cubes(conchno3*hno3_fac, concno3*no3_fac)
-    concNtno3.var_name = 'concNtno3'
-    concNtno3.units = 'ug N m-3'
-    return concNtno3
+    return calc_linear('concNtno3', conchno3, concno3f, concno3c)
 
 
 def calc_concNnh3(concnh3):
@@ -150,13 +252,7 @@ def calc_concNnh3(concnh3):
     iris.cube.Cube
         NH3 concentration in units of ug N m-3
     """
-    assert concnh3.units == 'ug/m3'
-
-    fac = M_N / (M_N + 3*M_H)
-    concNnh3 = concnh3*fac
-    concNnh3.var_name = 'concNnh3'
-    concNnh3.units = 'ug N m-3'
-    return concNnh3
+    return calc_linear('concNnh3', concnh3)
 
 
 def calc_concNnh4(concnh4):
@@ -173,13 +269,7 @@ def calc_concNnh4(concnh4):
     iris.cube.Cube
         NH4+ concentration in units of ug N m-3
     """
-    assert concnh4.units == 'ug/m3'
-
-    fac = M_N / (M_N + 4*M_H)
-    concNnh4 = concnh4*fac
-    concNnh4.var_name = 'concNnh4'
-    concNnh4.units = 'ug N m-3'
-    return concNnh4
+    return calc_linear('concNnh4', concnh4)
 
 
 def calc_concNhno3(conchno3):
@@ -196,13 +286,7 @@ def calc_concNhno3(conchno3):
     iris.cube.Cube
         HNO3 concentration in units of ug N m-3
     """
-    assert conchno3.units == 'ug/m3'
-
-    fac = M_N / (M_N + M_H + 3*M_O)
-    concNhno3 = conchno3*fac
-    concNhno3.var_name = 'concNhno3'
-    concNhno3.units = 'ug N m-3'
-    return concNhno3
+    return calc_linear('concNhno3', conchno3)
 
 
 def calc_concno3pm25(concno3f, concno3c):
@@ -224,14 +308,7 @@ def calc_concno3pm25(concno3f, concno3c):
     iris.cube.Cube
         NO3- concentration in particles smaller than 2.5 um, in ug m-3
     """
-    assert concno3f.units == 'ug/m3'
-    assert concno3c.units == 'ug/m3'
-
-    frac_no3c_pm25 = 0.134
-    concno3pm25 = add_cubes(concno3f, concno3c*frac_no3c_pm25)
-    concno3pm25.var_name = 'concno3pm25'
-    concno3pm25.units = 'ug/m3'
-    return concno3pm25
+    return calc_linear('concno3pm25', concno3f, concno3c)
 
 
 def calc_concNno3pm25(concno3f, concno3c):
@@ -241,13 +318,27 @@ def calc_concNno3pm25(concno3f, concno3c):
     See doc-string of calc_concno3pm25. The only difference is that the
     unit of the returned data is ug N m-3.
     """
-    concno3pm25 = calc_concno3pm25(concno3f, concno3c)
+    return calc_linear('concNno3pm25', concno3f, concno3c)
+
+
+def calc_concNno3pm25_from_concno3pm25(concno3pm25):
+    """
+    Convert nitrate in PM2.5 from ug/m3 to ug N m-3
+
+    Parameters
+    ----------
+    concno3pm25 : iris.cube.Cube
+        NO3- concentration in particles smaller than 2.5 um in ug/m3,
+        e.g. as returned by calc_concno3pm25
+
+    Returns
+    -------
+    iris.cube.Cube
+        NO3- concentration in particles smaller than 2.5 um in ug N m-3
+    """
+    assert concno3pm25.units == 'ug/m3'
 
-    fac = M_N / (M_N + 3*M_O)
-    concNno3pm25 = concno3pm25*fac
-    concNno3pm25.var_name = 'concNno3pm25'
-    concNno3pm25.units = 'ug N m-3'
-    return concNno3pm25
+    return linear_combination([concno3pm25], [NO3_FAC], 'concNno3pm25', 'ug N m-3')
 
 
 def calc_concNno3pm10(concno3f, concno3c):
@@ -263,15 +354,7 @@ def calc_concNno3pm10(concno3f, concno3c):
         NO3- concentration in coarse particles in ug/m3.
         All of this is assumed to be in particles smaller than 10 um
     """
-    assert concno3f.units == 'ug/m3'
-    assert concno3c.units == 'ug/m3'
-
-    fac = M_N / (M_N + 3*M_O)
-    concno3pm10 = add_cubes(concno3f, concno3c)
-    concNno3pm10 = concno3pm10*fac
-    concNno3pm10.var_name = 'concNno3pm10'
-    concNno3pm10.units = 'ug N m-3'
-    return concNno3pm10
+    return calc_linear('concNno3pm10', concno3f, concno3c)
 
 
 def fix_ecunits(concCecpm25):
@@ -5,7 +5,19 @@ Created on Wed Jun 23 10:17:17 2021
 
 @author: jonasg
 """
-import os, shutil, glob
+import os, shutil, glob, json
+import numpy as np
+import pandas as pd
+import pyaerocom as pya
+from pyaerocom.time_config import PANDAS_RESAMPLE_OFFSETS
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from profiling import PROFILER, init_worker
+from station_meta import extract_stations
+
+# offset of the time stamps of monthly colocated data in pyaerocom from the
+# start of the month (i.e. the 15th of each month)
+MONTH_OFFSET = pd.Timedelta(PANDAS_RESAMPLE_OFFSETS['MS'])
 
 
 def delete_outdated_output(outdir, varlist):
@@ -15,10 +27,19 @@ def delete_outdated_output(outdir, varlist):
         var = fname.split('_')[-1].split('.csv')[0]
         if var not in varlist:
             clear_output(outdir, var)
+    # store files of output_store.py
+    for file in glob.glob(f'{outdir}/output_*.parquet') + glob.glob(f'{outdir}/output_*.h5'):
+        var = os.path.splitext(os.path.basename(file))[0][len('output_'):]
+        if var not in varlist:
+            clear_output(outdir, var)
 
 
 def clear_output(outdir, var):
     files = glob.glob(f'{outdir}/*_{var}.csv')
+    files += glob.glob(f'{outdir}/output_{var}.parquet')
+    files += glob.glob(f'{outdir}/output_{var}.h5')
+    files += glob.glob(f'{outdir}/manifest_{var}.json')
+    files += glob.glob(f'{outdir}/checkpoint_{var}.pkl')
     if len(files) > 0:
         print(f'delete output for {var} in {outdir}')
     for file in files:
@@ -64,3 +85,414 @@ def get_years_to_read(periods):
     start_str = str(first-1)
     stop_str = str(last+1)
     return start_str, stop_str
+
+
+class ColocatedArrays:
+    """
+    Observations and model of colocated station data as NumPy matrices
+
+    The data of all stations is extracted from the colocated data at once,
+    so that the time series of a station can be accessed by its index
+    without label lookup in the xarray object.
+
+    Parameters
+    ----------
+    coldata : pyaerocom.ColocatedData
+        Colocated data with dimensions data_source, time and station_name.
+    start, stop : str, optional
+        Time range to extract (as in .loc[start:stop] of a pandas.Series).
+
+    Attributes
+    ----------
+    times : pandas.DatetimeIndex
+        Time stamps (shared by all stations).
+    obs, mod : numpy.ndarray
+        Observations and model with shape (number of stations, number of
+        times).
+    station_names, latitudes, longitudes, altitudes : numpy.ndarray
+        Station metadata of the colocated data.
+    name : str
+        Name of the colocated data (variable).
+    """
+    def __init__(self, coldata, start=None, stop=None):
+        arr = coldata.data
+        if start is not None or stop is not None:
+            arr = arr.sel(time=slice(start, stop))
+        arr = arr.transpose('data_source', 'station_name', 'time')
+        values = arr.values
+        self.obs = np.ascontiguousarray(values[0])
+        self.mod = np.ascontiguousarray(values[1])
+        self.times = pd.DatetimeIndex(arr.time.values, name='time')
+        self.station_names = arr.station_name.values
+        self.latitudes = arr.latitude.values
+        self.longitudes = arr.longitude.values
+        self.altitudes = arr.altitude.values
+        self.name = arr.name
+
+    @classmethod
+    def from_arrays(cls, times, obs, mod, station_names, latitudes, longitudes,
+                    altitudes, name):
+        """Create from arrays (as the attributes of this class)"""
+        new = cls.__new__(cls)
+        new.times = pd.DatetimeIndex(times, name='time')
+        new.obs = obs
+        new.mod = mod
+        new.station_names = np.asarray(station_names)
+        new.latitudes = np.asarray(latitudes)
+        new.longitudes = np.asarray(longitudes)
+        new.altitudes = np.asarray(altitudes)
+        new.name = name
+        return new
+
+    def __len__(self):
+        return len(self.station_names)
+
+    def select(self, mask):
+        """Subset of stations (boolean mask or indices) as new object"""
+        return ColocatedArrays.from_arrays(
+            self.times, self.obs[mask], self.mod[mask], self.station_names[mask],
+            self.latitudes[mask], self.longitudes[mask], self.altitudes[mask],
+            self.name)
+
+    def _series(self, values):
+        return pd.Series(values, index=self.times, name=self.name)
+
+    def obs_series(self, index):
+        """Observed time series of station with given index as pandas.Series"""
+        return self._series(self.obs[index])
+
+    def mod_series(self, index):
+        """Model time series of station with given index as pandas.Series"""
+        return self._series(self.mod[index])
+
+
+def fill_missing(colarr, other, mask):
+    """
+    Fill values of colocated data with the ones of other colocated data
+
+    The values of other are aligned to colarr by station name and time.
+
+    Parameters
+    ----------
+    colarr : ColocatedArrays
+        Colocated data to be filled.
+    other : ColocatedArrays
+        Colocated data of (some of) the stations of colarr.
+    mask : numpy.ndarray
+        Boolean mask with the shape of colarr.obs, True where the values are
+        to be taken from other (if other has the station and time).
+
+    Returns
+    -------
+    ColocatedArrays
+    """
+    rows = pd.Index(other.station_names).get_indexer(colarr.station_names)
+    cols = other.times.get_indexer(colarr.times)
+    mask = mask & (rows >= 0)[:, None] & (cols >= 0)[None, :]
+    obs, mod = colarr.obs.copy(), colarr.mod.copy()
+    sel = np.nonzero(mask)
+    obs[sel] = other.obs[rows[sel[0]], cols[sel[1]]]
+    mod[sel] = other.mod[rows[sel[0]], cols[sel[1]]]
+    return ColocatedArrays.from_arrays(
+        colarr.times, obs, mod, colarr.station_names, colarr.latitudes,
+        colarr.longitudes, colarr.altitudes, colarr.name)
+
+
+def coarse_stations(data, station_names):
+    """
+    Stations with observations at lower than daily resolution (e.g. weekly)
+
+    Parameters
+    ----------
+    data : pyaerocom.UngriddedData
+        Observations.
+    station_names : numpy.ndarray
+        Station names.
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean mask, True for the stations with at least one metadata block
+        with lower than daily resolution
+    """
+    daily = pya.TsType('daily')
+    names = set()
+    for meta in data.metadata.values():
+        ts_type = meta.get('ts_type')
+        if ts_type is not None and pya.TsType(ts_type) < daily:
+            names.add(meta['station_name'])
+    return np.isin(station_names, list(names))
+
+
+class MonthlyFromDaily:
+    """
+    Monthly means of daily colocated data for several coverage constraints
+
+    The sums and the numbers of valid days of each month are computed once,
+    the monthly means (or sums) for a minimum number of days (as min_num_obs
+    monthly from daily in pyaerocom) are then only a division and a mask.
+
+    Parameters
+    ----------
+    daily : ColocatedArrays
+        Daily colocated data (model is NaN where observations are NaN, as
+        in colocation with colocate_time=True).
+    """
+    def __init__(self, daily):
+        self.daily = daily
+        months = daily.times.to_period('M')
+        if len(months) == 0:
+            self.times = pd.DatetimeIndex([], name='time')
+            shape = (len(daily), 0)
+            self.obs_sum = self.mod_sum = np.zeros(shape)
+            self.obs_num = self.mod_num = np.zeros(shape, dtype=int)
+            return
+        # start index of each month (times are sorted)
+        starts = np.concatenate([[0], np.flatnonzero(months[1:] != months[:-1]) + 1])
+        # stamped as the months of colocated data in pyaerocom
+        self.times = pd.DatetimeIndex(months[starts].to_timestamp() + MONTH_OFFSET,
+                                      name='time')
+        self.obs_sum, self.obs_num = self._sum_num(daily.obs, starts)
+        self.mod_sum, self.mod_num = self._sum_num(daily.mod, starts)
+
+    @staticmethod
+    def _sum_num(values, starts):
+        valid = ~np.isnan(values)
+        total = np.add.reduceat(np.where(valid, values, 0), starts, axis=1)
+        num = np.add.reduceat(valid.astype(int), starts, axis=1)
+        return total, num
+
+    @staticmethod
+    def _mean(total, num, min_num):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / num
+        mean[num < max(min_num, 1)] = np.nan
+        return mean
+
+    @staticmethod
+    def _sum(total, num, min_num):
+        total = total.copy()
+        total[num < max(min_num, 1)] = np.nan
+        return total
+
+    def monthly(self, min_num, how='mean'):
+        """
+        Monthly means (or sums if how is 'sum') with at least min_num valid
+        days (NaN otherwise)
+
+        Returns
+        -------
+        ColocatedArrays
+        """
+        if how == 'mean':
+            func = self._mean
+        elif how == 'sum':
+            func = self._sum
+        else:
+            raise ValueError(f'invalid how {how}, choose from mean or sum')
+        daily = self.daily
+        return ColocatedArrays.from_arrays(
+            self.times, func(self.obs_sum, self.obs_num, min_num),
+            func(self.mod_sum, self.mod_num, min_num), daily.station_names,
+            daily.latitudes, daily.longitudes, daily.altitudes, daily.name)
+
+
+def colocate_monthly(mdata, data, start_yr, stop_yr, constraint_sets,
+                     resample_how='mean', how='mean', colocate_time=True,
+                     **kwargs):
+    """
+    Colocate at monthly resolution for several sets of resample constraints
+
+    Observations and model are colocated at daily resolution once (for each
+    distinct daily constraint), the model is set to NaN on the days without
+    observations, and the monthly means (or sums) for each set are computed
+    from the daily sums and numbers of valid days of each month (see
+    MonthlyFromDaily). For means, this gives the same as colocating at
+    monthly resolution with colocate_time=True for each set, including the
+    time stamps of the months. Stations with observations at lower than
+    daily resolution (e.g. weekly) cannot be colocated daily, these are also
+    colocated at monthly resolution for each set, and their months without
+    daily observations are taken from there (see fill_missing).
+
+    Parameters
+    ----------
+    mdata : pyaerocom.GriddedData
+        Model data.
+    data : pyaerocom.UngriddedData
+        Observations.
+    start_yr, stop_yr : str
+        First and last year to colocate.
+    constraint_sets : list
+        Resample constraints (min_num_obs) for each output.
+    resample_how : str, optional
+        How observations are resampled in the colocation (e.g. 'mean' or
+        'sum', see colocate_gridded_ungridded).
+    how : str, optional
+        'mean' for monthly means or 'sum' for monthly sums of the daily
+        values (see MonthlyFromDaily.monthly).
+    colocate_time : bool, optional
+        colocate_time of colocate_gridded_ungridded. Only matters for the
+        observations that are resampled to daily or monthly (the daily
+        model is used on the days with observations in any case).
+    **kwargs
+        Further arguments of colocate_gridded_ungridded (e.g.
+        harmonise_units).
+
+    Returns
+    -------
+    list
+        Monthly ColocatedArrays for each set of constraints (None if none of
+        the stations has data in the time range)
+    """
+    result = [None] * len(constraint_sets)
+    groups = {}
+    for i, constraints in enumerate(constraint_sets):
+        key = json.dumps(constraints.get('daily'), sort_keys=True)
+        groups.setdefault(key, []).append(i)
+
+    for idxs in groups.values():
+        try:
+            coldata = pya.colocation.colocate_gridded_ungridded(
+                        mdata, data, ts_type='daily', start=start_yr, stop=stop_yr,
+                        colocate_time=colocate_time, resample_how=resample_how,
+                        min_num_obs=constraint_sets[idxs[0]], **kwargs
+                        )
+        except pya.exceptions.VarNotAvailableError:
+            # no data of these stations in the time range
+            continue
+        daily = ColocatedArrays(coldata, start_yr, stop_yr)
+        # no model on days without observations
+        daily.mod[np.isnan(daily.obs)] = np.nan
+        monthly = MonthlyFromDaily(daily)
+
+        # stations with observations at lower resolution (or without daily
+        # colocated data), their months without daily observations are
+        # taken from colocation at monthly resolution
+        coarse = (coarse_stations(data, daily.station_names)
+                  | np.isnan(daily.obs).all(axis=1))
+        nodays = (monthly.obs_num == 0) & coarse[:, None]
+        for i in idxs:
+            constraints = constraint_sets[i]
+            result[i] = monthly.monthly(constraints.get('monthly', {}).get('daily', 0),
+                                        how=how)
+            if not coarse.any():
+                continue
+            try:
+                coldata = pya.colocation.colocate_gridded_ungridded(
+                            mdata, extract_stations(data, daily.station_names[coarse]),
+                            ts_type='monthly', start=start_yr, stop=stop_yr,
+                            colocate_time=colocate_time, resample_how=resample_how,
+                            min_num_obs=constraints, **kwargs
+                            )
+            except pya.exceptions.VarNotAvailableError:
+                continue
+            result[i] = fill_missing(result[i], ColocatedArrays(coldata, start_yr, stop_yr),
+                                     nodays)
+    return result
+
+
+def order_variables(variables, first):
+    """
+    Reorder variables so that the ones in first come first
+
+    The order is otherwise preserved.
+
+    Parameters
+    ----------
+    variables : list
+        Variable names.
+    first : list
+        Variable names to be moved to the start, in this order.
+
+    Returns
+    -------
+    list
+        Reordered variable names
+    """
+    head = [var for var in first if var in variables]
+    return head + [var for var in variables if var not in head]
+
+
+def _init_task_worker(max_mem_gb, profiler_state):
+    # record the stages of the worker in the profiling records of the run
+    # and limit its memory
+    init_worker(profiler_state)
+    if max_mem_gb is not None:
+        import resource
+        nbytes = int(max_mem_gb * 1024**3)
+        resource.setrlimit(resource.RLIMIT_AS, (nbytes, nbytes))
+
+
+def _pop_tasks(tasks):
+    # yield the tasks of a list and remove them from it, so that their
+    # arguments can be freed once the task is done
+    tasks.reverse()
+    while tasks:
+        yield tasks.pop()
+
+
+def run_tasks(func, tasks, nworkers=1, max_mem_gb=None):
+    """
+    Call func for each tuple of arguments in tasks, possibly in a process pool
+
+    Tasks are started in the given order and at most nworkers of them are
+    submitted at a time, so that the arguments of the remaining tasks are
+    not copied to the worker processes before they are needed. An exception
+    in a task is raised after the running tasks are finished.
+
+    Parameters
+    ----------
+    func : callable
+        Function to call (must be picklable if nworkers > 1, i.e. defined
+        at module level).
+    tasks : list or iterator
+        Tuples of arguments of func. A list is emptied while the tasks are
+        submitted, so that the arguments can be freed. An iterator (e.g. a
+        generator reading the input data) is only advanced when a task can
+        be started, so the arguments of at most nworkers + 1 tasks are in
+        memory at a time.
+    nworkers : int, optional
+        Number of worker processes. If 1 (default), the tasks are run one
+        after another in the current process.
+    max_mem_gb : float, optional
+        Maximum address space of each worker process in GB. Only used if
+        nworkers > 1. A task exceeding it fails with a MemoryError.
+
+    Returns
+    -------
+    list
+        Return values of func, in the order of the tasks
+    """
+    if isinstance(tasks, list):
+        tasks = _pop_tasks(tasks)
+    else:
+        tasks = iter(tasks)
+    if nworkers <= 1:
+        results = []
+        for task in tasks:
+            results.append(func(*task))
+            # free the arguments before the next task is read
+            del task
+        return results
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=nworkers, initializer=_init_task_worker,
+                             initargs=(max_mem_gb, PROFILER.get_state())) as executor:
+        running = {}
+        ntasks = 0
+        remaining = True
+        while remaining or running:
+            while remaining and len(running) < nworkers:
+                task = next(tasks, None)
+                if task is None:
+                    remaining = False
+                    break
+                running[executor.submit(func, *task)] = ntasks
+                del task
+                ntasks += 1
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return [results[i] for i in range(ntasks)]
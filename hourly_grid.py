@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Hourly observations of all stations on a dense day x hour grid
+
+Resampling hourly observations to daily values is done by pyaerocom for
+each station separately (UngriddedData.to_station_data and pandas resampling
+of the time series in the colocation). For hourly ozone of all stations and
+years this is the slowest part of calc_trends_o3.py. HourlyGrid puts the
+hourly data of all stations into one array of shape (number of stations,
+number of days, 24) instead, so that daily values and the number of valid
+hours per day are computed for all stations at once. The daily values can
+be converted back to UngriddedData, which is then colocated at daily
+resolution.
+
+The blocks of a station are merged as in UngriddedData.to_station_data: in
+an hour with valid data in several blocks, the value of the preferred block
+is used (see station_meta.station_blocks). Several values of the preferred
+block in the same hour (e.g. of an instrument with 30 minute resolution) are
+averaged, with a warning.
+"""
+import warnings
+import numpy as np
+import pandas as pd
+import pyaerocom as pya
+
+from station_meta import count_valid, station_blocks
+
+# Metadata of the preferred block of a station that is kept in the daily data
+DAILY_META_KEYS = ['data_id', 'dataset_name', 'station_id', 'station_name',
+                   'latitude', 'longitude', 'altitude', 'framework',
+                   'instrument_name', 'data_level', 'revision_date', 'filename']
+
+
+class HourlyGrid:
+    """
+    Hourly data of all stations of a variable on a day x hour grid
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Hourly data with shape (number of stations, number of days, 24),
+        NaN where there is no valid data.
+    days : pandas.DatetimeIndex
+        Days of the grid.
+    station_names : list
+        Station names.
+    metas : list
+        Metadata dict of the preferred block of each station.
+    var : str
+        Variable name.
+
+    Attributes
+    ----------
+    values, days, station_names, metas, var
+        As the parameters.
+    """
+    def __init__(self, values, days, station_names, metas, var):
+        self.values = values
+        self.days = pd.DatetimeIndex(days, name='time')
+        self.station_names = list(station_names)
+        self.metas = metas
+        self.var = var
+
+    @classmethod
+    def from_ungridded(cls, data, var, first_yr, last_yr):
+        """
+        Create from UngriddedData
+
+        Parameters
+        ----------
+        data : pyaerocom.UngriddedData
+            Hourly observations.
+        var : str
+            Variable name.
+        first_yr, last_yr : int or str
+            First and last year of the grid (both included). The grid needs
+            192 bytes per station and day.
+
+        Returns
+        -------
+        HourlyGrid
+        """
+        start, stop = f'{first_yr}-01-01', f'{last_yr}-12-31 23:59:59'
+        nvalid = count_valid(data, var, start, stop)
+        blocks = station_blocks(data, var, start, stop, nvalid)
+        station_names = sorted(blocks)
+        metas = [data.metadata[blocks[name][0]] for name in station_names]
+        days = np.arange(np.datetime64(start, 'D'), np.datetime64(stop, 'D') + 1)
+
+        # station index and rank (0 for the preferred block) of each block
+        block_stat = np.full(len(nvalid), -1)
+        block_rank = np.zeros(len(nvalid), dtype=int)
+        for istat, name in enumerate(station_names):
+            for rank, idx in enumerate(blocks[name]):
+                block_stat[idx] = istat
+                block_rank[idx] = rank
+
+        # valid values of the stations in the time range
+        arr = data._data
+        if var in data.var_idx:
+            mask = arr[:, data._VARINDEX] == data.var_idx[var]
+            mask &= ~np.isnan(arr[:, data._DATAINDEX])
+        else:
+            mask = np.zeros(len(arr), dtype=bool)
+        times = arr[:, data._TIMEINDEX].astype('datetime64[s]')
+        mask &= (times >= np.datetime64(start)) & (times <= np.datetime64(stop))
+        meta_idx = arr[mask, data._METADATAKEYINDEX].astype(int)
+        stat = block_stat[meta_idx]
+        rank = block_rank[meta_idx]
+        vals = arr[mask, data._DATAINDEX]
+        times = times[mask]
+        tdays = times.astype('datetime64[D]')
+        iday = (tdays - days[0]).astype(int)
+        ihour = ((times - tdays) // np.timedelta64(1, 'h')).astype(int)
+
+        # mean of the values of the preferred block in each hour of each
+        # station (sorted by hour and rank, the first value of each hour is
+        # from the preferred block)
+        flat = (stat * len(days) + iday) * 24 + ihour
+        order = np.lexsort((rank, flat))
+        flat, rank, vals = flat[order], rank[order], vals[order]
+        flat, first, inverse = np.unique(flat, return_index=True, return_inverse=True)
+        keep = rank == rank[first][inverse]
+        counts = np.bincount(inverse[keep], minlength=len(flat))
+        sums = np.bincount(inverse[keep], weights=vals[keep], minlength=len(flat))
+        nmulti = int((counts > 1).sum())
+        if nmulti:
+            warnings.warn(f'{var}: {nmulti} station hours have several values of the same '
+                          f'block, their mean is used ({int(counts.sum()) - len(flat)} '
+                          f'values more than hours)')
+        values = np.full(len(station_names) * len(days) * 24, np.nan)
+        values[flat] = sums / counts
+        values = values.reshape(len(station_names), len(days), 24)
+        return cls(values, days, station_names, metas, var)
+
+    def valid_hours(self):
+        """Number of valid hours of each station and day"""
+        return (~np.isnan(self.values)).sum(axis=2)
+
+    def daily_max(self, min_num_obs=0):
+        """
+        Daily maximum of each station (as resampling hourly to daily with
+        how='max' in pyaerocom)
+
+        Parameters
+        ----------
+        min_num_obs : int, optional
+            Minimum number of valid hours in a day, NaN otherwise.
+
+        Returns
+        -------
+        daily : numpy.ndarray
+            Daily maxima with shape (number of stations, number of days).
+        num : numpy.ndarray
+            Number of valid hours (same shape).
+        """
+        num = self.valid_hours()
+        with warnings.catch_warnings():
+            # days without data give NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            daily = np.nanmax(self.values, axis=2)
+        daily[num < min_num_obs] = np.nan
+        return daily, num
+
+    def to_ungridded(self, daily, var=None):
+        """
+        Convert daily values of all stations to UngriddedData
+
+        Only the valid days are kept. The metadata of each station is that
+        of its preferred block, with ts_type daily.
+
+        Parameters
+        ----------
+        daily : numpy.ndarray
+            Daily values with shape (number of stations, number of days),
+            e.g. output of daily_max.
+        var : str, optional
+            Variable name, defaults to the variable of the hourly data.
+
+        Returns
+        -------
+        pyaerocom.UngriddedData
+        """
+        var = self.var if var is None else var
+        stats = []
+        for istat, meta in enumerate(self.metas):
+            valid = ~np.isnan(daily[istat])
+            if not valid.any():
+                continue
+            stat = pya.StationData(**{key: meta[key] for key in DAILY_META_KEYS
+                                      if key in meta}, ts_type='daily')
+            info = dict(meta.get('var_info', {}).get(self.var, {}))
+            info['ts_type'] = 'daily'
+            stat.var_info[var] = info
+            stat[var] = pd.Series(daily[istat, valid], index=self.days[valid])
+            stats.append(stat)
+        return pya.UngriddedData.from_station_data(stats)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Manifest of the input of the output of a variable, for incremental updates
+
+The manifest file (manifest_<var>.json in the observation output directory)
+records a fingerprint of everything the output of a variable depends on:
+
+- config: a hash of the settings shared by all stations (time range,
+  resample constraints, periods, seasons, modification times of the model
+  files and the source code of the scripts).
+- stations: for each station name, a hash of the observations of the
+  station (data values and time stamps of all metadata blocks, and the
+  EBAS file names, revision dates and station metadata of the blocks).
+
+The output of a station only depends on its own observations and on the
+config, so when the config is unchanged only the stations with a changed
+fingerprint need to be recomputed (see OutputUpdate).
+"""
+import os, json, hashlib
+import numpy as np
+import pandas as pd
+
+MANIFEST_VERSION = 1
+
+# Metadata items of the blocks of a station that are part of its fingerprint
+STATION_FINGERPRINT_META = ['filename', 'revision_date', 'station_id',
+                            'station_name', 'latitude', 'longitude',
+                            'altitude', 'framework', 'data_level', 'ts_type',
+                            'var_info']
+
+
+def _sha1(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_manifest_file(outdir, var):
+    """Path of the manifest file of a variable in an output directory"""
+    return os.path.join(outdir, f'manifest_{var}.json')
+
+
+def hash_files(paths):
+    """Hash of the content of files (e.g. source code of the scripts)"""
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def model_file_stats(getfile, start_yr, stop_yr, data_freq):
+    """
+    Modification time and size of the yearly model files
+
+    Parameters
+    ----------
+    getfile : function (int, str) -> str
+        Function to get the model file of a year (see read_mods.read_model).
+    start_yr, stop_yr : str or int
+        First and stop year (stop_yr not included).
+    data_freq : str
+        Time frequency of the model files.
+
+    Returns
+    -------
+    dict
+        [mtime, size] for each year (None if the file does not exist)
+    """
+    stats = {}
+    for year in range(int(start_yr), int(stop_yr)):
+        path = getfile(year, data_freq)
+        if os.path.exists(path):
+            stats[year] = [os.path.getmtime(path), os.path.getsize(path)]
+        else:
+            stats[year] = None
+    return stats
+
+
+def config_fingerprint(**items):
+    """Hash of the settings shared by all stations (JSON serialisable items)"""
+    return _sha1(items)
+
+
+def station_fingerprints(data, var):
+    """
+    Hash of the observations of a variable for each station
+
+    Parameters
+    ----------
+    data : pyaerocom.UngriddedData
+        Filtered observations.
+    var : str
+        Variable name.
+
+    Returns
+    -------
+    dict
+        Fingerprint (hex string) for each station name
+    """
+    cols = [data._TIMEINDEX, data._DATAINDEX]
+    blocks = {}
+    for idx, meta in data.metadata.items():
+        if not var in data.meta_idx[idx]:
+            continue
+        rows = data._data[data.meta_idx[idx][var]][:, cols]
+        meta_hash = _sha1({key: meta.get(key) for key in STATION_FINGERPRINT_META})
+        data_hash = hashlib.sha1(np.ascontiguousarray(rows).tobytes()).hexdigest()
+        blocks.setdefault(meta['station_name'], []).append([meta_hash, data_hash])
+    return {name: _sha1(items) for name, items in blocks.items()}
+
+
+def merge_table(previous, df, keep_ids, site_order):
+    """
+    Merge previous rows of unchanged stations into a new output table
+
+    Parameters
+    ----------
+    previous : pandas.DataFrame or None
+        Table of the previous run (sitemeta or trends).
+    df : pandas.DataFrame
+        Table of the recomputed stations.
+    keep_ids : list
+        Station IDs whose rows are taken from previous.
+    site_order : dict
+        Rank of each station ID in the output. Rows are sorted by it, the
+        order of the rows of a station is kept.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if previous is not None and len(previous) > 0:
+        previous = previous[previous['station_id'].isin(keep_ids)].copy()
+        for col in previous.columns:
+            # integer columns are float in previous if they had missing
+            # values in the rows that are replaced
+            vals = previous[col]
+            if (len(df) > 0 and col in df and pd.api.types.is_integer_dtype(df[col])
+                    and pd.api.types.is_float_dtype(vals) and vals.notna().all()
+                    and (vals == vals.round()).all()):
+                previous[col] = vals.astype(df[col].dtype)
+        if len(df) > 0:
+            df = pd.concat([previous, df], ignore_index=True)
+        else:
+            df = previous
+    rank = df['station_id'].map(site_order).values
+    return df.iloc[np.argsort(rank, kind='stable')].reset_index(drop=True)
+
+
+class OutputUpdate:
+    """
+    Stations of a variable whose output needs to be recomputed
+
+    Parameters
+    ----------
+    path : str
+        Path of the manifest file.
+    config : str
+        Fingerprint of the settings (see config_fingerprint).
+    fingerprints : dict
+        Fingerprint of each station (see station_fingerprints).
+    incremental : bool
+        If False, all stations are recomputed.
+
+    Attributes
+    ----------
+    full : bool
+        True if all output is recomputed (no manifest, changed config or
+        not incremental). The previous output must then be deleted.
+    todo : list
+        Names of stations to recompute (sorted).
+    removed : list
+        Names of stations in the previous output that have no observations
+        anymore.
+    previous : dict
+        Station ID in the previous output of each station name (None if the
+        station had no output).
+    """
+    def __init__(self, path, config, fingerprints, incremental=True):
+        self.path = path
+        self.config = config
+        self.fingerprints = fingerprints
+        self.previous = {}
+        prev_config, prev_stations = None, {}
+        if incremental and os.path.exists(path):
+            with open(path) as f:
+                content = json.load(f)
+            if content.get('version') == MANIFEST_VERSION:
+                prev_config = content['config']
+                prev_stations = content['stations']
+
+        self.full = prev_config != config
+        if self.full:
+            self.todo = sorted(fingerprints)
+            self.removed = []
+        else:
+            self.previous = {name: item['station_id'] for name, item in prev_stations.items()}
+            self.todo = [name for name in sorted(fingerprints)
+                         if prev_stations.get(name, {}).get('fingerprint') != fingerprints[name]]
+            self.removed = [name for name in sorted(prev_stations) if not name in fingerprints]
+
+    @property
+    def uptodate(self):
+        """True if there is nothing to recompute"""
+        return not self.full and not self.todo and not self.removed
+
+    @property
+    def key(self):
+        """Fingerprint of the work to do (e.g. for checkpoints)"""
+        todo = {name: self.fingerprints[name] for name in self.todo}
+        return _sha1([self.config, self.full, todo, self.removed])
+
+    @property
+    def kept(self):
+        """Names of stations whose previous output is kept"""
+        if self.full:
+            return []
+        todo = set(self.todo)
+        return [name for name in sorted(self.fingerprints) if not name in todo]
+
+    @property
+    def outdated_ids(self):
+        """Station IDs of the previous output that are replaced or removed"""
+        names = self.todo + self.removed
+        return [self.previous[name] for name in names
+                if self.previous.get(name) is not None]
+
+    def site_order(self, new_ids):
+        """
+        Rank of each station ID in the output (sorted by station name, as
+        in the colocated data)
+
+        Parameters
+        ----------
+        new_ids : dict
+            Station ID of each recomputed station name.
+        """
+        ids = {name: self.previous.get(name) for name in self.kept}
+        ids.update(new_ids)
+        return {ids[name]: i for i, name in enumerate(sorted(ids))
+                if ids[name] is not None}
+
+    def save(self, new_ids):
+        """
+        Write the manifest after the output has been written
+
+        Parameters
+        ----------
+        new_ids : dict
+            Station ID of each recomputed station name (stations without
+            output may be missing).
+        """
+        stations = {}
+        for name, fingerprint in self.fingerprints.items():
+            if name in new_ids or name in self.todo:
+                site_id = new_ids.get(name)
+            else:
+                site_id = self.previous.get(name)
+            stations[name] = dict(fingerprint=fingerprint, station_id=site_id)
+        content = dict(version=MANIFEST_VERSION, config=self.config,
+                       stations=stations)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(content, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
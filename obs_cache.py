@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of filtered observations (UngriddedData) per variable
+
+Reading a variable from EBAS means parsing thousands of NASA Ames files.
+read_obs saves the filtered result to a cache directory and loads it from
+there in later runs. Each entry is a directory with
+
+- data.npy: the data array of the UngriddedData object (loaded
+  memory-mapped, copy-on-write, so loading is fast and only the parts that
+  are used are read from disk)
+- meta.pkl: metadata blocks and indices
+
+The name of the entry contains a hash of the variable, the filters, the
+pyaerocom version and the state of the database (data directory, revision
+and modification times of the revision file, the file index database and
+the file directory), so outdated entries are not used (they can be deleted
+by hand). The single files are not checked, which would take about as long
+as reading them on lustre: a new version of the database is detected by
+its revision or index, and added or removed files by the modification
+time of the file directory.
+"""
+import os, json, hashlib, pickle, shutil
+import numpy as np
+import pyaerocom as pya
+
+from profiling import stage
+
+OBS_CACHE_VERSION = 1
+
+
+def _file_stat(path):
+    if path is None or not os.path.exists(path):
+        return None
+    return [os.path.abspath(path), os.path.getmtime(path)]
+
+
+def source_fingerprint(oreader, data_id):
+    """
+    Fingerprint of the observation database
+
+    Only a few files and directories are checked (see module docstring),
+    so this is fast also for tens of thousands of source files.
+
+    Parameters
+    ----------
+    oreader : pyaerocom.io.ReadUngridded
+        Reader of observations.
+    data_id : str
+        ID of observation network (e.g. EBAS_ID).
+
+    Returns
+    -------
+    dict
+    """
+    reader = oreader.get_lowlevel_reader(data_id)
+    return dict(data_dir=reader.data_dir,
+                revision=reader.data_revision,
+                revision_file=_file_stat(os.path.join(reader.data_dir, reader.REVISION_FILE)),
+                file_index=_file_stat(getattr(reader, 'sqlite_database_file', None)),
+                file_dir=_file_stat(getattr(reader, 'file_dir', None)))
+
+
+def get_obs_cache_dir(cache_dir, data_id, var, filters, source):
+    """
+    Get path of the cache entry of a filtered variable
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory with the cache entries.
+    data_id : str
+        ID of observation network.
+    var : str
+        Variable name.
+    filters : dict
+        Filters applied to the data (apply_filters).
+    source : dict
+        Fingerprint of the database (see source_fingerprint).
+
+    Returns
+    -------
+    str
+        Path to the cache entry (which may not exist yet)
+    """
+    fingerprint = dict(version=OBS_CACHE_VERSION, pyaerocom=pya.__version__,
+                       data_id=data_id, var=var, filters=filters, source=source)
+    sha = hashlib.sha1(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()
+    return os.path.join(cache_dir, f'{data_id}_{var}_{sha[:16]}')
+
+
+def save_obs_cache(data, path):
+    """
+    Save UngriddedData object to cache entry
+
+    The entry is first written under a temporary name and then renamed, so
+    an interrupted run never leaves a partial entry behind.
+    """
+    tmp = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    np.save(os.path.join(tmp, 'data.npy'), data._data)
+    meta = dict(metadata=data.metadata, meta_idx=data.meta_idx,
+                var_idx=data.var_idx, data_revision=data.data_revision,
+                filter_hist=data.filter_hist, index=data._index)
+    with open(os.path.join(tmp, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # saved by another process in the meantime
+        shutil.rmtree(tmp)
+
+
+def load_obs_cache(path):
+    """Load UngriddedData object from cache entry (data memory-mapped)"""
+    with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+        meta = pickle.load(f)
+    data = pya.UngriddedData(num_points=0)
+    data._data = np.load(os.path.join(path, 'data.npy'), mmap_mode='c')
+    data._index = meta['index']
+    data.metadata = meta['metadata']
+    data.meta_idx = meta['meta_idx']
+    data.var_idx = meta['var_idx']
+    data.data_revision = meta['data_revision']
+    data.filter_hist = meta['filter_hist']
+    return data
+
+
+def read_obs(oreader, data_id, var, filters, cache_dir=None):
+    """
+    Read and filter observations of a variable, using the cache if possible
+
+    Parameters
+    ----------
+    oreader : pyaerocom.io.ReadUngridded
+        Reader of observations.
+    data_id : str
+        ID of observation network (e.g. EBAS_ID).
+    var : str
+        Variable name.
+    filters : dict
+        Filters to apply (see UngriddedData.apply_filters).
+    cache_dir : str, optional
+        Directory with the cache entries. If None, the cache is not used.
+
+    Returns
+    -------
+    pyaerocom.UngriddedData
+        Filtered observations of var
+    """
+    if cache_dir is None:
+        with stage('read_obs', var):
+            data = oreader.read(data_id, vars_to_retrieve=var)
+        with stage('filter_obs', var):
+            return data.apply_filters(**filters)
+
+    source = source_fingerprint(oreader, data_id)
+    path = get_obs_cache_dir(cache_dir, data_id, var, filters, source)
+    if os.path.exists(path):
+        print(f'Loading {var} from cache {path}')
+        with stage('read_obs', var, cached=True):
+            return load_obs_cache(path)
+
+    with stage('read_obs', var):
+        data = oreader.read(data_id, vars_to_retrieve=var)
+    with stage('filter_obs', var):
+        data = data.apply_filters(**filters)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_obs_cache(data, path)
+    return data
+
+
+def read_obs_multi(oreader, data_id, variables, filters, cache_dir=None):
+    """
+    Read and filter observations of several variables in one pass
+
+    Like read_obs, but the variables that are not in the cache are read
+    with one call of the reader, so that each source file is parsed once
+    even if it contains several of the variables. The data is filtered
+    and then split into one UngriddedData object per variable.
+
+    Parameters
+    ----------
+    oreader : pyaerocom.io.ReadUngridded
+        Reader of observations.
+    data_id : str
+        ID of observation network (e.g. EBAS_ID).
+    variables : list
+        Variable names.
+    filters : dict
+        Filters to apply (see UngriddedData.apply_filters).
+    cache_dir : str, optional
+        Directory with the cache entries. If None, the cache is not used.
+
+    Returns
+    -------
+    dict
+        Filtered observations (pyaerocom.UngriddedData) of each variable
+    """
+    result = {}
+    paths = {}
+    if cache_dir is not None:
+        source = source_fingerprint(oreader, data_id)
+        for var in variables:
+            paths[var] = get_obs_cache_dir(cache_dir, data_id, var, filters, source)
+            if os.path.exists(paths[var]):
+                print(f'Loading {var} from cache {paths[var]}')
+                with stage('read_obs', var, cached=True):
+                    result[var] = load_obs_cache(paths[var])
+
+    todo = [var for var in variables if not var in result]
+    if todo:
+        with stage('read_obs', ','.join(todo)):
+            data = oreader.read(data_id, vars_to_retrieve=todo)
+        with stage('filter_obs', ','.join(todo)):
+            data = data.apply_filters(**filters)
+        for var in todo:
+            result[var] = data.extract_var(var)
+            if cache_dir is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                save_obs_cache(result[var], paths[var])
+        del data
+    return {var: result[var] for var in variables}
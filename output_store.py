@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Output of the trend scripts for one variable and one side (obs or model)
+
+Two formats are available with the same interface:
+
+- 'csv': the layout of the emep_trends_2021_data repositories, i.e. one
+  file per station for the time series, one file per station, period and
+  season for the yearly series, and one file each for sitemeta and trends.
+- 'store': one columnar file per variable and side (Parquet if pyarrow is
+  installed, else HDF5), containing all of the above as one long table with
+  a 'kind' column. export_legacy_csv writes the 'csv' layout from it.
+"""
+import os, re, json
+import numpy as np
+import pandas as pd
+
+OUTPUT_FORMATS = ['csv', 'store']
+
+# Kinds of rows in the store
+KIND_TIMESERIES = 'timeseries'
+KIND_YEARLY = 'yearly'
+KIND_SITEMETA = 'sitemeta'
+KIND_TRENDS = 'trends'
+
+# Columns used to select rows in the store
+STORE_INDEX_COLUMNS = ['kind', 'station_id', 'freq', 'period', 'season']
+
+# Key of the metadata of the store in the Parquet or HDF5 file
+STORE_META_KEY = 'emep_trends_2021'
+
+
+def _store_engine():
+    try:
+        import pyarrow.parquet # noqa: F401
+        return 'parquet'
+    except ImportError:
+        return 'hdf5'
+
+
+def get_store_file(outdir, var, engine=None):
+    """Path of the store file of a variable in an output directory"""
+    if engine is None:
+        engine = _store_engine()
+    ext = 'parquet' if engine == 'parquet' else 'h5'
+    return os.path.join(outdir, f'output_{var}.{ext}')
+
+
+def get_output_writer(output_format, outdir, var, writer=None):
+    """
+    Get output writer for one variable in an output directory
+
+    Parameters
+    ----------
+    output_format : str
+        One of OUTPUT_FORMATS.
+    outdir : str
+        Output directory (obs_output or mod_output).
+    var : str
+        Variable name.
+    writer : async_writer.AsyncWriter, optional
+        Background writer for the csv files. If None, files are written
+        directly.
+
+    Returns
+    -------
+    CsvOutput or StoreOutput
+    """
+    if output_format == 'csv':
+        return CsvOutput(outdir, var, writer)
+    elif output_format == 'store':
+        return StoreOutput(outdir, var, writer)
+    raise ValueError(f'invalid output format {output_format}, choose from '
+                     f'{OUTPUT_FORMATS}')
+
+
+class CsvOutput:
+    """
+    Write output in the layout of the emep_trends_2021_data repositories
+
+    Parameters
+    ----------
+    outdir : str
+        Output directory (obs_output or mod_output).
+    var : str
+        Variable name.
+    writer : async_writer.AsyncWriter, optional
+        Background writer for the series files (written directly if None).
+        The series are then on disk after close.
+    """
+    def __init__(self, outdir, var, writer=None):
+        self.outdir = outdir
+        self.var = var
+        self.datadir = os.path.join(outdir, f'data_{var}')
+        self.writer = writer
+
+    def _datafile(self, fname):
+        if self.writer is None:
+            os.makedirs(self.datadir, exist_ok=True)
+        return os.path.join(self.datadir, fname)
+
+    def _to_csv(self, path, frame):
+        if self.writer is None:
+            frame.to_csv(path)
+        else:
+            self.writer.submit(path, frame)
+
+    def write_timeseries(self, site_id, freq, series):
+        """Write time series of a station (e.g. monthly means)"""
+        self._to_csv(self._datafile(f'data_{self.var}_{site_id}_{freq}.csv'), series)
+
+    def write_yearly(self, site_id, period, season, series):
+        """Write yearly series of a station used for the trend of a period
+        and season (or percentile label, such as '95p')"""
+        fname = f'{self.var}_{site_id}_{period}_{season}_yearly.csv'
+        self._to_csv(self._datafile(fname), series)
+
+    def _table_file(self, kind):
+        return os.path.join(self.outdir, f'{kind}_{self.var}.csv')
+
+    def _write_table(self, df, kind):
+        # write to temporary file first, so that an interrupted run never
+        # leaves a partial table behind
+        path = self._table_file(kind)
+        df.to_csv(f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+
+    def write_sitemeta(self, df):
+        """Write table of station metadata"""
+        self._write_table(df, KIND_SITEMETA)
+
+    def write_trends(self, df):
+        """Write table of trend results"""
+        self._write_table(df, KIND_TRENDS)
+
+    def read_table(self, kind):
+        """Read table (KIND_SITEMETA or KIND_TRENDS) of the previous output,
+        None if there is none"""
+        path = self._table_file(kind)
+        if not os.path.exists(path):
+            return None
+        return pd.read_csv(path, index_col=0, keep_default_na=False,
+                           na_values=[''], float_precision='round_trip')
+
+    def keep_stations(self, site_ids):
+        """Keep the previous series of these stations (the files stay)"""
+        pass
+
+    def remove_stations(self, site_ids):
+        """Delete the previous series of these stations"""
+        if not os.path.exists(self.datadir):
+            return
+        var = re.escape(self.var)
+        patterns = [re.compile(f'data_{var}_{re.escape(site_id)}_[^_]+\\.csv$')
+                    for site_id in site_ids]
+        patterns += [re.compile(f'{var}_{re.escape(site_id)}_[^_]+_[^_]+_yearly\\.csv$')
+                     for site_id in site_ids]
+        for fname in os.listdir(self.datadir):
+            if any(pattern.match(fname) for pattern in patterns):
+                os.remove(os.path.join(self.datadir, fname))
+
+    def flush(self):
+        """Wait until the series submitted to the writer are written"""
+        if self.writer is not None:
+            self.writer.flush()
+
+    def get_state(self):
+        """Output that is not written yet (for checkpoints, None for csv)"""
+        return None
+
+    def set_state(self, state):
+        """Restore output returned by get_state"""
+        pass
+
+    def close(self):
+        """Finish output (wait for the writer for csv)"""
+        self.flush()
+
+
+class StoreOutput(CsvOutput):
+    """
+    Collect output and write it to one columnar file when closed
+
+    Same interface as CsvOutput. The tables and series are kept in memory
+    until close is called.
+    """
+    def __init__(self, outdir, var, writer=None):
+        super().__init__(outdir, var, writer)
+        self._series = []
+        self._tables = {}
+        self._meta = {'var': var}
+        self._previous = None
+
+    def write_timeseries(self, site_id, freq, series):
+        self._meta['timeseries_name'] = series.name
+        self._meta['timeseries_index_name'] = series.index.name
+        self._series.append((KIND_TIMESERIES, site_id, freq, '', '', series))
+
+    def write_yearly(self, site_id, period, season, series):
+        self._series.append((KIND_YEARLY, site_id, 'yearly', period, season,
+                             series))
+
+    def write_sitemeta(self, df):
+        self._tables[KIND_SITEMETA] = df
+
+    def write_trends(self, df):
+        self._tables[KIND_TRENDS] = df
+
+    def _load_previous(self):
+        if self._previous is None:
+            path = get_store_file(self.outdir, self.var)
+            if os.path.exists(path):
+                self._previous = read_store(path)
+            else:
+                self._previous = (None, {})
+        return self._previous
+
+    def read_table(self, kind):
+        df, meta = self._load_previous()
+        if df is None or not f'{kind}_columns' in meta:
+            return None
+        return _legacy_table(df[df['kind'] == kind], meta[f'{kind}_columns'],
+                             meta[f'{kind}_dtypes'])
+
+    def keep_stations(self, site_ids):
+        """Copy the previous series of these stations to the new store"""
+        df, meta = self._load_previous()
+        if df is None:
+            return
+        for key in ['timeseries_name', 'timeseries_index_name']:
+            if key in meta:
+                self._meta.setdefault(key, meta[key])
+        df = df[df['station_id'].isin(site_ids)]
+        for kind, site_id, freq, period, season, series in _iter_series(df, meta):
+            self._series.append((kind, site_id, freq, period, season, series))
+
+    def remove_stations(self, site_ids):
+        """Nothing to do, previous series are only kept by keep_stations"""
+        pass
+
+    def get_state(self):
+        return dict(series=self._series, tables=self._tables, meta=self._meta)
+
+    def set_state(self, state):
+        self._series = state['series']
+        self._tables = state['tables']
+        self._meta = state['meta']
+
+    def _to_frame(self):
+        frames = []
+        if self._series:
+            lens = [len(s[-1]) for s in self._series]
+            cols = {}
+            for i, col in enumerate(STORE_INDEX_COLUMNS):
+                cols[col] = np.repeat([s[i] for s in self._series], lens)
+            cols['time'] = np.concatenate(
+                [s[-1].index.values for s in self._series]).astype('datetime64[ns]')
+            cols['value'] = np.concatenate(
+                [s[-1].values for s in self._series]).astype(float)
+            frames.append(pd.DataFrame(cols))
+        for kind, df in self._tables.items():
+            self._meta[f'{kind}_columns'] = list(df.columns)
+            self._meta[f'{kind}_dtypes'] = [str(dt) for dt in df.dtypes]
+            df = df.reset_index(drop=True).copy()
+            df.insert(0, 'kind', kind)
+            for col in STORE_INDEX_COLUMNS[1:]:
+                if not col in df:
+                    df[col] = ''
+            frames.append(df)
+        if not frames:
+            return pd.DataFrame(columns=STORE_INDEX_COLUMNS)
+        return pd.concat(frames, ignore_index=True, sort=False)
+
+    def close(self):
+        """Write all collected output to the store file"""
+        df = self._to_frame()
+        engine = _store_engine()
+        path = get_store_file(self.outdir, self.var, engine)
+        tmp = f'{path}.tmp'
+        if engine == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            meta = dict(table.schema.metadata or {})
+            meta[STORE_META_KEY.encode()] = json.dumps(self._meta).encode()
+            pq.write_table(table.replace_schema_metadata(meta), tmp)
+        else:
+            # HDF5 tables cannot hold None in string columns
+            for col in df.columns:
+                if df[col].dtype == object:
+                    df[col] = df[col].fillna('').astype(str)
+            with pd.HDFStore(tmp, mode='w') as store:
+                store.put('output', df, format='table',
+                          data_columns=STORE_INDEX_COLUMNS)
+                store.get_storer('output').attrs[STORE_META_KEY] = self._meta
+        os.replace(tmp, path)
+        self._series = []
+        self._tables = {}
+
+
+def read_store(path):
+    """
+    Read store file
+
+    Parameters
+    ----------
+    path : str
+        Path of store file (.parquet or .h5).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        All rows of the store (see STORE_INDEX_COLUMNS).
+    meta : dict
+        Metadata of the store (variable, column names of the tables).
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+        meta = json.loads(table.schema.metadata[STORE_META_KEY.encode()])
+        return table.to_pandas(), meta
+    with pd.HDFStore(path, mode='r') as store:
+        df = store.get('output')
+        meta = store.get_storer('output').attrs[STORE_META_KEY]
+    return df, meta
+
+
+def _legacy_table(df, columns, dtypes):
+    # Rebuild the table from rows with None for missing values, as in the
+    # scripts, so that the dtypes and thus the csv files are the same
+    isint = [dtype.startswith('int') for dtype in dtypes]
+    rows = []
+    for row in df[columns].itertuples(index=False):
+        vals = []
+        for val, toint in zip(row, isint):
+            if val is None or (isinstance(val, str) and val == ''):
+                val = None
+            elif isinstance(val, (float, np.floating)):
+                if np.isnan(val):
+                    val = None
+                elif toint:
+                    val = int(val)
+            vals.append(val)
+        rows.append(vals)
+    return pd.DataFrame(rows, columns=columns)
+
+
+def _iter_series(df, meta):
+    # series of the store as (kind, site_id, freq, period, season, series)
+    for kind in [KIND_TIMESERIES, KIND_YEARLY]:
+        rows = df[df['kind'] == kind]
+        for key, group in rows.groupby(STORE_INDEX_COLUMNS[1:], sort=False):
+            if kind == KIND_TIMESERIES:
+                index = pd.DatetimeIndex(group['time'].values,
+                                         name=meta.get('timeseries_index_name'))
+                series = pd.Series(group['value'].values, index=index,
+                                   name=meta.get('timeseries_name'))
+            else:
+                series = pd.Series(group['value'].values,
+                                   index=pd.DatetimeIndex(group['time'].values))
+            yield (kind, *key, series)
+
+
+def export_legacy_csv(path, outdir):
+    """
+    Write the content of a store file in the 'csv' layout
+
+    Parameters
+    ----------
+    path : str
+        Path of store file.
+    outdir : str
+        Output directory (obs_output or mod_output of a data repository).
+    """
+    df, meta = read_store(path)
+    out = CsvOutput(outdir, meta['var'])
+    for kind, site_id, freq, period, season, series in _iter_series(df, meta):
+        if kind == KIND_TIMESERIES:
+            out.write_timeseries(site_id, freq, series)
+        else:
+            out.write_yearly(site_id, period, season, series)
+    for kind, write in [(KIND_SITEMETA, out.write_sitemeta),
+                        (KIND_TRENDS, out.write_trends)]:
+        if f'{kind}_columns' in meta:
+            write(_legacy_table(df[df['kind'] == kind], meta[f'{kind}_columns'],
+                                meta[f'{kind}_dtypes']))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Write store files in the layout of the emep_trends_2021_data '
+                    'repositories')
+    parser.add_argument('files', nargs='+', help='store files (output_<var>.parquet or .h5)')
+    parser.add_argument('--outdir', default=None,
+                        help='output directory (default: directory of each file)')
+    args = parser.parse_args()
+    for path in args.files:
+        outdir = args.outdir or os.path.dirname(os.path.abspath(path))
+        export_legacy_csv(path, outdir)
+        print(f'exported {path} to {outdir}')
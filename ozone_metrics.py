@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ozone metrics of hourly observations and model for all stations at once
+
+Besides the yearly percentiles of daily max ozone (VAR_DMAX in
+calc_trends_o3.py), the following yearly metrics are computed from the
+hourly ozone (VAR_ORIG) of all stations on a day x hour grid (see
+hourly_grid.py):
+
+- vmro3mda8: yearly percentiles of the daily maximum 8-hour mean (MDA8),
+- somo35: sum of MDA8 above 35 ppb over the year (ppb days),
+- aot40: sum of hourly values above 40 ppb from May to July, 8-20 CET
+  (ppb hours).
+
+The definitions follow the EU air quality directive 2008/50/EC and the
+EMEP reports. The thresholds are in ppb, i.e. the data must be in ppb or
+nmol mol-1. The hourly model data is read year by year at the stations
+(model_hourly_grid) and set to NaN where the observations are missing, so
+that the same coverage rules apply to observations and model.
+"""
+import os, warnings
+import numpy as np
+
+from batch_trends import yearly_percentiles, year_dates
+from hourly_grid import HourlyGrid
+from read_mods import read_model, StationGridIndex
+
+# MDA8: 8-hour running means (assigned to the day in which they end) with
+# at least 6 valid hours, and at least 18 valid means in a day
+MDA8_WINDOW = 8
+MDA8_MIN_HOURS = 6
+MDA8_MIN_MEANS = 18
+
+# SOMO35: threshold in ppb. The sum is scaled by the number of days of the
+# year over the number of valid days.
+SOMO35_THRESHOLD = 35.
+
+# AOT40: threshold in ppb, months and hours (UTC, i.e. 8-20 CET) included.
+# The sum is scaled by the number of possible over the number of valid
+# hours, which must be at least AOT40_MIN_COVERAGE of the possible hours.
+AOT40_THRESHOLD = 40.
+AOT40_MONTHS = [5, 6, 7]
+AOT40_HOURS = list(range(7, 19))
+AOT40_MIN_COVERAGE = 0.9
+
+# Time stamps of the hourly model output. Depending on the model version and
+# output settings, the value of an hour is stamped at the start (first stamp
+# of a year at 00:00 on 1 January), the middle (at 00:30) or the end of the
+# hour (first stamp at 01:00, last one at 00:00 on 1 January of the next
+# year). model_hourly_grid detects the convention of each file and assigns
+# each value to the hour in which it starts, as the observations (EBAS data
+# is stamped with the start time of each sample), so that midnight and the
+# hours of MDA8 and AOT40 (AOT40_HOURS) match. A value stamped at the end of
+# the hour is moved back by MODEL_HOUR_END_SHIFT.
+MODEL_HOUR_END_SHIFT = np.timedelta64(1, 'h')
+
+# Metrics that can be computed: unit (from the unit of the hourly data),
+# frequency of the time series written per station and whether the yearly
+# values are percentiles of the daily values
+OZONE_METRICS = {
+    'vmro3mda8': dict(unit='{unit}', freq='daily', percentiles=True),
+    'somo35': dict(unit='{unit} d', freq='yearly', percentiles=False),
+    'aot40': dict(unit='{unit} h', freq='yearly', percentiles=False)
+}
+
+
+def _year_starts(days):
+    # years of the days and index of the first day of each year (days are
+    # sorted)
+    years = days.year.values
+    starts = np.concatenate([[0], np.flatnonzero(years[1:] != years[:-1]) + 1])
+    return years[starts], starts
+
+
+def mda8(values, window=MDA8_WINDOW, min_hours=MDA8_MIN_HOURS,
+         min_means=MDA8_MIN_MEANS):
+    """
+    Daily maximum 8-hour mean
+
+    The running mean ending at hour h of a day covers the hours h-7 to h
+    (i.e. the first mean of a day starts at 17 on the previous day).
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Hourly data with shape (number of stations, number of days, 24).
+
+    Returns
+    -------
+    numpy.ndarray
+        MDA8 with shape (number of stations, number of days)
+    """
+    nstat, ndays, nhours = values.shape
+    flat = values.reshape(nstat, ndays * nhours)
+    padded = np.concatenate([np.full((nstat, window - 1), np.nan), flat], axis=1)
+    total = np.zeros(flat.shape)
+    num = np.zeros(flat.shape, dtype=int)
+    for k in range(window):
+        part = padded[:, k:k + flat.shape[1]]
+        valid = ~np.isnan(part)
+        total += np.where(valid, part, 0)
+        num += valid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = total / num
+    means[num < min_hours] = np.nan
+    means = means.reshape(nstat, ndays, nhours)
+    nmeans = (~np.isnan(means)).sum(axis=2)
+    with warnings.catch_warnings():
+        # days without valid means give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        daily = np.nanmax(means, axis=2)
+    daily[nmeans < min_means] = np.nan
+    return daily
+
+
+def somo35(days, daily_mda8, min_days, threshold=SOMO35_THRESHOLD):
+    """
+    Yearly SOMO35 from MDA8
+
+    Parameters
+    ----------
+    days : pandas.DatetimeIndex
+        Days of the data (complete years).
+    daily_mda8 : numpy.ndarray
+        MDA8 with shape (number of stations, number of days).
+    min_days : int
+        Minimum number of valid days in a year, NaN otherwise.
+
+    Returns
+    -------
+    dates : numpy.ndarray
+        Time stamps of the years (see batch_trends.year_dates).
+    result : numpy.ndarray
+        SOMO35 with shape (number of stations, number of years).
+    """
+    years, starts = _year_starts(days)
+    valid = ~np.isnan(daily_mda8)
+    excess = np.where(valid, np.maximum(daily_mda8 - threshold, 0), 0)
+    total = np.add.reduceat(excess, starts, axis=1)
+    num = np.add.reduceat(valid.astype(int), starts, axis=1)
+    ndays = np.diff(np.append(starts, len(days)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = total * ndays / num
+    result[num < max(min_days, 1)] = np.nan
+    return year_dates(years), result
+
+
+def aot40(days, values, threshold=AOT40_THRESHOLD, months=AOT40_MONTHS,
+          hours=AOT40_HOURS, min_coverage=AOT40_MIN_COVERAGE):
+    """
+    Yearly AOT40 from hourly data
+
+    Parameters
+    ----------
+    days : pandas.DatetimeIndex
+        Days of the data (complete years).
+    values : numpy.ndarray
+        Hourly data with shape (number of stations, number of days, 24).
+
+    Returns
+    -------
+    dates : numpy.ndarray
+        Time stamps of the years (see batch_trends.year_dates).
+    result : numpy.ndarray
+        AOT40 with shape (number of stations, number of years).
+    """
+    years, _ = _year_starts(days)
+    insel = np.isin(days.month, months)
+    sel = values[:, insel][:, :, hours]
+    valid = ~np.isnan(sel)
+    excess = np.where(valid, np.maximum(sel - threshold, 0), 0).sum(axis=2)
+    nvalid = valid.sum(axis=2)
+    # index of the year of each selected day
+    iyear = np.searchsorted(years, days.year.values[insel])
+    shape = (values.shape[0], len(years))
+    total, num = np.zeros(shape), np.zeros(shape, dtype=int)
+    for iyr in range(len(years)):
+        total[:, iyr] = excess[:, iyear == iyr].sum(axis=1)
+        num[:, iyr] = nvalid[:, iyear == iyr].sum(axis=1)
+    possible = np.bincount(iyear, minlength=len(years)) * len(hours)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = total * possible / num
+    result[(num == 0) | (num < min_coverage * possible)] = np.nan
+    return year_dates(years), result
+
+
+def compute_metrics(grid, metrics, percentiles, min_days):
+    """
+    Compute ozone metrics of all stations from hourly data
+
+    Parameters
+    ----------
+    grid : hourly_grid.HourlyGrid
+        Hourly ozone (complete years).
+    metrics : list
+        Names of metrics (keys of OZONE_METRICS).
+    percentiles : list
+        Percentiles of the daily values of the percentile metrics.
+    min_days : int
+        Minimum number of valid days in a year for the yearly percentiles
+        and SOMO35.
+
+    Returns
+    -------
+    dict
+        For each metric, a tuple (daily, dates, yearly): daily values of
+        shape (number of stations, number of days) or None, time stamps of
+        the years, and yearly values of shape (number of stations, number
+        of years, number of percentiles), where the last dimension has size
+        1 for metrics that are not percentiles.
+    """
+    for metric in metrics:
+        if not metric in OZONE_METRICS:
+            raise ValueError(f'invalid ozone metric {metric}, choose from '
+                             f'{list(OZONE_METRICS)}')
+    result = {}
+    daily_mda8 = None
+    if 'vmro3mda8' in metrics or 'somo35' in metrics:
+        daily_mda8 = mda8(grid.values)
+    if 'vmro3mda8' in metrics:
+        dates, yearly = yearly_percentiles(grid.days, daily_mda8, percentiles,
+                                           min_days)
+        result['vmro3mda8'] = (daily_mda8, dates, yearly)
+    if 'somo35' in metrics:
+        dates, yearly = somo35(grid.days, daily_mda8, min_days)
+        result['somo35'] = (None, dates, yearly[:, :, np.newaxis])
+    if 'aot40' in metrics:
+        dates, yearly = aot40(grid.days, grid.values)
+        result['aot40'] = (None, dates, yearly[:, :, np.newaxis])
+    return result
+
+
+def model_hour_starts(times, year):
+    """
+    Start of the hour of each time stamp of one year of hourly model data
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        datetime64 time stamps of the file of year (sorted).
+    year : int
+        Year of the file.
+
+    Returns
+    -------
+    numpy.ndarray
+        datetime64[s] start of the hour of each value
+
+    Raises
+    ------
+    ValueError
+        If the convention of the time stamps cannot be detected (see
+        MODEL_HOUR_END_SHIFT).
+    """
+    times = np.asarray(times).astype('datetime64[s]')
+    new_year = np.datetime64(f'{year}-01-01T00:00:00')
+    next_year = np.datetime64(f'{year + 1}-01-01T00:00:00')
+    offsets = (times - times.astype('datetime64[h]')).astype(int)
+    if (offsets == 1800).all():
+        # middle of the hour
+        return times.astype('datetime64[h]').astype('datetime64[s]')
+    if (offsets == 0).all():
+        if times[0] == new_year + np.timedelta64(1, 'h') or times[-1] == next_year:
+            return times - MODEL_HOUR_END_SHIFT
+        if times[0] == new_year:
+            return times
+    raise ValueError(f'Cannot tell whether the hourly model data of {year} is '
+                     f'stamped at the start or the end of the hour (first and '
+                     f'last time stamp {times[0]}, {times[-1]})')
+
+
+def model_hourly_grid(obs, getfile, var, units):
+    """
+    Hourly model data at the stations of hourly observations
+
+    The model files are read one year at a time, only in the grid cells of
+    the stations (see read_mods.StationGridIndex), and the nearest grid cell
+    of each station is used (as in the colocation). Each value is assigned
+    to the hour in which it starts (see MODEL_HOUR_END_SHIFT). The model is
+    NaN where the observations are NaN. Years without a model file are NaN,
+    with a warning.
+
+    Parameters
+    ----------
+    obs : hourly_grid.HourlyGrid
+        Hourly observations.
+    getfile : function (int, str) -> str
+        Function to get the model file of a year and data_freq (see
+        read_mods.get_modelfile).
+    var : str
+        Model variable name (as in pyaerocom).
+    units : str
+        Units of the model variable (see read_mods.EMEP_VAR_UNITS).
+
+    Returns
+    -------
+    hourly_grid.HourlyGrid
+    """
+    lats = np.array([meta['latitude'] for meta in obs.metas], dtype=float)
+    lons = np.array([meta['longitude'] for meta in obs.metas], dtype=float)
+    # only the rows and columns of the station cells (the nearest cell of
+    # each station is in this subgrid, and the hourly fields are large)
+    station_index = StationGridIndex(lats, lons, nneighbours=0)
+    var_info = {var: {'units': units, 'data_freq': 'hour'}}
+    values = np.full(obs.values.shape, np.nan)
+    ndays = len(obs.days)
+    for year in np.unique(obs.days.year):
+        if not os.path.exists(getfile(year, 'hour')):
+            warnings.warn(f'No hourly model file for {year}, model {var} is NaN')
+            continue
+        mdata = read_model(var, getfile, year, year + 1, var_info,
+                           station_index=station_index)
+        times, data = station_index.extract(mdata)
+        data = data.T
+        times = model_hour_starts(times, year)
+        tdays = times.astype('datetime64[D]')
+        iday = (tdays - obs.days.values[0].astype('datetime64[D]')).astype(int)
+        ihour = ((times - tdays) // np.timedelta64(1, 'h')).astype(int)
+        inside = (iday >= 0) & (iday < ndays)
+        values[:, iday[inside], ihour[inside]] = data[:, inside]
+    # colocated in time: no model where there are no observations
+    values[np.isnan(obs.values)] = np.nan
+    return HourlyGrid(values, obs.days, obs.station_names, obs.metas, var)
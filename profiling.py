@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the stages of a run
+
+The stages of the scripts (reading and filtering observations, reading and
+deriving the model per year, colocation, station metadata, trends and
+output) are wrapped in stage(). If profiling is enabled (see
+Profiler.enable), each stage appends a record with
+
+- wall and CPU time (CPU time of the process, including threads),
+- bytes read and written by the process (rchar/wchar of /proc/self/io,
+  i.e. including reads from the page cache),
+- the peak RSS of the process so far and, if tracemalloc is enabled, the
+  peak of memory allocated by Python during the stage
+
+to the records file of the run. Worker processes initialised with
+init_worker append to the same file. write_report summarises the records per stage and
+variable in a JSON and a CSV file, which can be compared between runs
+(e.g. between report years) with compare_reports or
+
+    python profiling.py old_report.json new_report.json
+
+Profiler.cprofile dumps a cProfile of the processing of chosen variables.
+"""
+import os, json, time, socket, resource, threading, tracemalloc, cProfile
+from contextlib import contextmanager
+import pandas as pd
+
+# Stages recorded by the scripts
+PROFILE_STAGES = ['read_obs', 'filter_obs', 'read_model', 'derive', 'colocate',
+                  'station_meta', 'trends', 'write_output']
+
+# Relative increase of wall time reported as regression by compare_reports
+REGRESSION_TOLERANCE = 0.2
+
+
+def _io_counters():
+    # bytes read and written by this process, None if not available
+    try:
+        with open('/proc/self/io') as f:
+            items = dict(line.split(':') for line in f)
+        return int(items['rchar']), int(items['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _diff(end, start):
+    if end is None or start is None:
+        return None
+    return end - start
+
+
+def _max_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Profiler:
+    """
+    Records of the stages of a run
+
+    Disabled after creation, stage() then only runs the wrapped code.
+
+    Attributes
+    ----------
+    report_dir : str
+        Directory of the records and report files (None if disabled).
+    run_id : str
+        Name of the run, used in the file names.
+    cprofile_vars : list
+        Variables for which cprofile() dumps a profile.
+    """
+    def __init__(self):
+        self.report_dir = None
+        self.run_id = None
+        self.tracemalloc = False
+        self.cprofile_vars = []
+        self.settings = {}
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.report_dir is not None
+
+    @property
+    def records_file(self):
+        return os.path.join(self.report_dir, f'profile_{self.run_id}.jsonl')
+
+    def enable(self, report_dir, name, tracemalloc_on=False, cprofile_vars=None,
+               **settings):
+        """
+        Start recording the stages of a run
+
+        Parameters
+        ----------
+        report_dir : str
+            Directory of the report (created if needed).
+        name : str
+            Name of the script, the run ID is name plus the start time.
+        tracemalloc_on : bool
+            If True, trace memory allocations (slows down the run) to get
+            the peak memory of each stage.
+        cprofile_vars : list, optional
+            Variables for which cprofile() dumps a profile.
+        **settings
+            Settings of the run written to the report (JSON serialisable).
+        """
+        os.makedirs(report_dir, exist_ok=True)
+        self.report_dir = report_dir
+        self.run_id = f'{name}_{time.strftime("%Y%m%d-%H%M%S")}'
+        self.tracemalloc = tracemalloc_on
+        self.cprofile_vars = list(cprofile_vars or [])
+        self.settings = dict(settings, host=socket.gethostname(),
+                             start=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                             tracemalloc=tracemalloc_on)
+        if tracemalloc_on and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def get_state(self):
+        """Settings of the run, to record the stages of worker processes
+        in the same records file (see init_worker), None if disabled"""
+        if not self.enabled:
+            return None
+        return dict(report_dir=self.report_dir, run_id=self.run_id,
+                    tracemalloc=self.tracemalloc, cprofile_vars=self.cprofile_vars,
+                    settings=self.settings)
+
+    def set_state(self, state):
+        """Continue recording a run with the settings from get_state"""
+        self.report_dir = state['report_dir']
+        self.run_id = state['run_id']
+        self.tracemalloc = state['tracemalloc']
+        self.cprofile_vars = list(state['cprofile_vars'])
+        self.settings = dict(state['settings'])
+        if self.tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name, var=None, **info):
+        """
+        Record a stage of the run (context manager)
+
+        Parameters
+        ----------
+        name : str
+            Name of stage (see PROFILE_STAGES).
+        var : str, optional
+            Variable(s) processed in the stage.
+        **info
+            Further items of the record (e.g. year or number of stations).
+        """
+        if not self.enabled:
+            yield
+            return
+        stack = self._stack()
+        trace = self.tracemalloc and tracemalloc.is_tracing()
+        if trace:
+            # peak of the enclosing stage up to here, the peak is reset for
+            # this stage and passed on to the enclosing stage at the end
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        entry = dict(peak=0)
+        stack.append(entry)
+        read0, written0 = _io_counters()
+        start = time.time()
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall0
+            cpu = time.process_time() - cpu0
+            read1, written1 = _io_counters()
+            stack.pop()
+            peak = None
+            if trace:
+                peak = max(entry['peak'], tracemalloc.get_traced_memory()[1])
+                if stack:
+                    stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+                peak = peak / 1024**2
+            record = dict(stage=name, var=var, pid=os.getpid(), start=start,
+                          wall_s=wall, cpu_s=cpu,
+                          read_bytes=_diff(read1, read0),
+                          written_bytes=_diff(written1, written0),
+                          max_rss_mb=_max_rss_mb(), tracemalloc_peak_mb=peak,
+                          **info)
+            # one write per record, so that records of several processes
+            # are not mixed
+            with open(self.records_file, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    @contextmanager
+    def cprofile(self, var):
+        """Dump a cProfile of the wrapped code if var is in cprofile_vars
+        (to profile_<run ID>_<var>.prof, see pstats)"""
+        if not self.enabled or not var in self.cprofile_vars:
+            yield
+            return
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(os.path.join(self.report_dir,
+                                         f'profile_{self.run_id}_{var}.prof'))
+
+    def read_records(self):
+        """Records of the run as pandas.DataFrame"""
+        if not self.enabled or not os.path.exists(self.records_file):
+            return pd.DataFrame(columns=['stage', 'var', 'wall_s'])
+        return pd.read_json(self.records_file, lines=True)
+
+    def write_report(self):
+        """
+        Write report of the run
+
+        The records are written to profile_<run ID>.csv and a summary per
+        stage and per variable and stage to profile_<run ID>.json.
+
+        Returns
+        -------
+        str
+            Path of the JSON report (None if profiling is disabled)
+        """
+        if not self.enabled:
+            return None
+        df = self.read_records()
+        base = os.path.join(self.report_dir, f'profile_{self.run_id}')
+        df.to_csv(f'{base}.csv')
+        report = dict(run_id=self.run_id, settings=self.settings,
+                      end=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                      stages=summarise(df, ['stage']),
+                      var_stages=summarise(df, ['var', 'stage']))
+        with open(f'{base}.json', 'w') as f:
+            json.dump(report, f, indent=1, default=str)
+        print(f'Profiling report written to {base}.json')
+        return f'{base}.json'
+
+
+def summarise(df, by):
+    """
+    Sum of times and bytes and maximum of memory of records per group
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Records (see Profiler.read_records).
+    by : list
+        Columns to group by (e.g. ['stage'] or ['var', 'stage']).
+
+    Returns
+    -------
+    list
+        Dicts with the group columns, count, wall_s, cpu_s, read_bytes,
+        written_bytes, max_rss_mb and tracemalloc_peak_mb
+    """
+    if len(df) == 0:
+        return []
+    df = df.copy()
+    for col in by:
+        df[col] = df[col].fillna('')
+    how = dict(count=('wall_s', 'size'), wall_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'),
+               read_bytes=('read_bytes', 'sum'), written_bytes=('written_bytes', 'sum'),
+               max_rss_mb=('max_rss_mb', 'max'),
+               tracemalloc_peak_mb=('tracemalloc_peak_mb', 'max'))
+    summary = df.groupby(by, sort=False).agg(**how).reset_index()
+    return json.loads(summary.to_json(orient='records'))
+
+
+def compare_reports(old, new, tolerance=REGRESSION_TOLERANCE):
+    """
+    Compare wall times per variable and stage of two reports
+
+    Parameters
+    ----------
+    old, new : str
+        Paths of JSON reports (see Profiler.write_report). The old report
+        serves as budget.
+    tolerance : float
+        Relative increase of wall time that counts as regression.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Wall times of both reports, their ratio and a regression flag, per
+        variable and stage
+    """
+    tables = []
+    for path in [old, new]:
+        with open(path) as f:
+            report = json.load(f)
+        table = pd.DataFrame(report['var_stages'], columns=['var', 'stage', 'wall_s'])
+        tables.append(table.set_index(['var', 'stage'])['wall_s'])
+    df = pd.concat(tables, axis=1, keys=['old_wall_s', 'new_wall_s'])
+    df['ratio'] = df['new_wall_s'] / df['old_wall_s']
+    df['regression'] = df['ratio'] > 1 + tolerance
+    return df
+
+
+# Profiler of this process, used by the scripts and modules
+PROFILER = Profiler()
+
+
+def stage(name, var=None, **info):
+    """Record stage of the run with PROFILER (see Profiler.stage)"""
+    return PROFILER.stage(name, var, **info)
+
+
+def init_worker(state):
+    """
+    Initializer of worker processes (e.g. of a ProcessPoolExecutor)
+
+    Enables PROFILER of the worker with the state of PROFILER of the main
+    process (PROFILER.get_state()), so that the stages of the worker are
+    recorded in the records file of the run, whatever the start method of
+    the processes. Nothing is done if state is None (profiling disabled).
+    """
+    if state is not None:
+        PROFILER.set_state(state)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare wall times of two '
+                                                 'profiling reports')
+    parser.add_argument('old', help='JSON report of the reference run (budget)')
+    parser.add_argument('new', help='JSON report of the new run')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help='relative increase of wall time counted as regression')
+    args = parser.parse_args()
+    df = compare_reports(args.old, args.new, args.tolerance)
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(df)
+    if df['regression'].any():
+        print(f'{df["regression"].sum()} stages slower than the tolerance')
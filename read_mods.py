@@ -5,13 +5,19 @@ Created on Wed Jun 23 09:32:56 2021
 
 @author: hansb
 """
-import os, socket, tqdm
+import os, socket, tqdm, hashlib, inspect, json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import iris
 import cf_units
 import pyaerocom as pya
 import warnings
+from pyaerocom.exceptions import VarNotAvailableError
+from pyaerocom.units_helpers import UALIASES
 
 import derive_cubes as der
+from profiling import PROFILER, stage, init_worker
 
 # Units that the variables from EMEP should have, when returned by read_mods
 # (this may differ from the unit in the EMEP output file, since some unit
@@ -51,6 +57,12 @@ EMEP_VAR_UNITS = {
     'concoaf': 'ug m-3'
 }
 
+# Derivations of the variables that are not read directly from the model
+# files. A req_var that has its own entry here is derived first and its
+# result is used (e.g. concNno3pm25 is computed from the derived
+# concno3pm25), except a variable listing itself, which means the raw field
+# of that name (e.g. concCecpm25). Cycles and duplicate definitions are
+# rejected (see check_calc_how).
 CALCULATE_HOW = {
     'concNtnh': {'req_vars': ['concnh3', 'concnh4'],
                  'function': der.calc_concNtnh},
@@ -64,8 +76,8 @@ CALCULATE_HOW = {
                  'function': der.calc_concNnh4},
     'concNhno3': {'req_vars': ['conchno3'],
                   'function': der.calc_concNhno3},
-    'concNno3pm25': {'req_vars': ['concno3f', 'concno3c'],
-                     'function': der.calc_concNno3pm25},
+    'concNno3pm25': {'req_vars': ['concno3pm25'],
+                     'function': der.calc_concNno3pm25_from_concno3pm25},
     'concNno3pm10': {'req_vars': ['concno3f', 'concno3c'],
                      'function': der.calc_concNno3pm10},
     'concno3pm25': {'req_vars': ['concno3f', 'concno3c'],
@@ -78,6 +90,12 @@ CALCULATE_HOW = {
                     'function': der.fix_ecunits}
 }
 
+# pyaerocom versions for which read_var_at_stations reads only the station
+# subgrid from the model files (it uses internals of ReadMscwCtm). With
+# other versions, the full fields are read and then cropped. The version used
+# for the report is 0.12.0dev2 (see README.md).
+READ_AT_STATIONS_PYAEROCOM_VERSIONS = ['0.12.0.dev2', '0.12.0']
+
 HOSTNAME = socket.gethostname()
 
 if HOSTNAME == 'pc5302':
@@ -104,7 +122,811 @@ def not_implemented(cube):
     raise NotImplementedError
 
 
-def read_model(var, getfile, start_yr, stop_yr, var_info, calc_how={}):
+class StationGridIndex(object):
+    """
+    Grid cells of a lon-lat model grid that contain a set of stations
+
+    The nearest grid cell is found separately for latitude and longitude,
+    which is the same as a nearest neighbour search on a rectilinear grid.
+    The subgrid made of the rows and columns of these cells (plus
+    nneighbours rows and columns on each side) therefore gives the same
+    nearest neighbour for each station as the full grid.
+
+    The subgrid is the product of all station rows and all station columns,
+    so it only saves much for a compact set of stations: e.g. on a 0.1
+    degree grid from 30N to 82N and 30W to 90E, the 16 stations of the
+    PM2.5 speciation need 0.3% of the grid cells, while a few hundred
+    stations spread over Europe need 15-25% (see coverage). The data read
+    with the index is still a gridded cube (on the subgrid), since it is
+    colocated with pyaerocom. extract gives the station x time array.
+
+    Parameters
+    ----------
+    latitudes : list
+        Station latitudes.
+    longitudes : list
+        Station longitudes (same length as latitudes).
+    nneighbours : int, optional
+        Number of neighbouring rows and columns on each side of the station
+        cells that are included in the subgrid. With at least 1, each station
+        is inside the lat/lon range of the subgrid, so that
+        colocate_gridded_ungridded does not drop stations at its edges.
+    """
+    def __init__(self, latitudes, longitudes, nneighbours=1):
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        if self.latitudes.shape != self.longitudes.shape:
+            raise ValueError('latitudes and longitudes must have the same length')
+        self.nneighbours = int(nneighbours)
+        self.grid_lats = None
+        self.grid_lons = None
+        self.lat_idx = None
+        self.lon_idx = None
+
+    @classmethod
+    def from_ungridded(cls, data, nneighbours=1):
+        """
+        Create index for all station coordinates in UngriddedData object(s)
+
+        data may be a single UngriddedData object or a list of them (e.g. one
+        per variable). Coordinates of all metadata blocks are used (not only
+        one per station name), since the coordinates used in the colocation
+        may come from any of the blocks of a station.
+        """
+        if not isinstance(data, (list, tuple)):
+            data = [data]
+        metas = [meta for obj in data for meta in obj.metadata.values()]
+        coords = set()
+        for meta in metas:
+            try:
+                lat, lon = float(meta['latitude']), float(meta['longitude'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if np.isfinite(lat) and np.isfinite(lon):
+                coords.add((lat, lon))
+        coords = sorted(coords)
+        return cls([c[0] for c in coords], [c[1] for c in coords], nneighbours)
+
+    @property
+    def key(self):
+        """Hashable identifier of station coordinates and neighbours"""
+        sha = hashlib.sha1(self.latitudes.tobytes() + self.longitudes.tobytes())
+        return (sha.hexdigest(), self.nneighbours)
+
+    def set_grid(self, grid_lats, grid_lons):
+        """
+        Find the grid cell of each station on the grid with given coordinates
+
+        Nothing is recomputed if the grid is the same as in the last call.
+
+        Returns
+        -------
+        bool
+            True if the grid is new (the cells were computed).
+        """
+        grid_lats = np.asarray(grid_lats, dtype=float)
+        grid_lons = np.asarray(grid_lons, dtype=float)
+        if (self.grid_lats is not None and np.array_equal(grid_lats, self.grid_lats)
+                and np.array_equal(grid_lons, self.grid_lons)):
+            return False
+        self.grid_lats = grid_lats
+        self.grid_lons = grid_lons
+        self.lat_idx = self._nearest(grid_lats, self.latitudes)
+        self.lon_idx = self._nearest(grid_lons, self.longitudes)
+        return True
+
+    @staticmethod
+    def _nearest(points, values):
+        return np.abs(points[:, np.newaxis] - values[np.newaxis, :]).argmin(axis=0)
+
+    def _subgrid(self, idx, size):
+        offsets = np.arange(-self.nneighbours, self.nneighbours + 1)
+        idx = (idx[:, np.newaxis] + offsets[np.newaxis, :]).ravel()
+        return np.unique(np.clip(idx, 0, size - 1))
+
+    @property
+    def subgrid_lat_idx(self):
+        """Sorted indices of the grid latitudes included in the subgrid"""
+        return self._subgrid(self.lat_idx, len(self.grid_lats))
+
+    @property
+    def subgrid_lon_idx(self):
+        """Sorted indices of the grid longitudes included in the subgrid"""
+        return self._subgrid(self.lon_idx, len(self.grid_lons))
+
+    @property
+    def coverage(self):
+        """Fraction of the grid cells that are in the subgrid"""
+        return (len(self.subgrid_lat_idx) * len(self.subgrid_lon_idx) /
+                (len(self.grid_lats) * len(self.grid_lons)))
+
+    def describe(self):
+        """Size of the subgrid compared to the grid (for the log)"""
+        return (f'{len(self.latitudes)} stations: subgrid of {len(self.subgrid_lat_idx)} x '
+                f'{len(self.subgrid_lon_idx)} of {len(self.grid_lats)} x '
+                f'{len(self.grid_lons)} grid cells ({self.coverage:.1%})')
+
+    def cell_indices(self, lats, lons):
+        """
+        Indices of the station cells in model data with given coordinates
+
+        Direct index arithmetic if the coordinates are those of the grid
+        (data read without station index) or of the subgrid (data read with
+        this index, see read_var_at_stations), nearest neighbour search
+        otherwise.
+
+        Parameters
+        ----------
+        lats, lons : numpy.ndarray
+            Latitudes and longitudes of the model data.
+
+        Returns
+        -------
+        lat_idx, lon_idx : numpy.ndarray
+            Latitude and longitude index of the cell of each station.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        if self.grid_lats is not None:
+            if np.array_equal(lats, self.grid_lats) and np.array_equal(lons, self.grid_lons):
+                return self.lat_idx, self.lon_idx
+            sub_lat, sub_lon = self.subgrid_lat_idx, self.subgrid_lon_idx
+            if (np.array_equal(lats, self.grid_lats[sub_lat])
+                    and np.array_equal(lons, self.grid_lons[sub_lon])):
+                return (np.searchsorted(sub_lat, self.lat_idx),
+                        np.searchsorted(sub_lon, self.lon_idx))
+        return self._nearest(lats, self.latitudes), self._nearest(lons, self.longitudes)
+
+    def extract(self, gridded):
+        """
+        Time series of gridded model data in the cell of each station
+
+        Same values as GriddedData.to_time_series at the station coordinates,
+        but with one fancy-indexing of the data array for all stations.
+
+        Parameters
+        ----------
+        gridded : pyaerocom.GriddedData
+            Model data on a lon-lat grid (the dimensions are reordered to
+            time, latitude, longitude).
+
+        Returns
+        -------
+        times : numpy.ndarray
+            Time stamps of the data.
+        values : numpy.ndarray
+            Data with shape (number of time stamps, number of stations), NaN
+            where the data is masked.
+        """
+        gridded.reorder_dimensions_tseries()
+        lat_idx, lon_idx = self.cell_indices(gridded.latitude.points,
+                                             gridded.longitude.points)
+        values = np.ma.filled(gridded.data[:, lat_idx, lon_idx], np.nan)
+        return np.asarray(gridded.time_stamps()), values
+
+    def cache_file(self, cache_dir):
+        """Path of the cache file of this index in cache_dir (see save)"""
+        sha, nneighbours = self.key
+        return os.path.join(cache_dir, f'station_index_{sha[:16]}_{nneighbours}.npz')
+
+    def save(self, path):
+        """
+        Save index with the grid cells of the stations (see set_grid) to a
+        npz file
+
+        The file is first written under a temporary name and then renamed, so
+        an interrupted run never leaves a partial file behind.
+        """
+        if self.grid_lats is None:
+            raise ValueError('No grid set, nothing to save')
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp, latitudes=self.latitudes, longitudes=self.longitudes,
+                 nneighbours=self.nneighbours, grid_lats=self.grid_lats,
+                 grid_lons=self.grid_lons, lat_idx=self.lat_idx, lon_idx=self.lon_idx)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load index saved with save"""
+        with np.load(path) as f:
+            index = cls(f['latitudes'], f['longitudes'], int(f['nneighbours']))
+            index.grid_lats = f['grid_lats']
+            index.grid_lons = f['grid_lons']
+            index.lat_idx = f['lat_idx']
+            index.lon_idx = f['lon_idx']
+        return index
+
+    @classmethod
+    def cached(cls, latitudes, longitudes, nneighbours=1, cache_dir=None):
+        """
+        Create index, or load it from cache_dir if it was saved there for
+        the same stations before (see cache_file)
+        """
+        index = cls(latitudes, longitudes, nneighbours)
+        if cache_dir is not None and os.path.exists(index.cache_file(cache_dir)):
+            return cls.load(index.cache_file(cache_dir))
+        return index
+
+
+def _find_dim(arr, names):
+    for name in names:
+        if name in arr.dims:
+            return name
+    raise ValueError('None of the dimensions %s found in model data with dimensions %s. '
+                     'Reading at stations requires a lon-lat grid.' % (names, arr.dims))
+
+
+def _report_subgrid(station_index, grid_lats, grid_lons):
+    # find the cells of the stations and report the size of the subgrid
+    # once per grid
+    if station_index.set_grid(grid_lats, grid_lons):
+        print(f'Reading model data at {station_index.describe()}')
+
+
+def _load_subgrid(reader, var_name, station_index):
+    # read only the subgrid from the netCDF file, with the steps of
+    # ReadMscwCtm.read_var of pyaerocom 0.12 (see read_var_at_stations)
+    var_name_aerocom = pya.const.VARS[var_name].var_name_aerocom
+    ts_type = reader.ts_type
+
+    arr = reader._load_var(var_name_aerocom, ts_type)
+    latdim = _find_dim(arr, ['lat', 'latitude'])
+    londim = _find_dim(arr, ['lon', 'longitude'])
+    _report_subgrid(station_index, arr[latdim].values, arr[londim].values)
+    arr = arr.isel({latdim: station_index.subgrid_lat_idx,
+                    londim: station_index.subgrid_lon_idx})
+
+    if arr.units in UALIASES:
+        arr.attrs['units'] = UALIASES[arr.units]
+    cube = arr.to_iris()
+    if ts_type == 'hourly':
+        cube.coord('time').convert_units('hours since 1900-01-01')
+    gridded = pya.GriddedData(cube, var_name=var_name_aerocom,
+                              ts_type=ts_type, check_unit=True,
+                              convert_unit_on_init=True)
+    gridded.metadata['data_id'] = reader.data_id
+    gridded.metadata['from_files'] = [reader.filepath]
+    for metadata in ['current_date_first', 'current_date_last']:
+        if metadata in gridded.metadata.keys():
+            del(gridded.metadata[metadata])
+    return gridded
+
+
+def crop_to_stations(gridded, station_index):
+    """
+    Crop gridded model data to the subgrid of a set of stations
+
+    Parameters
+    ----------
+    gridded : pyaerocom.GriddedData
+        Model data on a lon-lat grid (changed inplace).
+    station_index : StationGridIndex
+        Stations at which the data is needed.
+
+    Returns
+    -------
+    pyaerocom.GriddedData
+        Data on the subgrid of the stations
+    """
+    cube = gridded.cube
+    latdim = cube.coord_dims('latitude')[0]
+    londim = cube.coord_dims('longitude')[0]
+    _report_subgrid(station_index, cube.coord('latitude').points,
+                    cube.coord('longitude').points)
+    keys = [slice(None)] * cube.ndim
+    keys[latdim] = station_index.subgrid_lat_idx
+    cube = cube[tuple(keys)]
+    keys[latdim] = slice(None)
+    keys[londim] = station_index.subgrid_lon_idx
+    gridded.cube = cube[tuple(keys)]
+    return gridded
+
+
+def read_var_at_stations(reader, var_name, station_index):
+    """
+    Read a model variable only in the grid cells needed for a set of stations
+
+    With the pyaerocom versions in READ_AT_STATIONS_PYAEROCOM_VERSIONS, the
+    rows and columns of the grid which are not in the subgrid of
+    station_index are dropped before the data is loaded from the netCDF
+    file. This uses the private ReadMscwCtm._load_var and repeats the other
+    steps of ReadMscwCtm.read_var of these versions, which is checked by
+    tests/test_read_mods.py. With other versions, the variable is read with
+    ReadMscwCtm.read_var and then cropped to the subgrid (crop_to_stations).
+
+    Parameters
+    ----------
+    reader : pyaerocom.io.ReadMscwCtm
+        Reader of the model data file.
+    var_name : string
+        Variable name (as in pyaerocom).
+    station_index : StationGridIndex
+        Stations at which the data is needed.
+
+    Returns
+    -------
+    pyaerocom.GriddedData
+        Data on the subgrid of the stations
+    """
+    if not reader.has_var(var_name):
+        raise VarNotAvailableError(var_name)
+    if pya.__version__ in READ_AT_STATIONS_PYAEROCOM_VERSIONS:
+        return _load_subgrid(reader, var_name, station_index)
+    return crop_to_stations(reader.read_var(var_name), station_index)
+
+
+def read_raw_cubes(infile, req_vars, station_index=None):
+    """
+    Read raw model fields from one model file as iris cubes
+
+    Parameters
+    ----------
+    infile : string
+        Path to the model data file.
+    req_vars : list
+        Variable names (as in pyaerocom) to read from infile.
+    station_index : StationGridIndex, optional
+        If provided, only the subgrid of these stations is read.
+
+    Returns
+    -------
+    list
+        iris.cube.Cube objects in the same order as req_vars
+    """
+    reader = pya.io.ReadMscwCtm(infile)
+    cubes = []
+    for req_var in req_vars:
+        if station_index is None:
+            temp = reader.read_var(req_var)
+        else:
+            temp = read_var_at_stations(reader, req_var, station_index)
+        tcoord = temp.cube.coords('time')[0]
+        if tcoord.units.calendar == 'proleptic_gregorian':
+            tcoord.units = cf_units.Unit(tcoord.units.origin, calendar='gregorian')
+        cubes.append(temp.cube)
+    return cubes
+
+
+def check_calc_how(calc_how):
+    """
+    Check the derivations in calc_how (see CALCULATE_HOW)
+
+    Parameters
+    ----------
+    calc_how : dict
+        Derivations as in CALCULATE_HOW.
+
+    Raises
+    ------
+    ValueError
+        If an entry lists a req_var more than once, if two variables have
+        the same definition (req_vars and function), or if the entries
+        depend on each other in a cycle. A variable listing itself as
+        req_var means the raw field of the same name, which is no cycle.
+    """
+    defined = {}
+    for var, how in calc_how.items():
+        req_vars = list(how['req_vars'])
+        if len(set(req_vars)) != len(req_vars):
+            raise ValueError('Repeated req_vars in calc_how entry of %s: %s' % (var, req_vars))
+        definition = (tuple(req_vars), how['function'])
+        if definition in defined:
+            raise ValueError('%s and %s have the same definition in calc_how'
+                             % (defined[definition], var))
+        defined[definition] = var
+
+    checked = set()
+
+    def visit(var, path):
+        if var in path:
+            raise ValueError('Circular dependency in calc_how: %s'
+                             % ' -> '.join(path + [var]))
+        if var in checked or var not in calc_how:
+            return
+        for req in calc_how[var]['req_vars']:
+            if req != var:
+                visit(req, path + [var])
+        checked.add(var)
+
+    for var in calc_how:
+        visit(var, [])
+
+
+class ReadPlan(object):
+    """
+    Plan for reading and deriving several model variables in one pass
+
+    The plan is a graph of raw fields and derived variables, built from the
+    "req_vars" in calc_how. A req_var that has its own entry in calc_how
+    (and is not the variable itself) is derived first, so intermediates are
+    shared, e.g. concno3pm25 is computed once and reused for concNno3pm25.
+    Each distinct raw field is read once per model file, whatever the number
+    of variables that need it. calc_how is checked with check_calc_how.
+
+    Parameters
+    ----------
+    variables : list
+        Variables (as in pyaerocom) to provide.
+    calc_how : dict
+        Derivations as in CALCULATE_HOW. Variables without an entry are read
+        directly from the model files.
+    """
+    def __init__(self, variables, calc_how):
+        check_calc_how(calc_how)
+        self.variables = list(variables)
+        self.calc_how = calc_how
+        # raw fields to read (in order of first use)
+        self.raw_vars = []
+        # derivation steps in dependency order: (var, input nodes, function)
+        self.steps = []
+        # node (('raw'|'derived', name)) of each requested variable
+        self.outputs = {}
+        for var in self.variables:
+            self.outputs[var] = self._add(var)
+
+        # index of the last step using each node, to free intermediates early
+        self._last_use = {}
+        for i, (_, inputs, _) in enumerate(self.steps):
+            for node in inputs:
+                self._last_use[node] = i
+
+    def _add(self, var, req_of=None):
+        if var not in self.calc_how or var == req_of:
+            if var not in self.raw_vars:
+                self.raw_vars.append(var)
+            return ('raw', var)
+        node = ('derived', var)
+        if any(step[0] == var for step in self.steps):
+            return node
+        how = self.calc_how[var]
+        inputs = [self._add(req, req_of=var) for req in how['req_vars']]
+        self.steps.append((var, inputs, how['function']))
+        return node
+
+    def fingerprint(self, var):
+        """
+        Description of everything that var depends on in this plan
+
+        Returns a list of (var, req_vars, function name, hash of function
+        module source) for the derivations needed for var, and the raw
+        fields read directly.
+        """
+        sub = ReadPlan([var], self.calc_how)
+        steps = []
+        for dvar, _, function in sub.steps:
+            src = inspect.getsource(inspect.getmodule(function))
+            steps.append([dvar, list(self.calc_how[dvar]['req_vars']),
+                          f'{function.__module__}.{function.__qualname__}',
+                          hashlib.sha1(src.encode()).hexdigest()])
+        return [steps, sub.raw_vars]
+
+    def read(self, infile, station_index=None):
+        """Read all raw fields of the plan from one model file"""
+        with stage('read_model', ','.join(self.variables), file=os.path.basename(infile)):
+            return read_raw_cubes(infile, self.raw_vars, station_index)
+
+    def derive(self, raw_cubes):
+        """
+        Compute all requested variables from the raw fields of one file
+
+        Each derivation function gets copies of its input cubes (sharing the
+        data arrays), so functions that modify metadata inplace (e.g.
+        fix_ecunits) do not affect other users of the same input.
+
+        Returns
+        -------
+        dict
+            iris.cube.Cube for each requested variable
+        """
+        values = {('raw', var): cube for var, cube in zip(self.raw_vars, raw_cubes)}
+        keep = set(self.outputs.values())
+        for i, (var, inputs, function) in enumerate(self.steps):
+            args = [values[node].copy(data=values[node].core_data()) for node in inputs]
+            with stage('derive', var):
+                values[('derived', var)] = function(*args)
+            for node in inputs:
+                if self._last_use[node] == i and node not in keep:
+                    del values[node]
+        return {var: values[node] for var, node in self.outputs.items()}
+
+
+def group_variables(variables, calc_how):
+    """
+    Split variables into groups that share raw fields or derived intermediates
+
+    Variables of different groups have no model field in common, so reading
+    them with separate calls of read_models reads every field only once,
+    while only the data of one group needs to be in memory at a time. No
+    raw field is read again in a later call, so raw fields are not cached
+    between calls.
+
+    Parameters
+    ----------
+    variables : list
+        Variable names (as in pyaerocom).
+    calc_how : dict
+        Derivations as in CALCULATE_HOW.
+
+    Returns
+    -------
+    list
+        Lists of variable names. The groups are ordered by their first
+        variable, and the variables within each group as in variables.
+    """
+    groups = []
+    for var in variables:
+        plan = ReadPlan([var], calc_how)
+        fields = set(plan.raw_vars) | set(step[0] for step in plan.steps)
+        overlap = [i for i, (_, gfields) in enumerate(groups) if gfields & fields]
+        if not overlap:
+            groups.append(([var], fields))
+            continue
+        gvars, gfields = groups[overlap[0]]
+        for i in overlap[1:]:
+            gvars.extend(groups[i][0])
+            gfields.update(groups[i][1])
+        gvars.append(var)
+        gfields.update(fields)
+        groups = [group for i, group in enumerate(groups) if i not in overlap[1:]]
+    return [sorted(gvars, key=variables.index) for gvars, _ in groups]
+
+
+def _read_year(plan, infile, station_index=None):
+    """
+    Worker function of read_years_parallel
+
+    Reads the raw cubes of the plan from one yearly model file and returns
+    the derived cubes of the requested variables.
+    """
+    return plan.derive(plan.read(infile, station_index))
+
+
+def read_years_parallel(plan, infiles, nworkers, max_inflight=None,
+                        desc=None, station_index=None):
+    """
+    Read and derive yearly model cubes in a pool of worker processes
+
+    This is a generator: the yearly files are submitted to the pool in the
+    order given and the derived cubes of each file are yielded in the same
+    order, as when reading the files one after another. At most
+    max_inflight files are being read or waiting to be collected at any
+    time. The cubes of the collected years are only kept by the caller
+    (read_models keeps the requested variables until they are
+    concatenated, so its peak memory is the concatenated result plus the
+    files in flight).
+
+    The variables are derived in the workers, only the derived cubes are
+    sent back to the main process.
+
+    The stages recorded in the workers are added to the profiling records
+    of the run (see profiling.init_worker).
+
+    Parameters
+    ----------
+    plan : ReadPlan
+        Variables to read and derive.
+    infiles : list
+        Paths to the yearly model files, in year order.
+    nworkers : int
+        Number of worker processes.
+    max_inflight : int, optional
+        Maximum number of yearly files submitted but not yet collected.
+        Defaults to nworkers.
+    desc : str, optional
+        Description used for the progress bar.
+    station_index : StationGridIndex, optional
+        If provided, only the subgrid of these stations is read.
+
+    Yields
+    ------
+    dict
+        Derived iris.cube.Cube objects of each file in infiles
+    """
+    if max_inflight is None:
+        max_inflight = nworkers
+
+    todo = deque(infiles)
+    inflight = deque()
+    with ProcessPoolExecutor(max_workers=nworkers, initializer=init_worker,
+                             initargs=(PROFILER.get_state(),)) as pool, \
+            tqdm.tqdm(total=len(infiles), desc=desc) as pbar:
+        while todo or inflight:
+            while todo and len(inflight) < max_inflight:
+                inflight.append(pool.submit(_read_year, plan, todo.popleft(),
+                                            station_index))
+
+            derived = inflight.popleft().result()
+            pbar.update()
+            yield derived
+
+
+def get_derived_cache_file(cache_dir, var, start_yr, stop_yr, data_freq,
+                           infiles, plan, station_index=None):
+    """
+    Get path of the on-disk cache file of a concatenated model variable
+
+    The file name contains a hash of everything the result of read_model
+    depends on: variable, years, data_freq, paths and modification times of
+    the model files, the derivations of var in the plan (req_vars and source
+    code of the derivation functions' modules), the source code of this
+    module, the pyaerocom version and the station subgrid. Any change of these gives a new file
+    name, so outdated cache files are never used (they can be deleted by
+    hand).
+
+    Parameters
+    ----------
+    cache_dir : string
+        Directory with the cache files.
+    var : string
+        Variable name (as in pyaerocom).
+    start_yr, stop_yr : string or int
+        First and stop year (stop_yr not included), as in read_model.
+    data_freq : string
+        Time frequency of the model files.
+    infiles : list
+        Paths to the existing yearly model files.
+    plan : ReadPlan
+        Read plan containing var.
+    station_index : StationGridIndex, optional
+        Stations used to select the subgrid.
+
+    Returns
+    -------
+    string
+        Path to the cache file (which may not exist yet)
+    """
+    with open(__file__) as f:
+        read_src = f.read()
+    fingerprint = dict(
+        var=var,
+        years=[int(start_yr), int(stop_yr)],
+        data_freq=data_freq,
+        files=[[os.path.abspath(f), os.path.getmtime(f)] for f in infiles],
+        derivation=plan.fingerprint(var),
+        code=hashlib.sha1(read_src.encode()).hexdigest(),
+        pyaerocom=pya.__version__,
+        stations=None if station_index is None else list(station_index.key)
+    )
+    sha = hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+    fname = f'{var}_{start_yr}-{stop_yr}_{data_freq}_{sha[:16]}.nc'
+    return os.path.join(cache_dir, fname)
+
+
+def save_derived_cache(cube, cache_file):
+    """
+    Save cube to cache_file (compressed, chunked netCDF)
+
+    The file is first written under a temporary name and then renamed, so
+    an interrupted run never leaves a partial cache file behind. netCDF has
+    no boolean or empty attributes, so the boolean attributes set by
+    pyaerocom (e.g. "computed") are saved as integers, and attributes that
+    are None are left out.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    cube = cube.copy(data=cube.core_data())
+    for name, value in list(cube.attributes.items()):
+        if value is None:
+            del cube.attributes[name]
+        elif isinstance(value, (bool, np.bool_)):
+            cube.attributes[name] = int(value)
+    iris.save(cube, tmp_file, saver='nc', zlib=True)
+    os.replace(tmp_file, cache_file)
+
+
+def _check_var_units(data, var, var_info):
+    # verify final var_name and units
+    assert data.cube.var_name == var
+    if data.cube.units != var_info[var]['units']:
+        error_str = ('Calculation of variable "%s" result in units "%s", not the expected units "%s"'
+                     % (var, data.cube.units, var_info[var]['units']))
+        raise ValueError(error_str)
+
+
+def read_models(variables, getfile, start_yr, stop_yr, var_info, calc_how={},
+                nworkers=1, max_inflight=None,
+                station_index=None, cache_dir=None, var_station_index=None):
+    """
+    Read several model variables from multiple annual EMEP runs in one pass
+
+    Like read_model, but for a list of variables. Variables are grouped by
+    data_freq, and for each group every yearly model file is opened once
+    and each raw field needed by any of the variables is read once (see
+    ReadPlan). Derived intermediates that are entries of calc_how are shared
+    between the variables.
+
+    Parameters
+    ----------
+    variables : list
+        Variable names (as in pyaerocom).
+    var_info : dict
+        Dict of dicts with keys "units" and "data_freq" for each variable.
+    var_station_index : dict, optional
+        StationGridIndex of the stations of each variable, used instead of
+        station_index for the name of the on-disk cache file (see
+        get_derived_cache_file), so that the cached data of a variable stays
+        valid when the stations of other variables change. The subgrid read
+        is still the one of station_index, which must cover these stations.
+    For the other parameters, see read_model.
+
+    Returns
+    -------
+    dict
+        pyaerocom.GriddedData object for each variable
+    """
+    print(f'Reading {", ".join(variables)} from model output')
+
+    result = {}
+    freqs = []
+    for var in variables:
+        if var_info[var]['data_freq'] not in freqs:
+            freqs.append(var_info[var]['data_freq'])
+
+    for data_freq in freqs:
+        freq_vars = [var for var in variables if var_info[var]['data_freq'] == data_freq]
+
+        infiles = []
+        years = range(int(start_yr), int(stop_yr))
+        for year in years:
+            infile = getfile(year, data_freq)
+            if not os.path.exists(infile):
+                warnings.warn('No model data found for year %d. File %s not found' % (year, infile))
+                continue
+            infiles.append(infile)
+
+        # load variables that are available in the on-disk cache
+        plan = ReadPlan(freq_vars, calc_how)
+        cache_files = {}
+        if cache_dir is not None:
+            for var in freq_vars:
+                if var_station_index is not None and var in var_station_index:
+                    var_index = var_station_index[var]
+                else:
+                    var_index = station_index
+                cache_files[var] = get_derived_cache_file(cache_dir, var, start_yr, stop_yr,
+                                                          data_freq, infiles, plan, var_index)
+                if os.path.exists(cache_files[var]):
+                    print(f'Loading {var} from cache file {cache_files[var]}')
+                    result[var] = pya.GriddedData(iris.load_cube(cache_files[var]))
+                    _check_var_units(result[var], var, var_info)
+        todo = [var for var in freq_vars if var not in result]
+        if len(todo) == 0:
+            continue
+
+        plan = ReadPlan(todo, calc_how)
+        desc = ','.join(todo)
+        if nworkers > 1:
+            years = read_years_parallel(plan, infiles, nworkers, max_inflight,
+                                        desc=desc, station_index=station_index)
+        else:
+            years = (plan.derive(plan.read(infile, station_index))
+                     for infile in tqdm.tqdm(infiles, desc=desc))
+
+        # only the requested variables of each year are kept (the raw fields
+        # and intermediates are freed once the year is derived)
+        yearly = {var: iris.cube.CubeList() for var in todo}
+        for derived in years:
+            for var in todo:
+                yearly[var].append(derived.pop(var))
+
+        for var in todo:
+            cubes = yearly.pop(var)
+            concatenated = pya.GriddedData(pya.io.iris_io.concatenate_iris_cubes(cubes, True))
+            del cubes
+            _check_var_units(concatenated, var, var_info)
+            if cache_dir is not None:
+                save_derived_cache(concatenated.cube, cache_files[var])
+            result[var] = concatenated
+
+    return {var: result[var] for var in variables}
+
+
+def read_model(var, getfile, start_yr, stop_yr, var_info, calc_how={},
+               nworkers=1, max_inflight=None,
+               station_index=None, cache_dir=None):
     """
     Read a model variable from multiple annual EMEP runs
 
@@ -133,7 +955,25 @@ def read_model(var, getfile, start_yr, stop_yr, var_info, calc_how={}):
         must be a fuction that calculates the variable from the "req_vars" given
         as iris.cube.Cube objects (in that order) and returns an iris.cube.Cube
         object. This returned Cube must have properties "var_name"=var and
-        units equivalent to var_info[var]['units'].
+        units equivalent to var_info[var]['units']. A req_var that has its
+        own entry in calc_how is derived first (see ReadPlan).
+    nworkers : int, optional
+        Number of worker processes used to read and derive the yearly cubes.
+        If 1 (default), the years are read one after another in this process.
+    max_inflight : int, optional
+        Only used if nworkers > 1. Maximum number of yearly files being read
+        or waiting to be collected at any time (defaults to nworkers). The
+        derived cubes of the collected years are kept until they are
+        concatenated.
+    station_index : StationGridIndex, optional
+        If provided, only the grid cells needed for these stations (plus
+        neighbours) are read from the model files, and the returned
+        GriddedData covers only this subgrid. It can be used in
+        colocate_gridded_ungridded and to_time_series as the full grid.
+    cache_dir : string, optional
+        If provided, the concatenated result is saved to a netCDF file in this
+        directory, and loaded from there in later calls with the same input
+        (see get_derived_cache_file).
 
     Returns
     -------
@@ -141,44 +981,8 @@ def read_model(var, getfile, start_yr, stop_yr, var_info, calc_how={}):
         GriddedData object containing the requested variable covering the requested
         time period.
     """
-    print(f'Reading {var} from model output')
-
-    try:
-        calculate_how = calc_how[var]
-    except KeyError:
-        calculate_how = {'req_vars': [var], 'function': dummy}
-
-    data_freq = var_info[var]['data_freq']
-
-    data = []
-    years = range(int(start_yr), int(stop_yr))
-    for year in tqdm.tqdm(years, desc=var):
-        infile = getfile(year, data_freq)
-        if not os.path.exists(infile):
-            warnings.warn('No model data found for year %d. File %s not found' % (year, infile))
-            continue
-
-        reader = pya.io.ReadMscwCtm(infile)
-
-        temp_data = []
-        for req_var in calculate_how['req_vars']:
-            temp = reader.read_var(req_var)
-            tcoord = temp.cube.coords('time')[0]
-            if tcoord.units.calendar == 'proleptic_gregorian':
-                tcoord.units = cf_units.Unit(tcoord.units.origin, calendar='gregorian')
-            temp_data.append(temp.cube)
-        calc_temp = calculate_how['function'](*temp_data)
-        data.append(calc_temp)
-
-    concatenated = pya.GriddedData(pya.io.iris_io.concatenate_iris_cubes(iris.cube.CubeList(data), True))
-    # verify final var_name and units
-    assert concatenated.cube.var_name == var
-    if concatenated.cube.units != var_info[var]['units']:
-        error_str = ('Calculation of variable "%s" result in units "%s", not the expected units "%s"'
-                     % (var, concatenated.cube.units, var_info[var]['units']))
-        raise ValueError(error_str)
-
-    return concatenated
+    return read_models([var], getfile, start_yr, stop_yr, var_info, calc_how,
+                       nworkers, max_inflight, station_index, cache_dir)[var]
 
 
 if __name__ == '__main__':
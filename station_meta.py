@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Station metadata of UngriddedData for all stations at once
+
+The metadata written to the sitemeta files is taken from the metadata blocks
+of the UngriddedData object, following the same rules as
+UngriddedData.to_station_data (which blocks are used, and how blocks of the
+same station are merged), but without converting and resampling the time
+series of each station.
+"""
+import numpy as np
+import pandas as pd
+import pyaerocom as pya
+from pyaerocom.exceptions import DataCoverageError
+from pyaerocom.helpers import start_stop
+from pyaerocom.metastandards import DataSource
+
+# Columns of the DataFrame returned by get_station_meta
+STATION_META_COLUMNS = ['station_id', 'station_name', 'latitude', 'longitude',
+                        'altitude', 'unit', 'framework', 'matrix', 'num_valid']
+
+# Metadata items that are merged if a station has several metadata blocks
+MERGED_META_KEYS = ['station_id', 'station_name', 'framework']
+
+# pyaerocom versions for which get_station_meta and extract_stations work on
+# the data array and metadata blocks of UngriddedData directly (they use its
+# internals). With other versions, the metadata is read from
+# UngriddedData.to_station_data for each station and the stations are
+# extracted with filter_by_meta. The version used for the report is
+# 0.12.0dev2 (see README.md).
+STATION_META_PYAEROCOM_VERSIONS = ['0.12.0.dev2', '0.12.0']
+
+
+def _merge_str(current, val):
+    # as StationData._merge_meta_item for str
+    if current is None:
+        return val
+    if val is None or current == val:
+        return current
+    for item in [x.strip() for x in val.split(';')]:
+        if not item in current:
+            current += f';{item}'
+    return current
+
+
+def _merge_varinfo_str(current, val):
+    # as StationData.merge_varinfo for str
+    if current is None:
+        return val
+    if val is None:
+        return current
+    vals = [x.strip() for x in current.split(';')]
+    for item in [x.strip() for x in val.split(';')]:
+        if not item in vals:
+            current += f';{item}'
+    return current
+
+
+def _merge_pref_attr(metas):
+    # as UngriddedData._try_infer_stat_merge_pref_attr: the preferred
+    # attribute of the data source (e.g. revision_date for EBAS) if all
+    # blocks are from the same source
+    data_ids = set(meta.get('data_id') for meta in metas)
+    if len(data_ids) != 1 or None in data_ids:
+        return None
+    return DataSource(data_id=data_ids.pop()).stat_merge_pref_attr
+
+
+def count_valid(data, var, start=None, stop=None):
+    """
+    Count valid (not NaN) values of a variable in each metadata block
+
+    Parameters
+    ----------
+    data : pyaerocom.UngriddedData
+        Data object.
+    var : str
+        Variable name.
+    start, stop : optional
+        Time range (as in UngriddedData.to_station_data, i.e. a year given
+        as stop is the first second of that year minus one second).
+
+    Returns
+    -------
+    numpy.ndarray
+        Number of valid values for each metadata index
+    """
+    arr = data._data
+    nblocks = int(max(data.metadata.keys())) + 1 if len(data.metadata) else 0
+    if not var in data.var_idx:
+        return np.zeros(nblocks, dtype=int)
+    mask = arr[:, data._VARINDEX] == data.var_idx[var]
+    mask &= ~np.isnan(arr[:, data._DATAINDEX])
+    if start is not None or stop is not None:
+        start, stop = start_stop(start, stop)
+        dtime = arr[:, data._TIMEINDEX].astype('datetime64[s]')
+        mask &= (dtime >= np.datetime64(start)) & (dtime <= np.datetime64(stop))
+    meta_idx = arr[mask, data._METADATAKEYINDEX].astype(int)
+    return np.bincount(meta_idx, minlength=nblocks)
+
+
+def station_blocks(data, var, start=None, stop=None, nvalid=None):
+    """
+    Get the metadata blocks with valid data of each station
+
+    The blocks of a station are ordered as they are merged in
+    UngriddedData.to_station_data, i.e. the preferred block (most recent
+    revision for EBAS, else the one with most valid data) first.
+
+    Parameters
+    ----------
+    data : pyaerocom.UngriddedData
+        Data object.
+    var : str
+        Variable name.
+    start, stop : optional
+        Time range, as in UngriddedData.to_station_data.
+    nvalid : numpy.ndarray, optional
+        Output of count_valid (computed if not given).
+
+    Returns
+    -------
+    dict
+        Metadata indices (list of int) for each station name
+    """
+    if nvalid is None:
+        nvalid = count_valid(data, var, start, stop)
+    blocks = {}
+    for idx, meta in data.metadata.items():
+        idx = int(idx)
+        if idx < len(nvalid) and nvalid[idx] > 0:
+            blocks.setdefault(meta['station_name'], []).append(idx)
+
+    for name, idxs in blocks.items():
+        if len(idxs) < 2:
+            continue
+        metas = [data.metadata[idx] for idx in idxs]
+        pref_attr = _merge_pref_attr(metas)
+        if pref_attr is not None:
+            order = sorted(range(len(idxs)), key=lambda i: metas[i][pref_attr])
+        else:
+            order = sorted(range(len(idxs)), key=lambda i: nvalid[idxs[i]])
+        blocks[name] = [idxs[i] for i in order[::-1]]
+    return blocks
+
+
+def get_station_meta(data, var, start=None, stop=None):
+    """
+    Get metadata of all stations with valid data of a variable
+
+    Equivalent to reading the metadata from the StationData objects
+    returned by data.to_station_data(station_name, var, start, stop) for
+    each station. The coordinates and unit are taken from the preferred
+    metadata block of a station (most recent revision for EBAS, else the
+    one with most valid data), the other metadata items are merged.
+
+    Parameters
+    ----------
+    data : pyaerocom.UngriddedData
+        Data object.
+    var : str
+        Variable name.
+    start, stop : optional
+        Time range, as in UngriddedData.to_station_data.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per station name (index), columns STATION_META_COLUMNS.
+    """
+    if pya.__version__ not in STATION_META_PYAEROCOM_VERSIONS:
+        return _station_meta_from_station_data(data, var, start, stop)
+    nvalid = count_valid(data, var, start, stop)
+    blocks = station_blocks(data, var, start, stop, nvalid)
+
+    rows = []
+    for name, idxs in blocks.items():
+        metas = [data.metadata[idx] for idx in idxs]
+        first = metas[0]
+        info = first.get('var_info', {}).get(var, {})
+        row = {key: first.get(key) for key in MERGED_META_KEYS}
+        matrix = info.get('matrix')
+        for other in metas[1:]:
+            for key in MERGED_META_KEYS:
+                row[key] = _merge_str(row[key], other.get(key))
+            matrix = _merge_varinfo_str(
+                matrix, other.get('var_info', {}).get(var, {}).get('matrix'))
+        row['latitude'] = first.get('latitude', np.nan)
+        row['longitude'] = first.get('longitude', np.nan)
+        row['altitude'] = first.get('altitude', np.nan)
+        row['unit'] = str(info['units']) if 'units' in info else None
+        row['matrix'] = matrix
+        row['num_valid'] = int(sum(nvalid[idx] for idx in idxs))
+        rows.append(row)
+
+    df = pd.DataFrame(rows, columns=STATION_META_COLUMNS)
+    df.index = pd.Index(list(blocks.keys()), name='site')
+    return df
+
+
+def _station_meta_from_station_data(data, var, start=None, stop=None):
+    # get_station_meta from the StationData of each station, for pyaerocom
+    # versions not in STATION_META_PYAEROCOM_VERSIONS (num_valid is counted
+    # in the merged time series)
+    rows = []
+    names = []
+    for name in data.unique_station_names:
+        try:
+            stat = data.to_station_data(name, var, start=start, stop=stop)
+        except DataCoverageError:
+            continue
+        rows.append({'station_id': stat.station_id,
+                     'station_name': stat.station_name,
+                     'latitude': stat.latitude,
+                     'longitude': stat.longitude,
+                     'altitude': stat.altitude,
+                     'unit': stat.get_unit(var),
+                     'framework': stat.framework,
+                     'matrix': stat.var_info[var].get('matrix'),
+                     'num_valid': int(stat[var].count())})
+        names.append(name)
+    df = pd.DataFrame(rows, columns=STATION_META_COLUMNS)
+    df.index = pd.Index(names, name='site')
+    return df
+
+
+def extract_stations(data, station_names):
+    """
+    Get UngriddedData with only the metadata blocks of some stations
+
+    Parameters
+    ----------
+    data : pyaerocom.UngriddedData
+        Data object.
+    station_names : list
+        Names of stations to extract.
+
+    Returns
+    -------
+    pyaerocom.UngriddedData
+        New data object (data itself if it contains no other stations)
+    """
+    names = set(station_names)
+    idxs = [idx for idx, meta in data.metadata.items()
+            if meta['station_name'] in names]
+    if len(idxs) == len(data.metadata):
+        return data
+    if pya.__version__ not in STATION_META_PYAEROCOM_VERSIONS:
+        return data.filter_by_meta(station_name=list(names))
+    totnum = sum(len(rows) for idx in idxs for rows in data.meta_idx[idx].values())
+    return data._new_from_meta_blocks(idxs, totnum)
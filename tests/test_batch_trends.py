@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyaerocom')
+
+import batch_trends
+from batch_trends import compute_trends_batch, trend_row, yearly_series
+from constants import PERIODS, SEASONS
+
+
+def _synthetic(times, nstat=40, seed=42):
+    # trend plus noise, with missing values, stations without data in the
+    # first periods, and stations with tied yearly means
+    rng = np.random.default_rng(seed)
+    values = (10 + 0.1*np.arange(len(times)) +
+              rng.normal(0, 2, (nstat, len(times))))
+    values[rng.random(values.shape) < 0.3] = np.nan
+    values[:5, :len(times) // 2] = np.nan
+    values[5, :] = np.nan
+    values[6, ::2] = 3.
+    values[7, :] = 5.
+    values[8:12] = np.round(values[8:12] / 4) * 4
+    return values
+
+
+@pytest.mark.parametrize('ts_type,freq', [('monthly', 'MS'), ('yearly', 'AS')])
+def test_compute_trends_batch_same_as_trends_engine(ts_type, freq):
+    from pyaerocom.trends_engine import TrendsEngine
+    times = pd.date_range('1999-01-01', '2020-12-01', freq=freq)
+    values = _synthetic(times)
+    results, yearly = compute_trends_batch(times, values, ts_type, PERIODS, SEASONS)
+
+    for istat in range(values.shape[0]):
+        ts = pd.Series(values[istat], index=times)
+        for iper, (start, stop, min_yrs) in enumerate(PERIODS):
+            for iseas, seas in enumerate(SEASONS):
+                ref = TrendsEngine.compute_trend(ts, ts_type, start, stop, min_yrs, seas)
+                refrow = [ref[f'slp_{start}'], ref[f'slp_{start}_err'],
+                          ref[f'reg0_{start}'], ref['m'], ref['m_err'],
+                          ref['n'], ref['pval']]
+                row = trend_row(results, istat, iper, iseas)
+                for a, b in zip(refrow, row):
+                    if a is None or (isinstance(a, float) and np.isnan(a)):
+                        assert b is None, (istat, start, seas, refrow, row)
+                    else:
+                        # differences due to the order of summation only
+                        assert b == pytest.approx(a, rel=1e-10, abs=1e-300)
+                series = yearly_series(yearly, istat, start, stop, seas)
+                if ref['data'] is None:
+                    assert series is None
+                else:
+                    pd.testing.assert_series_equal(ref['data'], series,
+                                                   check_freq=False, rtol=1e-12)
+
+
+def test_seasons_same_as_pyaerocom():
+    from pyaerocom import trends_helpers
+    assert batch_trends.SEASON_MONTHS == trends_helpers.SEASONS
+    for seas in SEASONS:
+        for yr in [2000, 2019]:
+            assert batch_trends._start_season(seas, yr) == trends_helpers._start_season(seas, yr)
+            assert batch_trends._end_season(seas, yr) == trends_helpers._end_season(seas, yr)
+            assert batch_trends._mid_season(seas, yr) == trends_helpers._mid_season(seas, yr)
+    with pytest.raises(ValueError):
+        batch_trends._start_season('monsoon', 2000)
+
+
+def test_yearly_csv_same_as_baseline(tmp_path):
+    # yearly files as written by calc_trends.py and calc_trends_pr.py, and
+    # as written by the baseline (TrendsEngine.compute_trend(...)['data'])
+    from pyaerocom.trends_engine import TrendsEngine
+    from output_store import CsvOutput
+    times = pd.DatetimeIndex(pd.date_range('1999-01-01', '2020-12-01', freq='MS') +
+                             pd.Timedelta('14D'), name='time')
+    values = _synthetic(times, nstat=12)
+    results, yearly = compute_trends_batch(times, values, 'monthly', PERIODS, SEASONS)
+    out = CsvOutput(str(tmp_path), 'concso4')
+    for istat in range(values.shape[0]):
+        # monthly series as in the colocated data of the baseline
+        ts = pd.Series(values[istat], index=times, name='concso4')
+        for start, stop, min_yrs in PERIODS:
+            for seas in SEASONS:
+                ref = TrendsEngine.compute_trend(ts, 'monthly', start, stop, min_yrs,
+                                                 seas)['data']
+                series = yearly_series(yearly, istat, start, stop, seas)
+                if ref is None:
+                    assert series is None
+                    continue
+                out.write_yearly(f'XX{istat:04d}R', f'{start}-{stop}', seas, series)
+                fname = f'concso4_XX{istat:04d}R_{start}-{stop}_{seas}_yearly.csv'
+                ref.to_csv(tmp_path / 'ref.csv')
+                written = pd.read_csv(tmp_path / 'data_concso4' / fname, dtype=str)
+                expected = pd.read_csv(tmp_path / 'ref.csv', dtype=str)
+                # same header and dates, values up to the order of summation
+                assert list(written.columns) == list(expected.columns) == ['Unnamed: 0', '0']
+                assert (written.iloc[:, 0] == expected.iloc[:, 0]).all()
+                np.testing.assert_allclose(written.iloc[:, 1].astype(float),
+                                           expected.iloc[:, 1].astype(float), rtol=1e-12)
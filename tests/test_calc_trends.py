@@ -0,0 +1,36 @@
+import ast
+import os
+import pytest
+
+pytest.importorskip('pyaerocom')
+
+import calc_trends
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _local_imports(module):
+    # modules of this repository imported by module (recursively)
+    found = set()
+    todo = [module]
+    while todo:
+        with open(os.path.join(REPO_DIR, todo.pop() + '.py')) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                if (name not in found and
+                        os.path.exists(os.path.join(REPO_DIR, name + '.py'))):
+                    found.add(name)
+                    todo.append(name)
+    return found
+
+
+def test_code_files_cover_imported_modules():
+    imported = {name + '.py' for name in _local_imports('calc_trends')}
+    assert imported <= set(calc_trends.CODE_FILES)
@@ -0,0 +1,109 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyaerocom')
+
+from helper_functions import run_tasks, ColocatedArrays, MonthlyFromDaily, MONTH_OFFSET
+from profiling import PROFILER, stage
+
+
+def _square(x):
+    with stage('trends', str(x)):
+        return x * x
+
+
+def test_run_tasks_order_and_worker_profiling(tmp_path):
+    assert run_tasks(_square, [(i,) for i in range(5)]) == [0, 1, 4, 9, 16]
+    PROFILER.enable(str(tmp_path), 'test')
+    try:
+        results = run_tasks(_square, [(i,) for i in range(5)], nworkers=2)
+        records = PROFILER.read_records()
+    finally:
+        PROFILER.report_dir = None
+    assert results == [0, 1, 4, 9, 16]
+    assert len(records) == 5 and (records['pid'] != os.getpid()).all()
+
+
+def test_run_tasks_reads_generator_lazily():
+    started = []
+
+    def tasks():
+        for i in range(4):
+            started.append(i)
+            yield (i,)
+
+    def func(x):
+        # the next task is only read after this one is done
+        assert started == list(range(x + 1))
+        return x * x
+
+    assert run_tasks(func, tasks()) == [0, 1, 4, 9]
+    assert run_tasks(_square, tasks(), nworkers=2) == [0, 1, 4, 9]
+    assert run_tasks(_square, iter([])) == [] == run_tasks(_square, [], nworkers=2)
+
+
+@pytest.mark.parametrize('how', ['mean', 'sum'])
+def test_monthly_from_daily_same_as_pandas(how):
+    rng = np.random.default_rng(3)
+    times = pd.date_range('2018-01-01', '2019-12-31', freq='D')
+    obs = rng.normal(10, 2, (3, len(times)))
+    obs[rng.random(obs.shape) < 0.3] = np.nan
+    obs[2, :100] = np.nan
+    mod = np.where(np.isnan(obs), np.nan, obs + 1)
+    daily = ColocatedArrays.from_arrays(times, obs, mod, ['a', 'b', 'c'], [50.] * 3,
+                                        [10.] * 3, [0.] * 3, 'var')
+    monthly = MonthlyFromDaily(daily).monthly(21, how=how)
+    for values, result in [(obs, monthly.obs), (mod, monthly.mod)]:
+        for istat in range(3):
+            resampler = pd.Series(values[istat], index=times).resample('MS')
+            ref = getattr(resampler, how)()
+            ref[resampler.count() < 21] = np.nan
+            np.testing.assert_allclose(result[istat], ref.values, rtol=1e-12)
+    assert (monthly.times == ref.index + MONTH_OFFSET).all()
+    with pytest.raises(ValueError):
+        MonthlyFromDaily(daily).monthly(21, how='median')
+
+
+def test_colocate_monthly_daily_and_weekly_stations(tmp_path):
+    import pyaerocom as pya
+    import benchmark
+    from helper_functions import colocate_monthly
+    from read_mods import read_model, EMEP_VAR_UNITS
+    for year in [2018, 2019]:
+        benchmark.make_model_file(benchmark.benchmark_modelfile(str(tmp_path), year, 'day'),
+                                  benchmark.emep_fields('concso4'), year, 12, 15, 'day')
+    stations = benchmark.make_stations(6)
+    assert set(stations.ts_type) == {'daily', 'weekly'}
+    # the second station has daily observations in 2018 and weekly ones in 2019
+    mixed = stations.iloc[[1]]
+    stats = [benchmark.make_obs('concso4', stations.drop(index=1), 2018, 2019),
+             benchmark.make_obs('concso4', mixed, 2018, 2018, ts_type='daily'),
+             benchmark.make_obs('concso4', mixed, 2019, 2019, ts_type='weekly')]
+    data = pya.UngriddedData.from_station_data(
+        [ungridded.to_station_data(i) for ungridded in stats
+         for i in range(len(ungridded.metadata))])
+    assert len(data.metadata) == len(stations) + 1
+    var_info = {'concso4': {'units': EMEP_VAR_UNITS['concso4'], 'data_freq': 'day'}}
+    mdata = read_model('concso4', lambda year, freq: benchmark.benchmark_modelfile(
+        str(tmp_path), year, freq), 2018, 2020, var_info)
+    constraints = [dict(monthly=dict(daily=21, weekly=3), daily=dict(hourly=18)),
+                   dict(monthly=dict(daily=4, weekly=2), daily=dict(hourly=18))]
+    results = colocate_monthly(mdata, data, '2018', '2020', constraints)
+    for colarr, min_num_obs in zip(results, constraints):
+        # same as colocating monthly with colocate_time=True
+        ref = ColocatedArrays(pya.colocation.colocate_gridded_ungridded(
+            mdata, data, ts_type='monthly', start='2018', stop='2020',
+            colocate_time=True, resample_how='mean', min_num_obs=min_num_obs),
+            '2018', '2020')
+        assert list(colarr.station_names) == list(ref.station_names)
+        # same time stamps as pyaerocom (middle of the month)
+        assert (colarr.times == ref.times).all()
+        assert (colarr.times.day == 15).all()
+        np.testing.assert_allclose(colarr.obs, ref.obs, rtol=1e-6)
+        np.testing.assert_allclose(colarr.mod, ref.mod, rtol=1e-6)
+        assert not np.isnan(colarr.obs).all(axis=1).any()
+        imixed = list(colarr.station_names).index(mixed.station_name.iloc[0])
+        for year in [2018, 2019]:
+            assert not np.isnan(colarr.obs[imixed, colarr.times.year == year]).all()
@@ -0,0 +1,43 @@
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+
+pya = pytest.importorskip('pyaerocom')
+
+from hourly_grid import HourlyGrid
+
+
+def _station(name, times, values, ts_type):
+    stat = pya.StationData(station_id=name, station_name=name, latitude=50.,
+                           longitude=10., altitude=100., ts_type=ts_type,
+                           data_id='test', framework='EMEP', data_level=2,
+                           filename=f'{name}.nas')
+    stat.var_info['vmro3'] = dict(units='ppb', ts_type=ts_type)
+    stat['vmro3'] = pd.Series(values, index=times)
+    return stat
+
+
+def test_from_ungridded_averages_subhourly_values():
+    rng = np.random.default_rng(0)
+    hourly = pd.date_range('2019-01-01', '2019-01-02 23:00', freq='H')
+    halfhourly = pd.date_range('2019-01-01', '2019-01-02 23:30', freq='30min')
+    hvals = rng.normal(30, 5, len(hourly))
+    hhvals = rng.normal(30, 5, len(halfhourly))
+    hhvals[3] = np.nan
+    data = pya.UngriddedData.from_station_data(
+        [_station('A', hourly, hvals, 'hourly'),
+         _station('B', halfhourly, hhvals, 'minutely')])
+
+    with pytest.warns(UserWarning, match='47 station hours'):
+        grid = HourlyGrid.from_ungridded(data, 'vmro3', 2019, 2019)
+    assert grid.station_names == ['A', 'B']
+    np.testing.assert_array_equal(grid.values[0, :2].ravel(), hvals)
+    ref = pd.Series(hhvals, index=halfhourly).resample('H').mean()
+    np.testing.assert_allclose(grid.values[1, :2].ravel(), ref.values)
+    assert np.isnan(grid.values[:, 2:]).all()
+
+    # no warning for hourly data
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        HourlyGrid.from_ungridded(data.apply_filters(station_name='A'), 'vmro3', 2019, 2019)
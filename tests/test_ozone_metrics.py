@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyaerocom')
+
+import ozone_metrics as om
+from hourly_grid import HourlyGrid
+
+
+def _hourly(nstat=3, seed=1):
+    # two years of hourly ozone with gaps (one station without May 2020)
+    rng = np.random.default_rng(seed)
+    days = pd.date_range('2019-01-01', '2020-12-31', freq='D')
+    values = rng.gamma(8, 5, (nstat, len(days), 24))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    values[:, 40:45] = np.nan
+    values[1, (days.year == 2020) & (days.month == 5)] = np.nan
+    return days, values
+
+
+def _series(days, values):
+    index = pd.date_range(days[0], periods=values.size, freq='H')
+    return pd.Series(values.ravel(), index=index)
+
+
+def _mda8_ref(series):
+    means = series.rolling(8, min_periods=om.MDA8_MIN_HOURS).mean()
+    daily = means.resample('D').max()
+    daily[means.resample('D').count() < om.MDA8_MIN_MEANS] = np.nan
+    return daily
+
+
+def test_metrics_same_as_pandas():
+    days, values = _hourly()
+    daily = om.mda8(values)
+    _, somo = om.somo35(days, daily, min_days=300)
+    _, aot = om.aot40(days, values)
+    for istat in range(values.shape[0]):
+        series = _series(days, values[istat])
+        ref = _mda8_ref(series)
+        np.testing.assert_allclose(daily[istat], ref.values, rtol=1e-12)
+
+        for iyr, year in enumerate([2019, 2020]):
+            yr = ref[ref.index.year == year]
+            expected = (np.maximum(yr - om.SOMO35_THRESHOLD, 0).sum() *
+                        len(yr) / yr.count()) if yr.count() >= 300 else np.nan
+            np.testing.assert_allclose(somo[istat, iyr], expected, rtol=1e-12)
+
+            sel = series[(series.index.year == year) &
+                         series.index.month.isin(om.AOT40_MONTHS) &
+                         series.index.hour.isin(om.AOT40_HOURS)]
+            if sel.count() < om.AOT40_MIN_COVERAGE * len(sel):
+                expected = np.nan
+            else:
+                expected = (np.maximum(sel - om.AOT40_THRESHOLD, 0).sum() *
+                            len(sel) / sel.count())
+            np.testing.assert_allclose(aot[istat, iyr], expected, rtol=1e-12)
+    # the station without May 2020 has too little coverage for AOT40
+    assert np.isnan(aot[1, 1]) and not np.isnan(aot[0, 1])
+
+
+def test_model_hour_starts():
+    start = pd.date_range('2019-01-01', '2019-12-31 23:00', freq='H').values
+    hour = np.timedelta64(1, 'h')
+    np.testing.assert_array_equal(om.model_hour_starts(start, 2019), start)
+    np.testing.assert_array_equal(om.model_hour_starts(start + hour, 2019), start)
+    np.testing.assert_array_equal(om.model_hour_starts(start + hour // 2, 2019), start)
+    # the end of the last hour of a file without the first hours
+    np.testing.assert_array_equal(om.model_hour_starts(start[5:] + hour, 2019), start[5:])
+    with pytest.raises(ValueError):
+        om.model_hour_starts(start[5:-5], 2019)
+
+
+def test_model_hourly_grid_end_of_hour_stamps(tmp_path):
+    import netCDF4
+    import benchmark
+    days = pd.date_range('2019-01-01', '2019-12-31', freq='D')
+    lats, lons = [45.3, 60.1], [5.2, 20.7]
+    metas = [dict(latitude=lat, longitude=lon) for lat, lon in zip(lats, lons)]
+    obs = HourlyGrid(np.zeros((2, len(days), 24)), days, ['A', 'B'], metas, 'vmro3')
+    grids = []
+    for name in ['start', 'end']:
+        path = benchmark.benchmark_modelfile(str(tmp_path / name), 2019, 'hour')
+        benchmark.make_model_file(path, benchmark.emep_fields('vmro3'), 2019, 12, 15, 'hour')
+        if name == 'end':
+            with netCDF4.Dataset(path, 'a') as nc:
+                nc['time'][:] = nc['time'][:] + 1
+        getfile = lambda year, freq, name=name: benchmark.benchmark_modelfile(
+            str(tmp_path / name), year, freq)
+        grids.append(om.model_hourly_grid(obs, getfile, 'vmro3', 'ppb'))
+    assert not np.isnan(grids[0].values).any()
+    np.testing.assert_array_equal(grids[1].values, grids[0].values)
+
+    with pytest.warns(UserWarning, match='No hourly model file for 2019'):
+        om.model_hourly_grid(obs, lambda year, freq: str(tmp_path / 'missing.nc'),
+                             'vmro3', 'ppb')
@@ -0,0 +1,163 @@
+import os
+import numpy as np
+import pytest
+
+iris = pytest.importorskip('iris')
+pytest.importorskip('pyaerocom')
+
+
+def _double(cube):
+    return cube * 2
+
+
+def test_check_calc_how():
+    from read_mods import check_calc_how, CALCULATE_HOW
+    check_calc_how(CALCULATE_HOW)
+    # a variable listing itself means the raw field
+    check_calc_how({'a': {'req_vars': ['a'], 'function': _double}})
+    bad = [{'a': {'req_vars': ['b'], 'function': _double},
+            'b': {'req_vars': ['c', 'a'], 'function': _double}},
+           {'a': {'req_vars': ['b', 'b'], 'function': _double}},
+           {'a': {'req_vars': ['c'], 'function': _double},
+            'b': {'req_vars': ['c'], 'function': _double}}]
+    for calc_how in bad:
+        with pytest.raises(ValueError):
+            check_calc_how(calc_how)
+
+
+def test_group_variables():
+    from read_mods import group_variables, ReadPlan, CALCULATE_HOW
+    variables = ['concNhno3', 'concso4', 'concNno3pm25', 'concNtnh', 'concNtno3',
+                 'concNnh3', 'concpm25']
+    assert group_variables(variables, CALCULATE_HOW) == [
+        ['concNhno3', 'concNno3pm25', 'concNtno3'], ['concso4'],
+        ['concNtnh', 'concNnh3'], ['concpm25']]
+    # concNno3pm25 uses the derived concno3pm25 of its own entry
+    plan = ReadPlan(['concNno3pm25'], CALCULATE_HOW)
+    assert [step[0] for step in plan.steps] == ['concno3pm25', 'concNno3pm25']
+    assert plan.raw_vars == ['concno3f', 'concno3c']
+
+
+@pytest.fixture(scope='module')
+def model_dir(tmp_path_factory):
+    # two years of synthetic daily EMEP files with the fields of the test
+    # variables (see benchmark.py)
+    import benchmark
+    datadir = str(tmp_path_factory.mktemp('model'))
+    fields = sorted(set(field for var in ['conchno3', 'concno3f', 'concno3c', 'concso4']
+                        for field in benchmark.emep_fields(var)))
+    for year in [2018, 2019]:
+        benchmark.make_model_file(benchmark.benchmark_modelfile(datadir, year, 'day'),
+                                  fields, year, 12, 15, 'day')
+    return datadir
+
+
+def _read(model_dir, **kwargs):
+    import benchmark
+    from read_mods import read_models, CALCULATE_HOW, EMEP_VAR_UNITS
+    variables = ['concNtno3', 'concso4']
+    var_info = {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': 'day'} for var in variables}
+    getfile = lambda year, freq: benchmark.benchmark_modelfile(model_dir, year, freq)
+    return read_models(variables, getfile, 2018, 2020, var_info, CALCULATE_HOW, **kwargs)
+
+
+def test_read_models_parallel_same_as_serial(model_dir, tmp_path):
+    from profiling import PROFILER
+    serial = _read(model_dir)
+    PROFILER.enable(str(tmp_path), 'test')
+    try:
+        parallel = _read(model_dir, nworkers=2, max_inflight=1)
+        records = PROFILER.read_records()
+    finally:
+        PROFILER.report_dir = None
+    for var, data in serial.items():
+        np.testing.assert_array_equal(parallel[var].cube.data, data.cube.data)
+        np.testing.assert_array_equal(parallel[var].time_stamps(), data.time_stamps())
+    # stages of the workers are recorded
+    worker_stages = records[records['pid'] != os.getpid()]
+    assert {'read_model', 'derive'} <= set(worker_stages['stage'])
+
+
+@pytest.mark.parametrize('data_freq', ['day', 'hour'])
+def test_read_var_at_stations_same_as_read_var(tmp_path, data_freq):
+    import pyaerocom as pya
+    import benchmark
+    from read_mods import StationGridIndex, read_var_at_stations, crop_to_stations
+    path = benchmark.benchmark_modelfile(str(tmp_path), 2019, data_freq)
+    benchmark.make_model_file(path, benchmark.emep_fields('concso4'), 2019, 12, 15, data_freq)
+    lats = np.array([40.3, 52.77, 52.9, 68.1])
+    lons = np.array([-20.2, 5.01, 30.3, 12.6])
+
+    full = pya.io.ReadMscwCtm(path).read_var('concso4')
+    subgrids = [read_var_at_stations(pya.io.ReadMscwCtm(path), 'concso4',
+                                     StationGridIndex(lats, lons)),
+                crop_to_stations(pya.io.ReadMscwCtm(path).read_var('concso4'),
+                                 StationGridIndex(lats, lons))]
+    ref = full.to_time_series(latitude=list(lats), longitude=list(lons))
+    for sub in subgrids:
+        assert sub.units == full.units and sub.ts_type == full.ts_type
+        assert sub.var_name == full.var_name
+        assert sub.metadata['data_id'] == full.metadata['data_id']
+        np.testing.assert_array_equal(sub.time_stamps(), full.time_stamps())
+        # nearest cell of each station as on the full grid
+        times, values = StationGridIndex(lats, lons).extract(sub)
+        for i, stat in enumerate(ref):
+            np.testing.assert_array_equal(times, stat['concso4'].index.values)
+            np.testing.assert_allclose(values[:, i], stat['concso4'].values, rtol=1e-6)
+
+
+def test_read_models_cache_key_per_variable(model_dir, tmp_path):
+    from read_mods import StationGridIndex
+    own = StationGridIndex([45.1, 60.2], [10.3, 20.4])
+    union = StationGridIndex([45.1, 50.5, 60.2], [10.3, 0.2, 20.4])
+    other_union = StationGridIndex([45.1, 60.2, 70.7], [10.3, 20.4, 30.1])
+    cache_dir = str(tmp_path)
+    first = _read(model_dir, station_index=union, cache_dir=cache_dir,
+                  var_station_index={'concso4': own})
+    files = set(os.listdir(cache_dir))
+    assert len(files) == 2
+    # other stations of concNtno3 only invalidate the cache of concNtno3
+    second = _read(model_dir, station_index=other_union, cache_dir=cache_dir,
+                   var_station_index={'concso4': own})
+    assert len(set(os.listdir(cache_dir)) - files) == 1
+    _, values = own.extract(first['concso4'])
+    _, cached = own.extract(second['concso4'])
+    np.testing.assert_array_equal(cached, values)
+
+
+@pytest.mark.parametrize('data_freq', ['day', 'hour'])
+def test_load_subgrid_same_as_read_var_and_extract(tmp_path, data_freq):
+    # _load_subgrid repeats internals of ReadMscwCtm.read_var, so it is
+    # checked on its own (also with versions not in
+    # READ_AT_STATIONS_PYAEROCOM_VERSIONS, where read_var_at_stations does
+    # not use it), for raw fields read directly and computed on import
+    import pyaerocom as pya
+    import benchmark
+    from read_mods import StationGridIndex, crop_to_stations, _load_subgrid
+    variables = ['concso4', 'concpm25', 'concno3']
+    assert 'concno3' in pya.io.ReadMscwCtm.AUX_REQUIRES
+    fields = sorted(set(field for var in variables for field in benchmark.emep_fields(var)))
+    path = benchmark.benchmark_modelfile(str(tmp_path), 2019, data_freq)
+    benchmark.make_model_file(path, fields, 2019, 12, 15, data_freq)
+    lats = np.array([40.3, 52.77, 52.9, 68.1])
+    lons = np.array([-20.2, 5.01, 30.3, 12.6])
+
+    for var in variables:
+        sub = _load_subgrid(pya.io.ReadMscwCtm(path), var, StationGridIndex(lats, lons))
+        full = pya.io.ReadMscwCtm(path).read_var(var)
+        ref = crop_to_stations(pya.io.ReadMscwCtm(path).read_var(var),
+                               StationGridIndex(lats, lons))
+        # same cube as reading the full grid and cropping it
+        assert sub.cube.units == ref.cube.units
+        assert sub.cube.var_name == ref.cube.var_name
+        assert sub.ts_type == ref.ts_type
+        assert sub.metadata == ref.metadata
+        for coord in ['time', 'latitude', 'longitude']:
+            assert sub.cube.coord(coord) == ref.cube.coord(coord)
+        np.testing.assert_array_equal(sub.cube.data, ref.cube.data)
+        # same values at the stations as extracted from the full grid
+        times, values = StationGridIndex(lats, lons).extract(sub)
+        for i, stat in enumerate(full.to_time_series(latitude=list(lats),
+                                                     longitude=list(lons))):
+            np.testing.assert_array_equal(times, stat[var].index.values)
+            np.testing.assert_array_equal(values[:, i], stat[var].values)
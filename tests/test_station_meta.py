@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pya = pytest.importorskip('pyaerocom')
+
+import station_meta
+from station_meta import get_station_meta, extract_stations
+
+VAR = 'concso4'
+
+
+def _block(station, framework, matrix, start, stop, seed, data_id='synthetic'):
+    # one metadata block of a station with daily data
+    times = pd.date_range(start, stop, freq='D')
+    rng = np.random.default_rng(seed)
+    values = rng.normal(2, 0.5, len(times))
+    values[rng.random(len(times)) < 0.2] = np.nan
+    stat = pya.StationData(station_id=station[0], station_name=station[1],
+                           latitude=station[2], longitude=station[3],
+                           altitude=station[4], ts_type='daily', data_id=data_id,
+                           framework=framework, data_level=2)
+    stat.var_info[VAR] = dict(units='ug m-3', ts_type='daily', matrix=matrix)
+    stat[VAR] = pd.Series(values, index=times)
+    return stat
+
+
+@pytest.fixture(params=['ungridded', 'station_data'])
+def data(request, monkeypatch):
+    if request.param == 'station_data':
+        # pyaerocom version without the fast paths
+        monkeypatch.setattr(station_meta, 'STATION_META_PYAEROCOM_VERSIONS', [])
+    stations = [('XX0001R', 'Station 1', 50.1, 10.2, 100.),
+                ('XX0002R', 'Station 2', 60.3, 5.4, 250.),
+                ('XX0003R', 'Station 3', 45.5, -3.6, 0.)]
+    blocks = [_block(stations[0], 'EMEP', 'pm10', '2018-01-01', '2019-12-31', 1),
+              # several blocks with different framework and matrix, the
+              # second one has more valid data and gives the altitude
+              _block(stations[1], 'EMEP', 'pm10', '2018-01-01', '2018-06-30', 2),
+              _block(stations[1][:4] + (260.,), 'ACTRIS', 'pm25', '2018-07-01',
+                     '2019-12-31', 3),
+              _block(stations[1], 'EMEP', 'aerosol', '2019-01-01', '2019-03-31', 4),
+              # no data in the time range
+              _block(stations[2], 'EMEP', 'pm10', '2015-01-01', '2015-12-31', 5)]
+    return pya.UngriddedData.from_station_data(blocks)
+
+
+def test_get_station_meta_same_as_to_station_data(data):
+    meta = get_station_meta(data, VAR, start=2018, stop=2020)
+    assert list(meta.index) == ['Station 1', 'Station 2']
+    for name, row in meta.iterrows():
+        ref = data.to_station_data(name, VAR, start=2018, stop=2020)
+        assert row.station_id == ref.station_id
+        assert row.station_name == ref.station_name
+        assert row.framework == ref.framework
+        assert row.matrix == ref.var_info[VAR]['matrix']
+        assert row.unit == ref.get_unit(VAR)
+        assert (row.latitude, row.longitude, row.altitude) == (
+            ref.latitude, ref.longitude, ref.altitude)
+    assert meta.loc['Station 2', 'altitude'] == 260.
+    assert ';' in meta.loc['Station 2', 'framework']
+    assert ';' in meta.loc['Station 2', 'matrix']
+
+
+def test_extract_stations_same_as_filter_by_meta(data):
+    extracted = extract_stations(data, ['Station 2'])
+    ref = data.filter_by_meta(station_name='Station 2')
+    assert len(extracted.metadata) == len(ref.metadata) == 3
+    stat = extracted.to_station_data('Station 2', VAR)
+    refstat = ref.to_station_data('Station 2', VAR)
+    pd.testing.assert_series_equal(stat[VAR], refstat[VAR])
+    assert extract_stations(data, data.unique_station_names) is data
+
+
+def test_merge_pref_attr_same_as_pyaerocom(data):
+    ebas = pya.const.EBAS_MULTICOLUMN_NAME
+    metas = [dict(data_id=ebas), dict(data_id=ebas)]
+    for blocks in [metas, metas[:1] + [dict(data_id='synthetic')], [{}],
+                   list(data.metadata.values())]:
+        assert (station_meta._merge_pref_attr(blocks) ==
+                data._try_infer_stat_merge_pref_attr(blocks))
+    assert station_meta._merge_pref_attr(metas) == 'revision_date'
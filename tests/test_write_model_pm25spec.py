@@ -0,0 +1,38 @@
+import os
+import pytest
+
+pytest.importorskip('pyaerocom')
+
+from write_model_pm25spec import write_pm25spec
+
+VARIABLES = ['concso4', 'concno3pm25']
+
+
+def test_write_pm25spec_stream_same_as_all_years(tmp_path):
+    import benchmark
+    fields = sorted(set(field for var in ['concso4', 'concno3f', 'concno3c']
+                        for field in benchmark.emep_fields(var)))
+    for year in [2018, 2019]:
+        benchmark.make_model_file(benchmark.benchmark_modelfile(str(tmp_path), year, 'day'),
+                                  fields, year, 12, 15, 'day')
+    getfile = lambda year, freq: benchmark.benchmark_modelfile(str(tmp_path), year, freq)
+    args = (['XX01', 'XX02'], [45.1, 60.2], [10.3, 20.4])
+    outdirs = []
+    for stream in [True, False]:
+        outdir = tmp_path / f'stream_{stream}'
+        outdir.mkdir()
+        # no model file for 2017
+        with pytest.warns(UserWarning, match='2017'):
+            write_pm25spec(getfile, *args, str(outdir), 2017, 2019, stream=stream,
+                           variables=VARIABLES)
+        outdirs.append(outdir)
+    files = sorted(os.listdir(outdirs[0]))
+    assert files == sorted(os.listdir(outdirs[1])) and len(files) == 2
+    for fname in files:
+        streamed = (outdirs[0] / fname).read_text()
+        assert streamed == (outdirs[1] / fname).read_text()
+        assert streamed.splitlines()[0] == ',' + ','.join(VARIABLES)
+        assert len(streamed.splitlines()) == 1 + 365 * 2
+
+    with pytest.raises(IOError), pytest.warns(UserWarning):
+        write_pm25spec(getfile, *args, str(tmp_path), 2010, 2011, variables=VARIABLES)
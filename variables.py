@@ -15,6 +15,9 @@ ALL_EBAS_VARS = ['concno2',
                  'concpm25',
                  'concpm10',
                  'vmro3max',  # NB: EBAS variable is vmro3, but it is called vmro3max after resampled to daily max
+                 'vmro3mda8',  # NB: ozone metrics computed from vmro3 (see ozone_metrics.py)
+                 'somo35',
+                 'aot40',
                  'concso4',
                  'concNtno3',
                  'concNtnh',
@@ -1,12 +1,14 @@
 """
 Calculate daily time series at stations from EMEP model grid output
 """
-import os
+import os, warnings
 
 import pandas as pd
 
-from read_mods import read_model, EMEP_VAR_UNITS, CALCULATE_HOW, get_modelfile
+from read_mods import (read_models, EMEP_VAR_UNITS, CALCULATE_HOW, get_modelfile,
+                       StationGridIndex)
 from helper_functions import clear_output
+from profiling import stage
 
 # Provide the range of years to include in the time series (both FIRST_YEAR and LAST_YEAR are included)
 FIRST_YR = 2010
@@ -36,6 +38,107 @@ DATA_FREQ = 'day'
 
 DATA_FREQ_IN_FILENAME = {'day': 'daily', 'month': 'monthly', 'year': 'yearly'}
 
+# Folder where the grid cells of the stations are cached (see
+# read_mods.StationGridIndex.save), None to not cache them (see README.md)
+STATION_INDEX_CACHE_DIR = None
+
+# If True, the model files are read one year at a time and the time series
+# of the year are appended to the output files, so that only one year of
+# data at the stations is kept in memory. Otherwise all years are read
+# before writing (the output files are the same)
+STREAM_YEARS = True
+
+
+def _station_frames(moddata, station_index, site_ids, variables):
+    # time series of the variables at each station (extracted in the grid
+    # cell of the station, see read_mods.StationGridIndex.extract)
+    sitedata = dict([(site_id, {}) for site_id in site_ids])
+    for var in variables:
+        vardata = moddata.pop(var)
+        with stage('colocate', var):
+            times, values = station_index.extract(vardata)
+        for i, site_id in enumerate(site_ids):
+            sitedata[site_id][var] = pd.Series(values[:, i], index=times)
+    return {site_id: pd.DataFrame.from_dict(sitedata[site_id], orient='columns')
+            for site_id in site_ids}
+
+
+def write_pm25spec(getfile, site_ids, latitudes, longitudes, outdir,
+                   first_yr, last_yr, data_freq=DATA_FREQ, cache_dir=None,
+                   stream=STREAM_YEARS, variables=EBAS_VARS):
+    """
+    Write model time series of the PM2.5 species at stations
+
+    Parameters
+    ----------
+    getfile : function (int, str) -> str
+        Function to get the model file of a year (see read_mods.read_model).
+    site_ids, latitudes, longitudes : list
+        Station codes and coordinates (the output files only have the codes,
+        in their names).
+    outdir : str
+        Output folder (one csv file per station).
+    first_yr, last_yr : int
+        First and last year (both included).
+    data_freq : str
+        Time frequency of the model files.
+    cache_dir : str, optional
+        Folder of the cached station index (see
+        read_mods.StationGridIndex.cached).
+    stream : bool
+        If True, read and write one year at a time (see STREAM_YEARS). The
+        output files are the same.
+    variables : list
+        Species to write (as in pyaerocom, see EBAS_VARS).
+
+    Raises
+    ------
+    IOError
+        If there is no model file for any of the years.
+    """
+    data_freq_filestr = DATA_FREQ_IN_FILENAME[data_freq]
+    outfiles = {site_id: os.path.join(outdir, f'pm25spec_ugm3_{site_id}_{first_yr}-{last_yr}_'
+                                              f'{data_freq_filestr}.csv')
+                for site_id in site_ids}
+    # Read data at each station location (only the grid cells of the stations
+    # are read from the model files)
+    # All species are read in one pass over the model files, and the grid
+    # cells of the stations are found once and used for all species
+    station_index = StationGridIndex.cached(latitudes, longitudes, cache_dir=cache_dir)
+    var_info = {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': data_freq} for var in variables}
+    if stream:
+        # years without model file are missing in the output, as when
+        # reading all years at once
+        periods = []
+        for year in range(first_yr, last_yr + 1):
+            infile = getfile(year, data_freq)
+            if not os.path.exists(infile):
+                warnings.warn('No model data found for year %d. File %s not found' % (year, infile))
+                continue
+            periods.append((year, year + 1))
+        if not periods:
+            raise IOError(f'No model files found for {first_yr}-{last_yr}')
+    else:
+        periods = [(first_yr, last_yr + 1)]
+
+    written = set()
+    for start_yr, stop_yr in periods:
+        moddata = read_models(variables, getfile, start_yr, stop_yr, var_info, CALCULATE_HOW,
+                              station_index=station_index)
+        frames = _station_frames(moddata, station_index, site_ids, variables)
+
+        # Save data to one file per station (appended after the first year)
+        with stage('write_output', 'pm25spec', year=start_yr):
+            for site_id in site_ids:
+                if site_id in written:
+                    frames[site_id].to_csv(outfiles[site_id], mode='a', header=False)
+                else:
+                    frames[site_id].to_csv(outfiles[site_id])
+                    written.add(site_id)
+    if cache_dir is not None and station_index.grid_lats is not None:
+        station_index.save(station_index.cache_file(cache_dir))
+
+
 if __name__ == '__main__':
 
     data_freq_filestr = DATA_FREQ_IN_FILENAME[DATA_FREQ]
@@ -64,25 +167,10 @@ if __name__ == '__main__':
     # Create station metadata lists to be used by to_time_series
     longitudes = list(indata['longitude'].values)
     latitudes = list(indata['latitude'].values)
-    names = [indata['Station name'][i] for i in range(nst)]
     site_ids = [indata['Code'][i] for i in range(nst)]
-    add_meta = {'station_id': site_ids, 'station_name': names}
-
-    # Read data at each station location
-    sitedata = dict([(site_ids[i], {}) for i in range(nst)])
-    for var in EBAS_VARS:
-        var_info = {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': DATA_FREQ}}
-        vardata = read_model(var, get_modelfile, FIRST_YR, LAST_YR+1, var_info, CALCULATE_HOW)
-        stationdata_list = vardata.to_time_series(longitude=longitudes, latitude=latitudes, add_meta=add_meta)
-        for sd in stationdata_list:
-            site_id = sd.station_id
-            sitedata[site_id][var] = sd[var]
-
-    # Save data to one file per station
-    for site_id in site_ids:
-        moddf = pd.DataFrame.from_dict(sitedata[site_id], orient='columns')
-        fname = f'pm25spec_ugm3_{site_id}_{FIRST_YR}-{LAST_YR}_{data_freq_filestr}.csv'
-        modout = os.path.join(PM25SPEC_MOD_OUTPUT_DIR, fname)
-        moddf.to_csv(modout)
+
+    write_pm25spec(get_modelfile, site_ids, latitudes, longitudes,
+                   PM25SPEC_MOD_OUTPUT_DIR, FIRST_YR, LAST_YR, DATA_FREQ,
+                   STATION_INDEX_CACHE_DIR)
 
     print('Done.')